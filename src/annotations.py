@@ -0,0 +1,153 @@
+import cv2
+import operations
+
+
+# pixels a stroke can reach past its geometry, on top of half its thickness
+MARGIN = 2
+
+
+def bounds(kind, params):
+    pad = operations.THICKNESS + MARGIN
+    if kind == "text":
+        (w, h), baseline = cv2.getTextSize(
+            params["text"],
+            operations.FONT,
+            params["font_scale"],
+            operations.THICKNESS,
+        )
+        x0, y0 = params["x"], params["y"] - h
+        x1, y1 = params["x"] + w, params["y"] + baseline
+    elif kind == "rectangle":
+        x0, y0 = params["x"], params["y"]
+        x1, y1 = x0 + params["w"], y0 + params["h"]
+    elif kind == "line":
+        x0, x1 = sorted((params["x1"], params["x2"]))
+        y0, y1 = sorted((params["y1"], params["y2"]))
+    elif kind == "circle":
+        x0, y0 = (
+            params["center_x"] - params["radius"],
+            params["center_y"] - params["radius"],
+        )
+        x1, y1 = (
+            params["center_x"] + params["radius"],
+            params["center_y"] + params["radius"],
+        )
+    else:
+        raise ValueError(f"Unknown annotation: {kind}")
+    return x0 - pad, y0 - pad, x1 - x0 + 2 * pad + 1, y1 - y0 + 2 * pad + 1
+
+
+def union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+    x1, y1 = max(a[0] + a[2], b[0] + b[2]), max(a[1] + a[3], b[1] + b[3])
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def overlaps(a, b):
+    return (
+        a[0] < b[0] + b[2]
+        and b[0] < a[0] + a[2]
+        and a[1] < b[1] + b[3]
+        and b[1] < a[1] + a[3]
+    )
+
+
+def clip(rect, shape):
+    x0, y0 = max(rect[0], 0), max(rect[1], 0)
+    x1, y1 = min(rect[0] + rect[2], shape[1]), min(rect[1] + rect[3], shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def shifted(kind, params, dx, dy):
+    keys = {
+        "text": (("x", "y"),),
+        "rectangle": (("x", "y"),),
+        "line": (("x1", "y1"), ("x2", "y2")),
+        "circle": (("center_x", "center_y"),),
+    }[kind]
+    params = dict(params)
+    for x, y in keys:
+        params[x] -= dx
+        params[y] -= dy
+    return params
+
+
+def needs_color(image, annotations):
+    return operations.layout(image) == "gray" and any(
+        len(set(params["color"])) > 1 for _, params in annotations
+    )
+
+
+def render(image, annotations, region=None):
+    # a gray image stays gray unless one of the strokes actually has a colour
+    base = operations.to_color(image) if needs_color(image, annotations) else image
+    if region is None:
+        region = (0, 0, image.shape[1], image.shape[0])
+    else:
+        annotations = [
+            (kind, params)
+            for kind, params in annotations
+            if overlaps(bounds(kind, params), region)
+        ]
+    # OpenCV clips a stroke to the canvas before rasterising it, so every stroke must fit whole
+    # or it would come out slightly different from the full render
+    area = region
+    for kind, params in annotations:
+        area = union(area, clip(bounds(kind, params), image.shape))
+    x, y, w, h = area
+    y_end, x_end = y + h, x + w
+    canvas = base[y:y_end, x:x_end].copy()
+    gray = operations.layout(canvas) == "gray"
+    for kind, params in annotations:
+        params = shifted(kind, params, x, y)
+        params["color"] = tuple(params["color"])[:1] if gray else tuple(params["color"])
+        operations.DRAWINGS[kind](canvas, **params)
+
+    top, left = region[1] - y, region[0] - x
+    bottom, right = top + region[3], left + region[2]
+    return canvas[top:bottom, left:right]
+
+
+class Compositor:
+    def __init__(self):
+        self.base = None
+        self.annotations = ()
+        self.image = None
+
+    def update(self, base, annotations):
+        # returns the composited image and the rectangle that changed, None when all of it did
+        if (
+            base is not self.base
+            or needs_color(base, annotations) != needs_color(base, self.annotations)
+            or not self.annotations
+        ):
+            self.base = base
+            self.annotations = annotations
+            # without annotations the base is shown as it is, no copy is made
+            self.image = render(base, annotations) if annotations else base
+            return self.image, None
+
+        # everything past the common prefix was either added or removed, only those strokes are redrawn
+        common = 0
+        for old, new in zip(self.annotations, annotations):
+            if old != new:
+                break
+            common += 1
+        dirty = None
+        for kind, params in self.annotations[common:] + annotations[common:]:
+            dirty = union(dirty, bounds(kind, params))
+        self.annotations = annotations
+        dirty = clip(dirty, base.shape) if dirty is not None else None
+        if dirty is None:
+            # nothing that changed is inside the image
+            return self.image, (0, 0, 0, 0)
+        x, y, w, h = dirty
+        y_end, x_end = y + h, x + w
+        self.image[y:y_end, x:x_end] = render(base, annotations, dirty)
+        return self.image, dirty
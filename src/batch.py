@@ -0,0 +1,162 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait,
+)
+
+import cv2
+import operations
+
+
+EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def init_worker(threads=1):
+    # every worker handles one image at a time, OpenCV's own threads would only compete with the pool
+    cv2.setNumThreads(threads)
+
+
+def process_file(source, target, steps):
+    start = time.perf_counter()
+    image = cv2.imread(source, cv2.IMREAD_ANYCOLOR)
+    if image is None:
+        return source, time.perf_counter() - start, "не удалось прочитать файл"
+    try:
+        image = operations.run_pipeline(image, steps)
+    except (cv2.error, KeyError, TypeError, ValueError) as error:
+        # one bad file or value is reported for that file, the rest of the batch goes on
+        return source, time.perf_counter() - start, f"{type(error).__name__}: {error}"
+    if not cv2.imwrite(target, image):
+        return source, time.perf_counter() - start, "не удалось записать файл"
+    return source, time.perf_counter() - start, None
+
+
+def iter_images(input_dir):
+    for entry in sorted(os.scandir(input_dir), key=lambda entry: entry.name):
+        if entry.is_file() and entry.name.lower().endswith(EXTENSIONS):
+            yield entry.path
+
+
+def target_path(source, output_dir, extension=None):
+    name = os.path.basename(source)
+    if extension:
+        name = os.path.splitext(name)[0] + extension
+    return os.path.join(output_dir, name)
+
+
+def run_batch(
+    steps,
+    input_dir,
+    output_dir,
+    workers=None,
+    extension=None,
+    on_result=None,
+    threads=1,
+):
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+    processed = 0
+    failed = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(threads,),
+    ) as executor:
+        pending = set()
+        sources = iter_images(input_dir)
+        exhausted = False
+        while pending or not exhausted:
+            # keep a bounded number of files in flight so huge directories are streamed, not queued up front
+            while not exhausted and len(pending) < workers * 4:
+                source = next(sources, None)
+                if source is None:
+                    exhausted = True
+                    break
+                target = target_path(source, output_dir, extension)
+                pending.add(executor.submit(process_file, source, target, steps))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                source, seconds, error = future.result()
+                processed += 1
+                if error is not None:
+                    failed += 1
+                if on_result is not None:
+                    on_result(source, seconds, error)
+
+    seconds = time.perf_counter() - start
+    return {
+        "files": processed,
+        "failed": failed,
+        "seconds": seconds,
+        "images_per_second": processed / seconds if seconds > 0 else 0.0,
+    }
+
+
+def print_result(source, seconds, error):
+    if error is None:
+        print(f"{source}\t{seconds * 1000:.1f} мс", flush=True)
+    else:
+        print(f"{source}\tошибка: {error}", file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Пакетная обработка изображений без графического интерфейса",
+    )
+    parser.add_argument(
+        "pipeline",
+        help='JSON-файл или строка со списком операций, например \'[{"op": "blur", "kernel_size": 5}]\'',
+    )
+    parser.add_argument("input_dir", help="Каталог с исходными изображениями")
+    parser.add_argument("output_dir", help="Каталог для результатов")
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="Количество процессов (по умолчанию число ядер)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Потоков OpenCV в каждом процессе (по умолчанию 1; при малом числе больших файлов можно больше)",
+    )
+    parser.add_argument(
+        "--format",
+        default=None,
+        help="Расширение выходных файлов, например .jpg (по умолчанию как у исходного)",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        steps = operations.parse_pipeline(args.pipeline)
+    except ValueError as error:
+        parser.error(str(error))
+
+    summary = run_batch(
+        steps,
+        args.input_dir,
+        args.output_dir,
+        workers=args.workers,
+        extension=args.format,
+        on_result=print_result,
+        threads=args.threads,
+    )
+    print(
+        f"Обработано файлов: {summary['files']}, ошибок: {summary['failed']}, "
+        f"время: {summary['seconds']:.2f} с, {summary['images_per_second']:.1f} изобр./с",
+    )
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
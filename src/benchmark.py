@@ -0,0 +1,888 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import cv2
+import faces
+import numpy as np
+import operations
+import parallel
+import saving
+import server
+import tiles
+from annotations import Compositor
+
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "images")
+
+
+def bundled_images(upscale=1):
+    for path in sorted(glob.glob(os.path.join(IMAGES_DIR, "Picture*.png"))):
+        image = cv2.imread(path)
+        if upscale != 1:
+            image = cv2.resize(
+                image,
+                None,
+                fx=upscale,
+                fy=upscale,
+                interpolation=cv2.INTER_CUBIC,
+            )
+        yield os.path.basename(path), image
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def overlap(a, b):
+    width = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    height = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    return intersection / (a[2] * a[3] + b[2] * b[3] - intersection)
+
+
+SYNTHETIC_SIZES = {
+    "4k": (3840, 2160),
+    "8k": (7680, 4320),
+    "gigapixel": (40000, 25000),
+}
+# too large for the in-memory operations, so this input only goes through the tiled engine
+OUT_OF_CORE = ("gigapixel",)
+# slowdowns smaller than this are timer and scheduler noise, not regressions
+MIN_DIFFERENCE = 0.005
+TILED_OPERATIONS = {
+    "grayscale": [("grayscale", {})],
+    "blur": [("blur", {"kernel_size": 15})],
+    "canny": [("canny", {"threshold1": 100, "threshold2": 200})],
+    "brightness_contrast": [
+        ("brightness_contrast", {"brightness": 20, "contrast": 30}),
+    ],
+}
+
+
+def synthetic_image(width, height):
+    # scaled from a real photo rather than noise, so compression and detection see realistic content
+    image = next(bundled_images())[1]
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def synthetic_file(path, width, height, rows=1024):
+    image = next(bundled_images())[1]
+    target = np.lib.format.open_memmap(
+        path,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(height, width, 3),
+    )
+    for y in range(0, height, rows):
+        strip = cv2.resize(image, (width, min(rows, height - y)))
+        y_end = y + strip.shape[0]
+        target[y:y_end] = strip
+    target.flush()
+
+
+# the window the editor opens with, only the tiles inside it are converted and uploaded
+DISPLAY_SIZE = (1280, 800)
+_display = {}
+
+
+def display_viewer():
+    if "viewer" not in _display:
+        from viewer import ImageViewer
+
+        _display["viewer"] = ImageViewer()
+        _display["viewer"].resize(*DISPLAY_SIZE)
+    return _display["viewer"]
+
+
+def display(processor):
+    # the path MainWindow.displayImage takes for a new image: composite, then paint the visible tiles
+    viewer = display_viewer()
+    viewer.showComposited(Compositor(), processor.image, processor.annotations)
+    return viewer.grab()
+
+
+def prepare_display_stroke(processor):
+    viewer = display_viewer()
+    _display["compositor"] = Compositor()
+    processor.draw_text("benchmark", 50, 100, 3, (0, 0, 255))
+    viewer.showComposited(
+        _display["compositor"],
+        processor.image,
+        processor.annotations,
+    )
+    viewer.grab()
+
+
+def display_stroke(processor):
+    # one more stroke over an image already on screen, only the tiles under it are rebuilt
+    processor.draw_circle(200, 200, 100, (0, 255, 0))
+    viewer = display_viewer()
+    viewer.showComposited(
+        _display["compositor"],
+        processor.image,
+        processor.annotations,
+    )
+    return viewer.grab()
+
+
+# four resamplings one after another, or a single warpAffine once they are combined
+TRANSFORM_CHAIN = [
+    ("rotate", {"angle": 15}),
+    ("rotate", {"angle": 15}),
+    ("resize", {"width": 1920, "height": 1080}),
+    ("rotate", {"angle": -30}),
+]
+
+
+def transform_chain(processor):
+    return operations.run_pipeline(processor.image, TRANSFORM_CHAIN)
+
+
+def prepare_undo(processor):
+    processor.apply_blur(5)
+
+
+def prepare_redo(processor):
+    processor.apply_blur(5)
+    processor.undo()
+
+
+SUITE = {
+    "grayscale": (None, lambda processor: processor.apply_grayscale()),
+    "blur": (None, lambda processor: processor.apply_blur(15)),
+    "canny": (None, lambda processor: processor.apply_canny(100, 200)),
+    "rotate": (None, lambda processor: processor.rotate_image(30)),
+    "resize": (
+        None,
+        lambda processor: processor.resize_image(
+            processor.image.shape[1] // 2,
+            processor.image.shape[0] // 2,
+        ),
+    ),
+    "transform_chain": (None, transform_chain),
+    "brightness_contrast": (
+        None,
+        lambda processor: processor.change_brightness_contrast(20, 30),
+    ),
+    "text": (
+        None,
+        lambda processor: processor.draw_text("benchmark", 50, 100, 3, (0, 0, 255)),
+    ),
+    "rectangle": (
+        None,
+        lambda processor: processor.draw_rectangle(20, 20, 300, 200, (0, 255, 0)),
+    ),
+    "line": (
+        None,
+        lambda processor: processor.draw_line(0, 0, 500, 400, (255, 0, 0)),
+    ),
+    "circle": (
+        None,
+        lambda processor: processor.draw_circle(200, 200, 100, (0, 0, 255)),
+    ),
+    "detect_face": (None, lambda processor: processor.detect_face()),
+    "detect_face_fast": (None, lambda processor: processor.detect_face(fast=True)),
+    "undo": (prepare_undo, lambda processor: processor.undo()),
+    "redo": (prepare_redo, lambda processor: processor.redo()),
+    "display": (None, display),
+    "display_stroke": (prepare_display_stroke, display_stroke),
+}
+
+
+def measure(function, setup, repeat, teardown=None):
+    seconds = []
+    for _ in range(repeat):
+        state = setup()
+        seconds.append(timed(function, state)[1])
+        if teardown is not None:
+            teardown(state)
+    # one more run under tracemalloc, which slows Python code down and would skew the timings above
+    state = setup()
+    tracemalloc.start()
+    try:
+        function(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        if teardown is not None:
+            teardown(state)
+    return min(seconds), statistics.median(seconds), peak
+
+
+def suite_inputs(names):
+    for name in names:
+        if name == "bundled":
+            yield from bundled_images()
+        elif name in SYNTHETIC_SIZES and name not in OUT_OF_CORE:
+            yield name, synthetic_image(*SYNTHETIC_SIZES[name])
+        elif name not in OUT_OF_CORE:
+            raise ValueError(f"Unknown input: {name}")
+
+
+def compare(results, baseline, threshold, min_difference=MIN_DIFFERENCE):
+    # medians are compared, a single lucky or unlucky run moves them less than the minimum; sub-millisecond
+    # operations jitter by more than any ratio, so a slowdown must also exceed min_difference seconds
+    previous = {(row["input"], row["operation"]): row for row in baseline["results"]}
+    regressions = []
+    for row in results:
+        old = previous.get((row["input"], row["operation"]))
+        if old is None:
+            continue
+        # reports written before medians were recorded only have the fastest run
+        old_seconds = old.get("median_seconds", old["seconds"])
+        if not old_seconds:
+            continue
+        row["baseline_seconds"] = old_seconds
+        row["ratio"] = row["median_seconds"] / old_seconds
+        if (
+            row["ratio"] > 1 + threshold
+            and row["median_seconds"] - old_seconds > min_difference
+        ):
+            regressions.append(row)
+    return regressions
+
+
+def close_processor(processor):
+    # every processor starts a save thread of its own, a suite would otherwise leave hundreds of them behind
+    processor.saver.close()
+    processor.history.close()
+
+
+def bench_suite(args):
+    from main import ImageProcessor
+    from PyQt6.QtWidgets import QApplication
+
+    app = QApplication.instance() or QApplication(["benchmark"])
+    names = args.inputs.split(",")
+    operations = args.operations.split(",") if args.operations else list(SUITE)
+    unknown = set(operations) - set(SUITE)
+    if unknown:
+        raise ValueError(f"Unknown operations: {', '.join(sorted(unknown))}")
+
+    results = []
+
+    def record(input_name, size, operation, seconds, median, peak):
+        megapixels = size[0] * size[1] / 1e6
+        row = {
+            "input": input_name,
+            "size": list(size),
+            "operation": operation,
+            "seconds": seconds,
+            "median_seconds": median,
+            "peak_bytes": peak,
+            "megapixels_per_second": megapixels / seconds if seconds else 0.0,
+        }
+        results.append(row)
+        print(
+            f"{input_name:16} {size[0]}x{size[1]:<6} {operation:20} "
+            f"{seconds * 1000:10.1f} мс  {peak / 1e6:9.1f} МБ  {row['megapixels_per_second']:8.1f} Мп/с",
+            flush=True,
+        )
+
+    for input_name, image in suite_inputs(names):
+        size = (image.shape[1], image.shape[0])
+        for operation in operations:
+            setup, function = SUITE[operation]
+
+            def prepare():
+                processor = ImageProcessor()
+                processor.set_image(image)
+                if setup is not None:
+                    setup(processor)
+                return processor
+
+            record(
+                input_name,
+                size,
+                operation,
+                *measure(function, prepare, args.repeat, close_processor),
+            )
+
+    for input_name in (name for name in names if name in OUT_OF_CORE):
+        width, height = SYNTHETIC_SIZES[input_name]
+        with tempfile.TemporaryDirectory(dir=args.scratch) as directory:
+            source = os.path.join(directory, "source.npy")
+            target = os.path.join(directory, "target.npy")
+            synthetic_file(source, width, height)
+            for operation, steps in TILED_OPERATIONS.items():
+                if operation not in operations:
+                    continue
+                record(
+                    input_name,
+                    (width, height),
+                    f"tiled_{operation}",
+                    *measure(
+                        lambda steps: tiles.process_file(source, target, steps),
+                        lambda: steps,
+                        1,
+                    ),
+                )
+    app.processEvents()
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(
+            results,
+            baseline,
+            args.threshold,
+            args.min_difference_ms / 1000,
+        )
+        report["regressions"] = [
+            {
+                key: row[key]
+                for key in (
+                    "input",
+                    "operation",
+                    "median_seconds",
+                    "baseline_seconds",
+                    "ratio",
+                )
+            }
+            for row in regressions
+        ]
+        for row in regressions:
+            print(
+                f"Замедление: {row['input']} {row['operation']} — "
+                f"{row['baseline_seconds'] * 1000:.1f} → {row['median_seconds'] * 1000:.1f} мс ({row['ratio']:.2f}x)",
+                file=sys.stderr,
+            )
+        if not regressions:
+            print(
+                f"Замедлений больше чем на {args.threshold:.0%} относительно {args.baseline} нет",
+            )
+    return report
+
+
+def bench_faces(args):
+    results = []
+    for name, image in bundled_images(args.upscale):
+        exhaustive, exhaustive_seconds = timed(faces.detect_faces, image)
+        fast, fast_seconds = timed(
+            faces.detect_faces,
+            image,
+            fast=True,
+            min_face_size=args.min_face_size,
+        )
+        # the fast mode only promises faces of at least min_face_size, smaller ones are not counted against it
+        expected = [
+            box for box in exhaustive if max(box[2], box[3]) >= args.min_face_size
+        ]
+        matched = sum(
+            1 for box in expected if any(overlap(box, other) >= 0.3 for other in fast)
+        )
+        results.append(
+            {
+                "image": name,
+                "size": [image.shape[1], image.shape[0]],
+                "exhaustive_seconds": exhaustive_seconds,
+                "fast_seconds": fast_seconds,
+                "exhaustive_faces": len(exhaustive),
+                "expected_faces": len(expected),
+                "fast_faces": len(fast),
+                "matched_faces": matched,
+            },
+        )
+        print(
+            f"{name:16} {image.shape[1]}x{image.shape[0]}  "
+            f"полный: {exhaustive_seconds:.3f} с ({len(exhaustive)})  "
+            f"быстрый: {fast_seconds:.3f} с ({len(fast)}, совпало {matched} из {len(expected)})",
+        )
+
+    exhaustive_total = sum(result["exhaustive_seconds"] for result in results)
+    fast_total = sum(result["fast_seconds"] for result in results)
+    expected = sum(result["expected_faces"] for result in results)
+    matched = sum(result["matched_faces"] for result in results)
+    summary = {
+        "speedup": exhaustive_total / fast_total if fast_total else 0.0,
+        "recall": matched / expected if expected else 1.0,
+    }
+    print(
+        f"Ускорение: {summary['speedup']:.2f}x, полнота относительно полного режима: {summary['recall']:.2%}",
+    )
+    return {"results": results, "summary": summary}
+
+
+def bench_display(args):
+    from PyQt6.QtGui import (
+        QImage,
+        QPixmap,
+    )
+    from PyQt6.QtWidgets import QApplication
+    from viewer import to_qimage
+
+    app = QApplication.instance() or QApplication(["benchmark"])
+
+    def legacy(image):
+        qformat = QImage.Format.Format_Indexed8
+        if len(image.shape) == 3:
+            qformat = (
+                QImage.Format.Format_RGBA8888
+                if image.shape[2] == 4
+                else QImage.Format.Format_RGB888
+            )
+        qimage = QImage(
+            image,
+            image.shape[1],
+            image.shape[0],
+            image.strides[0],
+            qformat,
+        )
+        return QPixmap.fromImage(qimage.rgbSwapped())
+
+    def current(image):
+        return QPixmap.fromImage(to_qimage(image))
+
+    width, height = args.width, args.height
+    rng = np.random.default_rng(0)
+    inputs = {
+        "gray": rng.integers(0, 256, (height, width), dtype=np.uint8),
+        "bgr": rng.integers(0, 256, (height, width, 3), dtype=np.uint8),
+        "bgra": rng.integers(0, 256, (height, width, 4), dtype=np.uint8),
+    }
+    results = []
+    for name, image in inputs.items():
+        row = {"input": name, "size": [width, height]}
+        for label, function in (("legacy", legacy), ("current", current)):
+            seconds = min(timed(function, image)[1] for _ in range(args.repeat))
+            row[f"{label}_seconds"] = seconds
+        results.append(row)
+        print(
+            f"{name:5} {width}x{height}  было: {row['legacy_seconds'] * 1000:.1f} мс  "
+            f"стало: {row['current_seconds'] * 1000:.1f} мс",
+        )
+    app.processEvents()
+    return {"results": results}
+
+
+def bench_save(args):
+    image = next(bundled_images(args.upscale))[1]
+    settings = (
+        [("png", {"png_compression": level}) for level in (0, 1, 3, 6, 9)]
+        + [
+            ("jpg", {"jpeg_quality": quality, "jpeg_progressive": progressive})
+            for quality in (75, 90, 95)
+            for progressive in (False, True)
+        ]
+        + [("webp", {"webp_quality": quality}) for quality in (75, 90, 101)]
+    )
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for extension, options in settings:
+            path = os.path.join(directory, f"image.{extension}")
+            result = min(
+                (saving.write_image(path, image, options) for _ in range(args.repeat)),
+                key=lambda result: result["encode_seconds"],
+            )
+            results.append(
+                {
+                    "format": extension,
+                    "options": options,
+                    "bytes": result["bytes"],
+                    "encode_seconds": result["encode_seconds"],
+                },
+            )
+            print(
+                f"{extension:4} {json.dumps(options):50} {result['bytes'] / 1024:9.0f} КБ  "
+                f"{result['encode_seconds'] * 1000:8.1f} мс",
+            )
+    return {"size": [image.shape[1], image.shape[0]], "results": results}
+
+
+def bench_blur(args):
+    image = synthetic_image(args.width, args.height)
+    # fine texture on top of the photo, flat areas would hide most of the error
+    noise = np.random.default_rng(0).integers(0, 256, image.shape, dtype=np.uint8)
+    image = cv2.addWeighted(image, 0.7, cv2.GaussianBlur(noise, (0, 0), 2), 0.3, 0)
+    megapixels = image.shape[0] * image.shape[1] / 1e6
+
+    results = []
+    failures = []
+    for kernel_size in (int(size) for size in args.kernels.split(",")):
+        sigma = operations.gaussian_sigma(kernel_size | 1)
+        strategy = operations.blur_strategy(kernel_size | 1)
+        seconds = min(
+            timed(operations.blur, image, kernel_size)[1] for _ in range(args.repeat)
+        )
+        result = operations.blur(image, kernel_size)
+        reference, reference_seconds = timed(
+            cv2.GaussianBlur,
+            image,
+            (kernel_size | 1, kernel_size | 1),
+            0,
+        )
+        error = np.abs(result.astype(np.int16) - reference)
+        psnr = cv2.PSNR(result, reference)
+        results.append(
+            {
+                "kernel_size": kernel_size,
+                "sigma": sigma,
+                "strategy": strategy,
+                "seconds": seconds,
+                "reference_seconds": reference_seconds,
+                "mean_error": float(error.mean()),
+                "max_error": int(error.max()),
+                "psnr": psnr,
+            },
+        )
+        if psnr < args.min_psnr:
+            failures.append(kernel_size)
+        print(
+            f"ядро {kernel_size:5} (sigma {sigma:6.1f}) {strategy:8} {seconds * 1000:8.1f} мс "
+            f"({seconds * 1000 / megapixels:5.2f} мс/Мп)  эталон {reference_seconds * 1000:9.1f} мс  "
+            f"ошибка: средняя {error.mean():.2f}, макс. {error.max()}, PSNR {psnr:.1f} дБ"
+            + ("  НИЖЕ ПОРОГА" if psnr < args.min_psnr else ""),
+        )
+    return {
+        "size": [image.shape[1], image.shape[0]],
+        "results": results,
+        "regressions": failures,
+    }
+
+
+PARALLEL_OPERATIONS = {
+    "canny": [("canny", {"threshold1": 100, "threshold2": 200})],
+    "blur": [("blur", {"kernel_size": 15})],
+    "blur_large": [("blur", {"kernel_size": 301})],
+    "grayscale_blur": [("grayscale", {}), ("blur", {"kernel_size": 9})],
+    "brightness_contrast": [
+        ("brightness_contrast", {"brightness": 20, "contrast": 30}),
+    ],
+}
+
+
+def bench_parallel(args):
+    image = synthetic_image(args.width, args.height)
+    megapixels = image.shape[0] * image.shape[1] / 1e6
+    counts = sorted(
+        (
+            {int(count) for count in args.workers.split(",")}
+            if args.workers
+            else {2**power for power in range(os.cpu_count().bit_length())}
+            | {os.cpu_count()}
+        ),
+    )
+    names = args.operations.split(",") if args.operations else list(PARALLEL_OPERATIONS)
+
+    results = []
+    for name in names:
+        steps = PARALLEL_OPERATIONS[name]
+        reference = operations.run_pipeline(image, steps)
+        single = {}
+        for count in counts:
+            # OpenCV threading the whole image on its own, against strips on a pool of the same size
+            for mode, function in (
+                (
+                    "opencv",
+                    lambda: parallel.run_pipeline(
+                        image,
+                        steps,
+                        workers=1,
+                        threads=count,
+                    ),
+                ),
+                ("strips", lambda: parallel.run_pipeline(image, steps, workers=count)),
+            ):
+                seconds = min(timed(function)[1] for _ in range(args.repeat))
+                single.setdefault(mode, seconds)
+                exact = np.array_equal(function(), reference)
+                speedup = single[mode] / seconds
+                results.append(
+                    {
+                        "operation": name,
+                        "mode": mode,
+                        "workers": count,
+                        "seconds": seconds,
+                        "speedup": speedup,
+                        "efficiency": speedup / count,
+                        "exact": exact,
+                    },
+                )
+                print(
+                    f"{name:20} {mode:7} {count:3} потоков {seconds * 1000:9.1f} мс  "
+                    f"{megapixels / seconds:7.1f} Мп/с  ускорение {speedup:5.2f}x  "
+                    f"эффективность {speedup / count:4.0%}"
+                    + ("" if exact else "  РЕЗУЛЬТАТ ОТЛИЧАЕТСЯ"),
+                )
+    return {
+        "size": [image.shape[1], image.shape[0]],
+        "cpu_count": os.cpu_count(),
+        "results": results,
+        "regressions": [
+            f"{result['operation']}/{result['mode']}/{result['workers']}"
+            for result in results
+            if not result["exact"]
+        ],
+    }
+
+
+SERVICE_OPERATIONS = {
+    "grayscale_brightness": [
+        ("grayscale", {}),
+        ("brightness_contrast", {"brightness": 20, "contrast": 30}),
+    ],
+    "blur": [("blur", {"kernel_size": 5})],
+    "canny": [("canny", {"threshold1": 100, "threshold2": 200})],
+}
+
+
+def bench_service(args):
+    image = synthetic_image(args.width, args.height)
+    names = args.operations.split(",") if args.operations else list(SERVICE_OPERATIONS)
+    socket_path = None
+    if args.transport == "unix":
+        socket_path = os.path.join(tempfile.mkdtemp(), "service.sock")
+
+    results = []
+    for name in names:
+        steps = SERVICE_OPERATIONS[name]
+        reference = operations.run_pipeline(image, steps)
+        # the same load once with every request on its own and once with micro-batching
+        for max_batch in (1, args.max_batch):
+            service = server.Service(args.workers, max_batch, args.max_delay_ms / 1000)
+            http = server.create_server(service, port=0, socket_path=socket_path)
+            thread = threading.Thread(target=http.serve_forever, daemon=True)
+            thread.start()
+            client = server.Client(
+                port=http.server_address[1] if socket_path is None else None,
+                socket_path=socket_path,
+            )
+            latencies, mismatches = [], []
+
+            def run_client():
+                for _ in range(args.requests):
+                    start = time.perf_counter()
+                    result = client.process(image, steps)
+                    latencies.append(time.perf_counter() - start)
+                    if not np.array_equal(result, reference):
+                        mismatches.append(name)
+                client.close()
+
+            clients = [threading.Thread(target=run_client) for _ in range(args.clients)]
+            start = time.perf_counter()
+            for client_thread in clients:
+                client_thread.start()
+            for client_thread in clients:
+                client_thread.join()
+            seconds = time.perf_counter() - start
+            report = service.report()["operations"]
+            http.shutdown()
+            http.server_close()
+            service.close()
+
+            served = next(iter(report.values()))
+            client_latency = server.percentiles(latencies)
+            results.append(
+                {
+                    "operation": name,
+                    "max_batch": max_batch,
+                    "requests": len(latencies),
+                    "seconds": seconds,
+                    "throughput": len(latencies) / seconds,
+                    "latency_ms": client_latency,
+                    "server": served,
+                    "exact": not mismatches,
+                },
+            )
+            print(
+                f"{name:22} пакет до {max_batch:3}  {len(latencies) / seconds:8.1f} запр/с  "
+                f"задержка p50 {client_latency['p50']:7.2f} p90 {client_latency['p90']:7.2f} "
+                f"p99 {client_latency['p99']:7.2f} мс  "
+                f"в очереди p99 {served['queue_ms']['p99']:7.2f} мс  средний пакет {served['mean_batch']:5.2f}"
+                + ("" if not mismatches else "  РЕЗУЛЬТАТ ОТЛИЧАЕТСЯ"),
+            )
+    if socket_path is not None:
+        os.rmdir(os.path.dirname(socket_path))
+    return {
+        "size": [image.shape[1], image.shape[0]],
+        "clients": args.clients,
+        "transport": args.transport,
+        "results": results,
+        "regressions": [
+            f"{result['operation']}/{result['max_batch']}"
+            for result in results
+            if not result["exact"]
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры производительности операций")
+    parser.add_argument("--json", default=None, help="Сохранить результаты в JSON-файл")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    faces_parser = subparsers.add_parser(
+        "faces",
+        help="Сравнить быстрый и полный режимы распознавания лиц",
+    )
+    faces_parser.add_argument(
+        "--upscale",
+        type=float,
+        default=4,
+        help="Во сколько раз увеличить изображения из images/, чтобы получить снимки высокого разрешения",
+    )
+    faces_parser.add_argument(
+        "--min-face-size",
+        type=int,
+        default=128,
+        help="Минимальный размер лица в пикселях для быстрого режима",
+    )
+    faces_parser.set_defaults(run=bench_faces)
+
+    display_parser = subparsers.add_parser(
+        "display",
+        help="Сравнить прежнее и текущее преобразование массива в QPixmap",
+    )
+    display_parser.add_argument("--width", type=int, default=7680)
+    display_parser.add_argument("--height", type=int, default=4320)
+    display_parser.add_argument("--repeat", type=int, default=5)
+    display_parser.set_defaults(run=bench_display)
+
+    save_parser = subparsers.add_parser(
+        "save",
+        help="Сравнить время кодирования и размер файла при разных параметрах сохранения",
+    )
+    save_parser.add_argument("--upscale", type=float, default=4)
+    save_parser.add_argument("--repeat", type=int, default=3)
+    save_parser.set_defaults(run=bench_save)
+
+    blur_parser = subparsers.add_parser(
+        "blur",
+        help="Замерить размытие при разных размерах ядра и сравнить с точным cv2.GaussianBlur",
+    )
+    blur_parser.add_argument("--width", type=int, default=4000)
+    blur_parser.add_argument("--height", type=int, default=3000)
+    blur_parser.add_argument(
+        "--kernels",
+        default="5,15,31,61,151,301,601",
+        help="Размеры ядра через запятую",
+    )
+    blur_parser.add_argument("--repeat", type=int, default=3)
+    blur_parser.add_argument(
+        "--min-psnr",
+        type=float,
+        default=operations.BLUR_MIN_PSNR,
+        help="Наименьшее допустимое отношение сигнал/шум относительно эталона, дБ",
+    )
+    blur_parser.set_defaults(run=bench_blur)
+
+    parallel_parser = subparsers.add_parser(
+        "parallel",
+        help="Построить кривые масштабирования по числу потоков: потоки OpenCV и обработка полосами",
+    )
+    parallel_parser.add_argument("--width", type=int, default=7680)
+    parallel_parser.add_argument("--height", type=int, default=4320)
+    parallel_parser.add_argument(
+        "--workers",
+        default=None,
+        help="Числа потоков через запятую (по умолчанию степени двойки до числа ядер)",
+    )
+    parallel_parser.add_argument(
+        "--operations",
+        default=None,
+        help=f"Операции через запятую (по умолчанию все: {', '.join(PARALLEL_OPERATIONS)})",
+    )
+    parallel_parser.add_argument("--repeat", type=int, default=3)
+    parallel_parser.set_defaults(run=bench_parallel)
+
+    service_parser = subparsers.add_parser(
+        "service",
+        help="Нагрузить локальный сервис (server.py) параллельными клиентами, с пакетами и без",
+    )
+    service_parser.add_argument("--width", type=int, default=320)
+    service_parser.add_argument("--height", type=int, default=240)
+    service_parser.add_argument("--clients", type=int, default=16)
+    service_parser.add_argument(
+        "--requests",
+        type=int,
+        default=100,
+        help="Запросов на клиента",
+    )
+    service_parser.add_argument("--workers", type=int, default=None)
+    service_parser.add_argument("--max-batch", type=int, default=server.MAX_BATCH)
+    service_parser.add_argument(
+        "--max-delay-ms",
+        type=float,
+        default=server.MAX_DELAY * 1000,
+    )
+    service_parser.add_argument("--transport", choices=("tcp", "unix"), default="tcp")
+    service_parser.add_argument(
+        "--operations",
+        default=None,
+        help=f"Операции через запятую (по умолчанию все: {', '.join(SERVICE_OPERATIONS)})",
+    )
+    service_parser.set_defaults(run=bench_service)
+
+    suite_parser = subparsers.add_parser(
+        "suite",
+        help="Замерить все операции ImageProcessor и сравнить с сохранённым эталоном",
+    )
+    suite_parser.add_argument(
+        "--inputs",
+        default="bundled,4k,8k",
+        help="Входные данные через запятую: bundled, 4k, 8k, gigapixel (только по тайлам)",
+    )
+    suite_parser.add_argument(
+        "--operations",
+        default=None,
+        help=f"Операции через запятую (по умолчанию все: {', '.join(SUITE)})",
+    )
+    suite_parser.add_argument("--repeat", type=int, default=7)
+    suite_parser.add_argument(
+        "--baseline",
+        default=None,
+        help="JSON-отчёт прошлого запуска (--json), с которым сравнивается время",
+    )
+    suite_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Допустимое замедление относительно эталона, по умолчанию 0.2 (20%%)",
+    )
+    suite_parser.add_argument(
+        "--min-difference-ms",
+        type=float,
+        default=MIN_DIFFERENCE * 1000,
+        help="Меньшее замедление в миллисекундах не считается, сколько бы процентов оно ни составляло",
+    )
+    suite_parser.add_argument(
+        "--scratch",
+        default=None,
+        help="Каталог для временных файлов гигапиксельного изображения",
+    )
+    suite_parser.set_defaults(run=bench_suite)
+
+    args = parser.parse_args(argv)
+    report = args.run(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=4)
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
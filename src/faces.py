@@ -0,0 +1,264 @@
+import os
+import threading
+from concurrent.futures import (
+    CancelledError,
+    ThreadPoolExecutor,
+)
+
+import cv2
+import numpy as np
+from operations import to_gray
+from tracing import traced
+
+
+CASCADE_PATH = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+ANGLES = (0, 15, -15, 30, -30, 45, -45)
+# smallest face side, in pixels, that the cascade still finds reliably on the downscaled copy
+FAST_DETECTION_SIZE = 40
+
+_local = threading.local()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_classifier():
+    # loaded once per thread rather than once per call, and never shared between the detection threads
+    classifier = getattr(_local, "classifier", None)
+    if classifier is None:
+        classifier = cv2.CascadeClassifier(CASCADE_PATH)
+        _local.classifier = classifier
+    return classifier
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=min(len(ANGLES), os.cpu_count() or 1),
+                thread_name_prefix="faces",
+            )
+        return _executor
+
+
+@traced("faces")
+def detect_at_angle(
+    gray,
+    angle,
+    scale_factor=1.3,
+    min_neighbors=5,
+    min_size=None,
+    max_size=None,
+):
+    sizes = {}
+    if min_size is not None:
+        sizes["minSize"] = (min_size, min_size)
+    if max_size is not None:
+        sizes["maxSize"] = (max_size, max_size)
+
+    if angle == 0:
+        boxes = get_classifier().detectMultiScale(
+            gray,
+            scaleFactor=scale_factor,
+            minNeighbors=min_neighbors,
+            **sizes,
+        )
+        return [tuple(int(value) for value in box) for box in boxes]
+
+    (h, w) = gray.shape[:2]
+    center = (w // 2, h // 2)
+    M = cv2.getRotationMatrix2D(center, angle, 1.0)
+    rotated_gray = cv2.warpAffine(gray, M, (w, h))
+    boxes = get_classifier().detectMultiScale(
+        rotated_gray,
+        scaleFactor=scale_factor,
+        minNeighbors=min_neighbors,
+        **sizes,
+    )
+    if len(boxes) == 0:
+        return []
+
+    # map the corners of every box back into the unrotated image and keep their axis-aligned bounds
+    inverse = cv2.invertAffineTransform(M)
+    corners = np.stack(
+        [
+            boxes[:, :2],
+            boxes[:, :2] + boxes[:, 2:] * [1, 0],
+            boxes[:, :2] + boxes[:, 2:] * [0, 1],
+            boxes[:, :2] + boxes[:, 2:],
+        ],
+        axis=1,
+    ).astype(np.float64)
+    mapped = corners @ inverse[:, :2].T + inverse[:, 2]
+    top_left = np.clip(mapped.min(axis=1), 0, [w, h])
+    bottom_right = np.clip(mapped.max(axis=1), 0, [w, h])
+    return [
+        (int(x0), int(y0), int(x1 - x0), int(y1 - y0))
+        for (x0, y0), (x1, y1) in zip(top_left, bottom_right)
+        if x1 > x0 and y1 > y0
+    ]
+
+
+def non_max_suppression(boxes, scores, threshold=0.3):
+    if not boxes:
+        return []
+    boxes_array = np.array(boxes, dtype=np.float64)
+    x0, y0 = boxes_array[:, 0], boxes_array[:, 1]
+    x1, y1 = x0 + boxes_array[:, 2], y0 + boxes_array[:, 3]
+    areas = boxes_array[:, 2] * boxes_array[:, 3]
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind="stable")
+
+    keep = []
+    while len(order) > 0:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        width = np.clip(
+            np.minimum(x1[best], x1[rest]) - np.maximum(x0[best], x0[rest]),
+            0,
+            None,
+        )
+        height = np.clip(
+            np.minimum(y1[best], y1[rest]) - np.maximum(y0[best], y0[rest]),
+            0,
+            None,
+        )
+        overlap = width * height / (areas[best] + areas[rest] - width * height)
+        order = rest[overlap <= threshold]
+    return [boxes[index] for index in keep]
+
+
+@traced("faces")
+def detect_faces(
+    image,
+    angles=ANGLES,
+    scale_factor=1.3,
+    min_neighbors=5,
+    fast=False,
+    min_face_size=128,
+    progress=None,
+    cancelled=None,
+):
+    gray = to_gray(image)
+    scale = FAST_DETECTION_SIZE / min_face_size
+    if fast and scale < 1:
+        return detect_faces_fast(
+            gray,
+            angles,
+            scale,
+            scale_factor,
+            min_neighbors,
+            progress=progress,
+            cancelled=cancelled,
+        )
+
+    executor = get_executor()
+    futures = [
+        (
+            angle,
+            executor.submit(detect_at_angle, gray, angle, scale_factor, min_neighbors),
+        )
+        for angle in angles
+    ]
+    candidates = [
+        (box, angle)
+        for angle, boxes in collect(futures, progress, cancelled)
+        for box in boxes
+    ]
+    return merge_candidates(candidates)
+
+
+def detect_faces_fast(
+    gray,
+    angles,
+    scale,
+    scale_factor=1.3,
+    min_neighbors=5,
+    margin=0.5,
+    progress=None,
+    cancelled=None,
+):
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # the downscaled copy is cheap enough to scan with a finer step, which keeps faces near the lower bound
+    small_scale_factor = min(scale_factor, 1.1)
+    executor = get_executor()
+    futures = [
+        (
+            angle,
+            executor.submit(
+                detect_at_angle,
+                small,
+                angle,
+                small_scale_factor,
+                min_neighbors,
+                FAST_DETECTION_SIZE,
+            ),
+        )
+        for angle in angles
+    ]
+    first_half = (lambda fraction: progress(fraction / 2)) if progress else None
+    candidates = [
+        (tuple(int(round(value / scale)) for value in box), angle)
+        for angle, boxes in collect(futures, first_half, cancelled)
+        for box in boxes
+    ]
+
+    futures = [
+        (
+            (box, angle),
+            executor.submit(refine_candidate, gray, box, angle, min_neighbors, margin),
+        )
+        for box, angle in candidates
+    ]
+    second_half = (lambda fraction: progress(0.5 + fraction / 2)) if progress else None
+    refined = []
+    for (box, angle), found in collect(futures, second_half, cancelled):
+        # a candidate the full-resolution pass cannot confirm is kept as found, so the fast mode loses no recall
+        refined.extend((box, angle) for box in found or [box])
+    return merge_candidates(refined)
+
+
+def collect(futures, progress=None, cancelled=None):
+    results = []
+    for index, (key, future) in enumerate(futures):
+        if cancelled is not None and cancelled():
+            for _, pending in futures:
+                pending.cancel()
+            raise CancelledError()
+        results.append((key, future.result()))
+        if progress is not None:
+            progress((index + 1) / len(futures))
+    return results
+
+
+@traced("faces")
+def refine_candidate(gray, box, angle, min_neighbors=5, margin=0.5):
+    (h, w) = gray.shape[:2]
+    x, y, box_w, box_h = box
+    side = max(box_w, box_h)
+    pad = int(side * margin)
+    x0, y0 = max(x - pad, 0), max(y - pad, 0)
+    x1, y1 = min(x + box_w + pad, w), min(y + box_h + pad, h)
+    found = detect_at_angle(
+        gray[y0:y1, x0:x1],
+        angle,
+        scale_factor=1.1,
+        min_neighbors=min_neighbors,
+        min_size=int(side * 0.6),
+        max_size=int(side * 1.6),
+    )
+    return [(fx + x0, fy + y0, fw, fh) for fx, fy, fw, fh in found]
+
+
+def merge_candidates(candidates):
+    # upright detections are the most reliable, so they win when boxes from several angles overlap
+    return non_max_suppression(
+        [box for box, _ in candidates],
+        [-abs(angle) for _, angle in candidates],
+    )
+
+
+def draw_faces(image, faces, color=(0, 255, 0), thickness=2):
+    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+    for x, y, w, h in faces:
+        cv2.rectangle(image, (x, y), (x + w, y + h), color, thickness)
+    return image
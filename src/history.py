@@ -0,0 +1,417 @@
+import os
+import shutil
+import tempfile
+import weakref
+import zlib
+from collections import OrderedDict
+from contextlib import suppress
+
+import numpy as np
+from tracing import traced
+
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class HistoryEntry:
+    def __init__(self, keyframe, shape, dtype, tiles, payload, meta=None, nbytes=None):
+        self.keyframe = keyframe
+        self.shape = shape
+        self.dtype = dtype
+        # (y, x, h, w, offset, length) for every stored tile, keyframes store a single full-frame tile
+        self.tiles = tiles
+        self.payload = payload
+        self.nbytes = len(payload) if payload is not None else nbytes
+        self.path = None
+        # (mapping, offset) when the payload is a chunk of a larger file, e.g. a saved project, rather than a spill
+        # file; the mapping keeps that file readable even after another save has replaced it on disk
+        self.chunk = None
+        self.meta = meta
+
+    @property
+    def raw_nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+
+class History:
+    def __init__(
+        self,
+        tile_size=64,
+        compression="zlib",
+        keyframe_interval=8,
+        keyframe_ratio=0.5,
+        ram_budget=None,
+        scratch_dir=None,
+        state_cache=4,
+    ):
+        if compression not in (None, "zlib", "lz4"):
+            raise ValueError(f"Unknown compression: {compression}")
+        if compression == "lz4" and lz4 is None:
+            raise ValueError("lz4 compression requires the lz4 package")
+        self.tile_size = tile_size
+        self.compression = compression
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_ratio = keyframe_ratio
+        self.ram_budget = ram_budget
+        self.scratch_dir = scratch_dir
+        self.state_cache = state_cache
+        self.entries = []
+        self.index = -1
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        self._states = OrderedDict()
+        self._states_nbytes = 0
+        self._resident = OrderedDict()
+        self._ram_nbytes = 0
+        self._scratch = None
+        self._spill_count = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def nbytes(self):
+        return sum(entry.nbytes for entry in self.entries)
+
+    @property
+    def raw_nbytes(self):
+        return sum(entry.raw_nbytes for entry in self.entries)
+
+    @property
+    def meta(self):
+        return self.entries[self.index].meta if self.index >= 0 else None
+
+    @property
+    def ram_nbytes(self):
+        return self._ram_nbytes
+
+    @property
+    def disk_nbytes(self):
+        return self.nbytes - self._ram_nbytes
+
+    @property
+    def state_nbytes(self):
+        return self._states_nbytes
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "ram_bytes": self.ram_nbytes,
+            "state_bytes": self.state_nbytes,
+            "disk_bytes": self.disk_nbytes,
+            "ram_budget": self.ram_budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "spills": self.spills,
+        }
+
+    def clear(self):
+        self._drop(self.entries)
+        self.entries = []
+        self.index = -1
+        self._states.clear()
+        self._states_nbytes = 0
+
+    def set_budget(self, ram_budget):
+        self.ram_budget = ram_budget
+        self._enforce_budget()
+
+    def close(self):
+        # the directory goes away with the last spilled entry, a project still being saved may hold some of them
+        self.clear()
+        self._scratch = None
+
+    @traced("history")
+    def push(self, image, meta=None, encoded=None):
+        keep = self.index + 1
+        self._drop(self.entries[keep:])
+        del self.entries[keep:]
+        for index in [index for index in self._states if index >= keep]:
+            self._evict_state(index)
+        if encoded is not None and encoded[0] is self._top():
+            entry = encoded[1]
+        else:
+            # nothing was encoded in advance, or for a history that has moved since
+            entry = self.encode(self.prepare(), image)[1]
+        entry.meta = meta
+        self.entries.append(entry)
+        self._resident[entry] = None
+        self._ram_nbytes += entry.nbytes
+        self._enforce_budget()
+        self.index += 1
+        self._cache_state(self.index, image)
+
+    def prepare(self):
+        # taken on the GUI thread, everything encode needs, so the entry for a result can be built in a worker
+        previous = self._materialize(self.index) if self.index >= 0 else None
+        keep = self.index + 1
+        return (
+            self._top(),
+            previous,
+            keep - self._last_keyframe(keep) >= self.keyframe_interval,
+        )
+
+    def encode(self, prepared, image):
+        # no bookkeeping here, the entry is only added to the history by push
+        top, previous, keyframe = prepared
+        return top, self._encode(previous, image, keyframe)
+
+    def restore(self, entries, index, state=None):
+        # entries read from a project keep their payloads in the file until a state needs them
+        self.clear()
+        self.entries = list(entries)
+        self.index = index
+        if state is not None:
+            self._cache_state(index, state)
+
+    def relocate(self, mapping, offsets):
+        # every saved entry is read from the project file from now on, copies kept in RAM are released; a spill
+        # file goes with its entry, a save still running may be reading it
+        for entry in self.entries:
+            if entry not in offsets:
+                continue
+            entry.chunk = (mapping, offsets[entry])
+            if entry.payload is not None:
+                del self._resident[entry]
+                self._ram_nbytes -= entry.nbytes
+                entry.payload = None
+
+    def is_state(self, index, image):
+        return self._states.get(index) is image
+
+    def encode_state(self, image):
+        return self._encode_keyframe(image)
+
+    def decode_state(self, entry):
+        # a standalone keyframe that is not part of the history
+        return self._decode_tile(entry, self.read_payload(entry), entry.tiles[0]).copy()
+
+    def read_payload(self, entry):
+        # no bookkeeping here, so a project can be written from another thread
+        payload = entry.payload
+        if payload is not None:
+            return payload
+        if not entry.nbytes:
+            return b""
+        if entry.chunk is not None:
+            mapping, offset = entry.chunk
+            end = offset + entry.nbytes
+            return mapping[offset:end]
+        return np.load(entry.path, mmap_mode="r")
+
+    def undo(self):
+        if self.index > 0:
+            self.index -= 1
+            return self.get(self.index)
+        return None
+
+    def redo(self):
+        if self.index < len(self.entries) - 1:
+            self.index += 1
+            return self.get(self.index)
+        return None
+
+    def get(self, index):
+        return self._materialize(index)
+
+    def _cache_state(self, index, image):
+        # states are shared with the caller, so they must never be written to again
+        image.flags.writeable = False
+        if index in self._states:
+            self._evict_state(index)
+        self._states[index] = image
+        self._states_nbytes += image.nbytes
+        while len(self._states) > max(self.state_cache, 1):
+            self._evict_state(next(iter(self._states)))
+        self._enforce_budget()
+
+    def _evict_state(self, index):
+        self._states_nbytes -= self._states.pop(index).nbytes
+
+    @traced("history")
+    def _materialize(self, index):
+        if index in self._states:
+            self._states.move_to_end(index)
+            return self._states[index]
+        start = index
+        while not self.entries[start].keyframe:
+            start -= 1
+        cached = [cached for cached in self._states if start <= cached < index]
+        if cached:
+            state = self._states[max(cached)].copy()
+            start = max(cached) + 1
+        else:
+            state = self._decode_keyframe(self.entries[start])
+            start += 1
+        stop = index + 1
+        for entry in self.entries[start:stop]:
+            self._apply_delta(state, entry)
+        self._cache_state(index, state)
+        return state
+
+    def _top(self):
+        return self.entries[self.index] if self.index >= 0 else None
+
+    def _last_keyframe(self, stop):
+        index = stop - 1
+        while index >= 0 and not self.entries[index].keyframe:
+            index -= 1
+        return index
+
+    def _encode(self, previous, image, keyframe):
+        if previous is image:
+            # only the meta changed, e.g. an annotation was added on top of the same pixels
+            return HistoryEntry(False, image.shape, image.dtype, [], b"")
+        if (
+            previous is None
+            or previous.shape != image.shape
+            or previous.dtype != image.dtype
+            or keyframe
+        ):
+            return self._encode_keyframe(image)
+
+        changed = self._changed_tiles(previous, image)
+        rows, cols = self._grid(image)
+        if len(changed) >= self.keyframe_ratio * rows * cols:
+            return self._encode_keyframe(image)
+
+        t = self.tile_size
+        tiles = []
+        blobs = []
+        offset = 0
+        for row, col in changed:
+            y, x = row * t, col * t
+            y1, x1 = y + t, x + t
+            tile = image[y:y1, x:x1]
+            blob = self._compress(np.ascontiguousarray(tile))
+            tiles.append((y, x, tile.shape[0], tile.shape[1], offset, len(blob)))
+            blobs.append(blob)
+            offset += len(blob)
+        return HistoryEntry(False, image.shape, image.dtype, tiles, b"".join(blobs))
+
+    def _encode_keyframe(self, image):
+        blob = self._compress(np.ascontiguousarray(image))
+        h, w = image.shape[:2]
+        return HistoryEntry(
+            True,
+            image.shape,
+            image.dtype,
+            [(0, 0, h, w, 0, len(blob))],
+            blob,
+        )
+
+    def _grid(self, image):
+        h, w = image.shape[:2]
+        return -(-h // self.tile_size), -(-w // self.tile_size)
+
+    def _changed_tiles(self, previous, image):
+        t = self.tile_size
+        h, w = image.shape[:2]
+        rows, cols = self._grid(image)
+        diff = previous != image
+        if diff.ndim == 3:
+            diff = diff.any(axis=2)
+        padded = np.zeros((rows * t, cols * t), dtype=bool)
+        padded[:h, :w] = diff
+        return np.argwhere(padded.reshape(rows, t, cols, t).any(axis=(1, 3)))
+
+    def _decode_keyframe(self, entry):
+        return self._decode_tile(entry, self._payload(entry), entry.tiles[0]).copy()
+
+    def _apply_delta(self, state, entry):
+        payload = self._payload(entry)
+        for tile in entry.tiles:
+            y, x, h, w = tile[:4]
+            y1, x1 = y + h, x + w
+            state[y:y1, x:x1] = self._decode_tile(entry, payload, tile)
+
+    def _payload(self, entry):
+        if entry.payload is not None:
+            self.hits += 1
+            self._resident.move_to_end(entry)
+            return entry.payload
+        self.misses += 1
+        return self.read_payload(entry)
+
+    def _enforce_budget(self):
+        if self.ram_budget is None:
+            return
+        # decoded states are the cheapest to give back, they are rebuilt from the entries on the next miss;
+        # the latest one stays, it is usually the image on screen
+        while (
+            self._ram_nbytes + self._states_nbytes > self.ram_budget
+            and len(self._states) > 1
+        ):
+            self._evict_state(next(iter(self._states)))
+        while (
+            self._ram_nbytes + self._states_nbytes > self.ram_budget
+            and len(self._resident) > 1
+        ):
+            entry, _ = self._resident.popitem(last=False)
+            self._spill(entry)
+
+    @traced("history")
+    def _spill(self, entry):
+        # entries never change after they are encoded, so a file written once stays valid
+        if entry.path is None:
+            self._spill_count += 1
+            entry.path = os.path.join(
+                self._scratch_path(),
+                f"{self._spill_count:08d}.npy",
+            )
+            np.save(entry.path, np.frombuffer(entry.payload, dtype=np.uint8))
+            # removed with the entry rather than when it leaves the history, a project being saved may still read it;
+            # the finalizer also keeps the scratch directory alive until then
+            weakref.finalize(entry, _remove_spill, entry.path, self._scratch)
+        entry.payload = None
+        self._ram_nbytes -= entry.nbytes
+        self.spills += 1
+
+    def _scratch_path(self):
+        if self._scratch is None:
+            self._scratch = _ScratchDirectory(self.scratch_dir)
+        return self._scratch.path
+
+    def _drop(self, entries):
+        for entry in entries:
+            if entry.payload is not None:
+                del self._resident[entry]
+                self._ram_nbytes -= entry.nbytes
+
+    def _decode_tile(self, entry, payload, tile):
+        h, w, offset, length = tile[2:]
+        end = offset + length
+        raw = self._decompress(memoryview(payload)[offset:end])
+        return np.frombuffer(raw, dtype=entry.dtype).reshape(
+            (h, w) + tuple(entry.shape[2:]),
+        )
+
+    def _compress(self, array):
+        if self.compression == "zlib":
+            return zlib.compress(array, 1)
+        if self.compression == "lz4":
+            return lz4.frame.compress(array)
+        return array.tobytes()
+
+    def _decompress(self, blob):
+        if self.compression == "zlib":
+            return zlib.decompress(blob)
+        if self.compression == "lz4":
+            return lz4.frame.decompress(blob)
+        return blob
+
+
+def _remove_spill(path, scratch):
+    # at exit the scratch directory may have been cleaned up already
+    with suppress(FileNotFoundError):
+        os.remove(path)
+
+
+class _ScratchDirectory:
+    def __init__(self, parent=None):
+        self.path = tempfile.mkdtemp(prefix="history-", dir=parent)
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
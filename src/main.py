@@ -1,26 +1,44 @@
+import os
 import sys
+import time
+import zipfile
 
+import annotations
 import cv2
-from PyQt6.QtCore import Qt
+import faces
+import operations
+import parallel
+import project
+import tiles
+from annotations import Compositor
+from batch import iter_images
+from history import History
+from PyQt6.QtCore import (
+    pyqtSignal,
+    Qt,
+    QTimer,
+)
 from PyQt6.QtGui import (
     QAction,
     QIcon,
-    QImage,
     QMouseEvent,
     QPixmap,
 )
 from PyQt6.QtWidgets import (
     QApplication,
+    QCheckBox,
     QColorDialog,
     QDialog,
     QFileDialog,
     QFormLayout,
+    QHBoxLayout,
     QInputDialog,
     QLabel,
     QLineEdit,
     QMainWindow,
     QMenu,
     QMessageBox,
+    QProgressBar,
     QPushButton,
     QSlider,
     QSpinBox,
@@ -28,158 +46,400 @@ from PyQt6.QtWidgets import (
     QToolBar,
     QVBoxLayout,
 )
+from recipe import Recipe
+from saving import (
+    DEFAULT_OPTIONS,
+    SaveQueue,
+)
+from thumbnails import ThumbnailCache
+from tracing import (
+    span,
+    traced,
+    tracer,
+)
+from video import VideoPipeline
+from viewer import (
+    ImageViewer,
+    to_qimage,
+)
+from workers import TaskRunner
+
+
+# undo history the editor keeps in RAM, compressed entries and decoded states together, the rest is spilled to disk
+HISTORY_BUDGET = 1024 * 1024 * 1024
 
 
 class ImageProcessor:
-    def __init__(self):
+    def __init__(self, history_budget=None, workers=None):
         self.image = None
-        self.history = []
-        self.history_index = -1
-
+        # strips processed at once on large images, the number of cores by default
+        self.workers = workers
+        # vector strokes drawn over the image, kept apart until an operation needs the pixels
+        self.annotations = ()
+        self.history = History(ram_budget=history_budget)
+        self.saver = SaveQueue()
+        self.recipe = Recipe()
+        self._proxy_source = None
+        self._proxy_size = None
+        self._proxy = None
+
+    @staticmethod
+    @traced("io")
+    def decode_image(file_path):
+        # gray files stay single-channel instead of being expanded to three identical planes
+        return cv2.imread(file_path, cv2.IMREAD_ANYCOLOR)
+
+    @traced("processor")
     def load_image(self, file_path):
-        self.image = cv2.imread(file_path)
-        if self.image is None:
+        image = self.decode_image(file_path)
+        if image is None:
             return False
-        self.add_to_history()
+        self.set_image(image)
         return True
 
-    def save_image(self, file_path):
+    @traced("processor")
+    def set_image(self, image):
+        self.image = image
+        self.annotations = ()
+        self.recipe = Recipe(self.image)
+        self.add_to_history()
+
+    @property
+    def layout(self):
+        return None if self.image is None else operations.layout(self.image)
+
+    @traced("processor")
+    def save_image(self, file_path, options=None):
         if self.image is None:
-            return
-        cv2.imwrite(file_path, self.image)
+            return None
+        return self.saver.submit(file_path, self.image, options, self.annotations)
+
+    def add_to_history(self, encoded=None):
+        with span("ImageProcessor.add_to_history", "processor") as args:
+            self.history.push(
+                self.image,
+                (self.recipe.snapshot(), self.annotations),
+                encoded,
+            )
+            args["history_bytes"] = self.history.nbytes
 
-    def add_to_history(self):
-        self.history = self.history[: self.history_index + 1]
-        self.history.append(self.image.copy())
-        self.history_index += 1
+    def restore(self, image):
+        snapshot, self.annotations = self.history.meta
+        self.image = image
+        self.recipe.restore(snapshot)
 
+    @traced("processor")
     def undo(self):
-        if self.history_index > 0:
-            self.history_index -= 1
-            self.image = self.history[self.history_index].copy()
-            return self.image
-        return None
+        image = self.history.undo()
+        if image is not None:
+            self.restore(image)
+        return image
 
+    @traced("processor")
     def redo(self):
-        if self.history_index < len(self.history) - 1:
-            self.history_index += 1
-            self.image = self.history[self.history_index].copy()
-            return self.image
-        return None
+        image = self.history.redo()
+        if image is not None:
+            self.restore(image)
+        return image
+
+    @traced("processor")
+    def apply(self, name, **params):
+        source = self.flatten()
+        if name in operations.GEOMETRY:
+            recipe = self.prepare_step(name, **params)
+            return self.commit_recipe(source, recipe, recipe.result())
+        return self.commit(
+            source,
+            [(name, params)],
+            self.process(source, [(name, params)]),
+        )
+
+    def encode_result(self, prepared, result):
+        # run in the worker with the operation, diffing and compressing a large image would stall the GUI thread
+        return result, self.history.encode(prepared, result)
+
+    @traced("processor")
+    def commit(self, source, steps, result, encoded=None):
+        # results computed off the GUI thread are dropped if the image changed in the meantime
+        if source is not self.image:
+            return None
+        self.image = result
+        self.recipe.extend(steps, result)
+        self.add_to_history(encoded)
+        return self.image
+
+    @traced("processor")
+    def prepare_step(self, name, **params):
+        # a rotation or resize is computed from the recipe, so it joins the transforms right before it
+        recipe = self.recipe.copy()
+        recipe.load_source()
+        recipe.append(name, params)
+        return recipe
+
+    @traced("processor")
+    def prepare_edit(self, index, **params):
+        recipe = self.recipe.copy()
+        recipe.load_source()
+        recipe.edit(index, **params)
+        return recipe
+
+    @traced("processor")
+    def commit_recipe(self, source, recipe, result, encoded=None):
+        if source is not self.image:
+            return None
+        self.recipe = recipe
+        self.image = result
+        self.add_to_history(encoded)
+        return self.image
+
+    @traced("processor")
+    def edit_step(self, index, **params):
+        self.flatten()
+        recipe = self.prepare_edit(index, **params)
+        return self.commit_recipe(self.image, recipe, recipe.result())
+
+    @traced("processor")
+    def save_recipe(self, file_path):
+        Recipe(steps=self.steps()).save(file_path)
+
+    @traced("processor")
+    def save_project(self, file_path, settings=None):
+        result = project.save_project(file_path, project.capture(self, settings))
+        self.history.relocate(result["mapping"], result["offsets"])
+        return result
+
+    @traced("processor")
+    def load_project(self, file_path):
+        loaded = project.load_project(file_path, self.history.ram_budget)
+        self.history.close()
+        self.history = loaded["history"]
+        self.image = loaded["image"]
+        self.recipe = loaded["recipe"]
+        self.annotations = loaded["annotations"]
+        return loaded["settings"]
+
+    @traced("processor")
+    def apply_recipe(self, file_path):
+        steps = Recipe.load(file_path).steps
+        source = self.flatten()
+        return self.commit(source, steps, self.process(source, steps))
+
+    @traced("processor")
+    def process(self, source, steps):
+        return parallel.run_pipeline(source, steps, workers=self.workers)
+
+    @traced("processor")
+    def process_large(self, source_path, target_path, progress=None, cancelled=None):
+        # the current recipe is streamed over a file that is never loaded whole
+        return tiles.process_file(
+            source_path,
+            target_path,
+            self.steps(),
+            progress=progress,
+            cancelled=cancelled,
+        )
 
+    @traced("processor")
     def apply_grayscale(self, scale=1):
         if self.image is None:
             return None
-        gray_image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-        self.image = cv2.merge((gray_image,) * 3)
-        self.add_to_history()
-        return self.image
+        return self.apply("grayscale")
 
+    @traced("processor")
     def apply_blur(self, kernel_size):
         if self.image is None:
             return None
-        if kernel_size % 2 == 0:
-            kernel_size += 1
-        self.image = cv2.GaussianBlur(self.image, (kernel_size, kernel_size), 0)
-        self.add_to_history()
-        return self.image
+        return self.apply("blur", kernel_size=kernel_size)
 
+    @traced("processor")
     def apply_canny(self, threshold1, threshold2):
         if self.image is None:
             return None
-        self.image = cv2.Canny(
-            cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY),
-            threshold1,
-            threshold2,
+        return self.apply("canny", threshold1=threshold1, threshold2=threshold2)
+
+    @traced("processor")
+    def rotate_image(self, angle, interpolation="linear", expand=False):
+        return self.apply(
+            "rotate",
+            angle=angle,
+            interpolation=interpolation,
+            expand=expand,
         )
-        self.add_to_history()
-        return self.image
 
-    def rotate_image(self, angle):
-        (h, w) = self.image.shape[:2]
-        center = (w // 2, h // 2)
-        M = cv2.getRotationMatrix2D(center, angle, 1.0)
-        self.image = cv2.warpAffine(self.image, M, (w, h))
-        self.add_to_history()
-        return self.image
-
-    def resize_image(self, width, height):
-        self.image = cv2.resize(self.image, (width, height))
-        self.add_to_history()
-        return self.image
+    @traced("processor")
+    def resize_image(self, width, height, interpolation="linear"):
+        return self.apply(
+            "resize",
+            width=width,
+            height=height,
+            interpolation=interpolation,
+        )
 
+    @traced("processor")
     def change_brightness_contrast(self, brightness=0, contrast=0):
-        self.image = cv2.convertScaleAbs(
-            self.image,
-            alpha=(contrast / 127 + 1),
-            beta=brightness,
+        return self.apply(
+            "brightness_contrast",
+            brightness=brightness,
+            contrast=contrast,
         )
+
+    def steps(self):
+        # the recipe as it would be replayed, with the annotations drawn last
+        return self.recipe.steps + [
+            (kind, dict(params)) for kind, params in self.annotations
+        ]
+
+    @traced("processor")
+    def annotate(self, kind, **params):
+        # only the stroke is stored, the pixels and their history entry stay as they are
+        self.annotations = self.annotations + ((kind, params),)
         self.add_to_history()
+        return self.annotations
+
+    @traced("processor")
+    def flatten(self):
+        # operations work on pixels, so pending strokes are burned in and become recipe steps
+        if not self.annotations:
+            return self.image
+        # no history entry of its own, the operation that follows records both in one undo step
+        steps = list(self.annotations)
+        self.image = annotations.render(self.image, steps)
+        self.recipe.extend(steps, self.image)
+        self.annotations = ()
         return self.image
 
+    @traced("processor")
     def draw_text(self, text, x, y, font_scale, color):
-        cv2.putText(
-            self.image,
-            text,
-            (x, y),
-            cv2.FONT_HERSHEY_SIMPLEX,
-            font_scale,
-            color,
-            2,
+        return self.annotate(
+            "text",
+            text=text,
+            x=x,
+            y=y,
+            font_scale=font_scale,
+            color=color,
         )
-        self.add_to_history()
-        return self.image
 
+    @traced("processor")
     def draw_rectangle(self, x, y, w, h, color):
-        cv2.rectangle(self.image, (x, y), (x + w, y + h), color, 2)
-        self.add_to_history()
-        return self.image
+        return self.annotate("rectangle", x=x, y=y, w=w, h=h, color=color)
 
+    @traced("processor")
     def draw_line(self, x1, y1, x2, y2, color):
-        cv2.line(self.image, (x1, y1), (x2, y2), color, 2)
-        self.add_to_history()
-        return self.image
+        return self.annotate("line", x1=x1, y1=y1, x2=x2, y2=y2, color=color)
 
+    @traced("processor")
     def draw_circle(self, center_x, center_y, radius, color):
-        cv2.circle(self.image, (center_x, center_y), radius, color, 2)
-        self.add_to_history()
-        return self.image
-
-    def detect_face(self):
-        gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-        face_cascade = cv2.CascadeClassifier(
-            cv2.data.haarcascades + "haarcascade_frontalface_default.xml",
+        return self.annotate(
+            "circle",
+            center_x=center_x,
+            center_y=center_y,
+            radius=radius,
+            color=color,
         )
 
-        angles = [0, 15, -15, 30, -30, 45, -45]
-        faces = []
+    @traced("processor")
+    def preview_proxy(self, max_width=960, max_height=720):
+        # history states are immutable, so a proxy stays valid for as long as the same array is current
+        size = (max_width, max_height)
+        if self._proxy_source is not self.image or self._proxy_size != size:
+            h, w = self.image.shape[:2]
+            scale = min(1.0, max_width / w, max_height / h)
+            proxy = self.image
+            if scale < 1:
+                proxy = cv2.resize(
+                    self.image,
+                    (max(1, round(w * scale)), max(1, round(h * scale))),
+                    interpolation=cv2.INTER_AREA,
+                )
+            self._proxy_source = self.image
+            self._proxy_size = size
+            self._proxy = (proxy, scale)
+        return self._proxy
+
+    @traced("processor")
+    def detect_face(self, fast=False):
+        return faces.detect_faces(self.image, fast=fast)
+
+
+class PreviewDialog(QDialog):
+    def __init__(self, parent, title, proxy, render, sliders, delay=30):
+        super().__init__(parent)
+        self.setWindowTitle(title)
+        self.proxy = proxy
+        self.render_preview = render
+        self.sliders = []
+
+        self.preview = QLabel()
+        self.preview.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.preview.setMinimumSize(proxy.shape[1] // 2, proxy.shape[0] // 2)
+
+        # slider events only restart the timer, the proxy is re-rendered once the slider settles
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.updatePreview)
 
-        for angle in angles:
-            rotated_gray = gray
-            if angle != 0:
-                (h, w) = gray.shape[:2]
-                center = (w // 2, h // 2)
-                M = cv2.getRotationMatrix2D(center, angle, 1.0)
-                rotated_gray = cv2.warpAffine(gray, M, (w, h))
+        form_layout = QFormLayout()
+        for label, minimum, maximum, value, step in sliders:
+            slider = QSlider(Qt.Orientation.Horizontal)
+            slider.setRange(minimum, maximum)
+            slider.setSingleStep(step)
+            slider.setPageStep(step * 5)
+            slider.setValue(value)
+            slider.valueChanged.connect(self.valueChanged)
+            value_label = QLabel(str(value))
+            row = QHBoxLayout()
+            row.addWidget(slider)
+            row.addWidget(value_label)
+            form_layout.addRow(label, row)
+            self.sliders.append((slider, value_label, minimum, step))
+
+        apply_button = QPushButton("Применить")
+        apply_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Отмена")
+        cancel_button.clicked.connect(self.reject)
+        buttons = QHBoxLayout()
+        buttons.addWidget(apply_button)
+        buttons.addWidget(cancel_button)
 
-            detected_faces = face_cascade.detectMultiScale(
-                rotated_gray,
-                scaleFactor=1.3,
-                minNeighbors=5,
-            )
-            if len(detected_faces) > 0:
-                faces.extend(detected_faces)
+        layout = QVBoxLayout()
+        layout.addWidget(self.preview)
+        layout.addLayout(form_layout)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+        self.updatePreview()
 
-        if len(faces) > 0:
-            return "��������� �������"
-        else:
-            return "������� �� ���������"
+    def values(self):
+        # stepped sliders stay on their grid, e.g. kernel sizes only take odd values
+        return [
+            minimum + (slider.value() - minimum) // step * step
+            for slider, _, minimum, step in self.sliders
+        ]
+
+    def valueChanged(self):
+        for (_, value_label, _, _), value in zip(self.sliders, self.values()):
+            value_label.setText(str(value))
+        self.timer.start()
+
+    def updatePreview(self):
+        image = self.render_preview(self.proxy, *self.values())
+        self.preview.setPixmap(QPixmap.fromImage(to_qimage(image)))
 
 
 class MainWindow(QMainWindow):
+    saveFinished = pyqtSignal(str, object)
+
     def __init__(self):
         super().__init__()
-        self.processor = ImageProcessor()
+        self.processor = ImageProcessor(history_budget=HISTORY_BUDGET)
+        self.tasks = TaskRunner(self)
+        # long exports run in a slot of their own, edits and previews never cancel them
+        self.jobs = TaskRunner(self)
+        self.thumbnails = ThumbnailCache()
+        self.compositor = Compositor()
+        self.file_path = None
+        self.save_options = dict(DEFAULT_OPTIONS)
+        self.saveFinished.connect(self.imageSaved)
         self.initUI()
 
     def initUI(self):
@@ -187,14 +447,52 @@ class MainWindow(QMainWindow):
         self.setGeometry(100, 100, 800, 600)
         self.setWindowIcon(QIcon("ico/ico.png"))
 
-        self.image_label = QLabel(self)
-        self.image_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.image_label.setMouseTracking(True)
-        self.setCentralWidget(self.image_label)
+        self.viewer = ImageViewer(self)
+        self.viewer.cursorMoved.connect(self.showCursorPosition)
+        self.setCentralWidget(self.viewer)
 
         self.statusBar = QStatusBar()
         self.setStatusBar(self.statusBar)
 
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.hide()
+        self.cancel_button = QPushButton("Отмена")
+        self.cancel_button.clicked.connect(self.cancelTask)
+        self.cancel_button.hide()
+        self.job_label = QLabel()
+        self.job_label.hide()
+        self.job_progress_bar = QProgressBar()
+        self.job_progress_bar.setRange(0, 100)
+        self.job_progress_bar.setMaximumWidth(200)
+        self.job_progress_bar.hide()
+        self.job_cancel_button = QPushButton("Прервать")
+        self.job_cancel_button.clicked.connect(self.cancelJob)
+        self.job_cancel_button.hide()
+        self.trace_label = QLabel()
+        self.statusBar.addPermanentWidget(self.trace_label)
+        self.statusBar.addPermanentWidget(self.progress_bar)
+        self.statusBar.addPermanentWidget(self.cancel_button)
+        self.statusBar.addPermanentWidget(self.job_label)
+        self.statusBar.addPermanentWidget(self.job_progress_bar)
+        self.statusBar.addPermanentWidget(self.job_cancel_button)
+        self.tasks.started.connect(self.taskStarted)
+        self.tasks.progress.connect(self.progress_bar.setValue)
+        self.tasks.idle.connect(self.taskIdle)
+        self.tasks.failed.connect(self.taskFailed)
+        self.jobs.started.connect(self.jobStarted)
+        self.jobs.progress.connect(self.job_progress_bar.setValue)
+        self.jobs.idle.connect(self.jobIdle)
+        self.jobs.failed.connect(self.taskFailed)
+
+        # spans are recorded from worker threads too, so the summary is polled rather than pushed
+        self._trace_last = None
+        self.trace_timer = QTimer(self)
+        self.trace_timer.setInterval(500)
+        self.trace_timer.timeout.connect(self.updateTraceSummary)
+        self.trace_timer.start()
+
         self.createActions()
         self.createMenus()
         self.createToolBars()
@@ -254,6 +552,35 @@ class MainWindow(QMainWindow):
             triggered=self.saveImage,
             shortcut="Ctrl+S",
         )
+        self.save_options_act = QAction(
+            "&Параметры сохранения...",
+            self,
+            triggered=self.saveOptions,
+        )
+        self.save_project_act = QAction(
+            "Сохранить &проект...",
+            self,
+            triggered=self.saveProject,
+            shortcut="Ctrl+Shift+S",
+        )
+        self.open_project_act = QAction(
+            "Открыть п&роект...",
+            self,
+            triggered=self.openProject,
+            shortcut="Ctrl+Shift+O",
+        )
+        self.next_image_act = QAction(
+            "&Следующее изображение в папке",
+            self,
+            triggered=lambda: self.openNeighbour(1),
+            shortcut="PgDown",
+        )
+        self.previous_image_act = QAction(
+            "&Предыдущее изображение в папке",
+            self,
+            triggered=lambda: self.openNeighbour(-1),
+            shortcut="PgUp",
+        )
         self.exit_act = QAction(
             QIcon("ico/exit.png"),
             "&����� �� ���������",
@@ -292,6 +619,11 @@ class MainWindow(QMainWindow):
             self,
             triggered=self.detectFace,
         )
+        self.detect_face_fast_act = QAction(
+            "&Быстрое распознавание лиц",
+            self,
+            triggered=lambda: self.detectFace(fast=True),
+        )
         self.undo_act = QAction(
             QIcon("ico/undo.png"),
             "��������",
@@ -306,6 +638,57 @@ class MainWindow(QMainWindow):
             triggered=self.redoAction,
             shortcut="Ctrl+Y",
         )
+        self.process_large_act = QAction(
+            "&Обработать большое изображение по рецепту...",
+            self,
+            triggered=self.processLargeImage,
+        )
+        self.process_video_act = QAction(
+            "&Обработать видео по рецепту...",
+            self,
+            triggered=self.processVideo,
+        )
+        self.save_recipe_act = QAction(
+            "&Сохранить рецепт...",
+            self,
+            triggered=self.saveRecipe,
+        )
+        self.apply_recipe_act = QAction(
+            "&Применить рецепт...",
+            self,
+            triggered=self.applyRecipe,
+        )
+        self.edit_step_act = QAction(
+            "&Изменить шаг рецепта...",
+            self,
+            triggered=self.editRecipeStep,
+        )
+        self.trace_memory_act = QAction(
+            "&Учитывать выделение памяти",
+            self,
+            checkable=True,
+            toggled=tracer.set_memory,
+        )
+        self.export_trace_act = QAction(
+            "&Экспорт трассировки...",
+            self,
+            triggered=self.exportTrace,
+        )
+        self.clear_trace_act = QAction(
+            "&Очистить трассировку",
+            self,
+            triggered=tracer.clear,
+        )
+        self.workers_act = QAction(
+            "&Потоки обработки...",
+            self,
+            triggered=self.setWorkers,
+        )
+        self.history_budget_act = QAction(
+            "&Память для истории...",
+            self,
+            triggered=self.setHistoryBudget,
+        )
         self.help_act = QAction(
             QIcon("ico/info.png"),
             "&������",
@@ -323,6 +706,13 @@ class MainWindow(QMainWindow):
         self.file_menu = self.menuBar().addMenu("&����")
         self.file_menu.addAction(self.open_act)
         self.file_menu.addAction(self.save_act)
+        self.file_menu.addAction(self.save_options_act)
+        self.file_menu.addSeparator()
+        self.file_menu.addAction(self.open_project_act)
+        self.file_menu.addAction(self.save_project_act)
+        self.file_menu.addSeparator()
+        self.file_menu.addAction(self.previous_image_act)
+        self.file_menu.addAction(self.next_image_act)
         self.file_menu.addSeparator()
         self.file_menu.addAction(self.exit_act)
 
@@ -343,9 +733,28 @@ class MainWindow(QMainWindow):
         self.edit_menu.addAction(self.draw_circle_act)
         self.edit_menu.addAction(self.rectangle_act)
         self.edit_menu.addSeparator()
+        self.edit_menu.addAction(self.detect_face_act)
+        self.edit_menu.addAction(self.detect_face_fast_act)
+        self.edit_menu.addSeparator()
         self.edit_menu.addAction(self.undo_act)
         self.edit_menu.addAction(self.redo_act)
 
+        self.recipe_menu = self.menuBar().addMenu("&Рецепт")
+        self.recipe_menu.addAction(self.edit_step_act)
+        self.recipe_menu.addSeparator()
+        self.recipe_menu.addAction(self.save_recipe_act)
+        self.recipe_menu.addAction(self.apply_recipe_act)
+        self.recipe_menu.addAction(self.process_large_act)
+        self.recipe_menu.addAction(self.process_video_act)
+
+        self.trace_menu = self.menuBar().addMenu("&Профилирование")
+        self.trace_menu.addAction(self.trace_memory_act)
+        self.trace_menu.addAction(self.workers_act)
+        self.trace_menu.addAction(self.history_budget_act)
+        self.trace_menu.addSeparator()
+        self.trace_menu.addAction(self.export_trace_act)
+        self.trace_menu.addAction(self.clear_trace_act)
+
         self.help_menu = self.menuBar().addMenu("&������")
         self.help_menu.addAction(self.help_act)
         self.help_menu.addAction(self.about_act)
@@ -390,7 +799,7 @@ class MainWindow(QMainWindow):
             "��������� ��� ��������� �����������\n������ 1.2",
         )
 
-    def detectFace(self):
+    def detectFace(self, fast=False):
         if self.processor.image is None:
             QMessageBox.warning(
                 self,
@@ -398,8 +807,28 @@ class MainWindow(QMainWindow):
                 "���������� ��������� ����, ����� ���� ������ ��������������",
             )
             return
-        result = self.processor.detect_face()
-        self.statusBar.showMessage(result)
+        source = self.processor.image
+
+        def show(found):
+            if source is not self.processor.image:
+                return
+            if found:
+                self.displayImage(faces.draw_faces(source, found))
+                self.statusBar.showMessage(f"Обнаружено лиц: {len(found)}")
+            else:
+                self.displayImage(source)
+                self.statusBar.showMessage("Лица не обнаружены")
+
+        self.tasks.submit(
+            lambda task: faces.detect_faces(
+                source,
+                fast=fast,
+                progress=task.progress,
+                cancelled=task.cancelled,
+            ),
+            show,
+            "Распознавание лиц...",
+        )
 
     def mouseMoveEvent(self, event: QMouseEvent):
         pos = event.position()
@@ -407,43 +836,398 @@ class MainWindow(QMainWindow):
 
         self.statusBar.showMessage(f"���������� �������: ({x}, {y})")
 
+    def showCursorPosition(self, x, y):
+        self.statusBar.showMessage(f"Координаты курсора на изображении: ({x}, {y})")
+
     def openImage(self):
         file_dialog = QFileDialog(self)
         file_dialog.setNameFilter("Открыть (*.png *.jpg *.jpeg *.bmp)")
         if file_dialog.exec():
-            file_path = file_dialog.selectedFiles()[0]
-            if not self.processor.load_image(file_path):
+            self.openFile(file_dialog.selectedFiles()[0])
+
+    def openFile(self, file_path):
+        def loaded(image):
+            if image is None:
                 QMessageBox.warning(
                     self,
                     "������",
                     "�� ������� ��������� �����������. ��������� ���� � ����� � ��� �����������.",
                 )
-            else:
-                self.displayImage(self.processor.image)
-                self.statusBar.showMessage(f"����������� ���������: {file_path}")
+                return
+            self.file_path = file_path
+            self.processor.set_image(image)
+            self.displayImage(image)
+            self.statusBar.showMessage(f"����������� ���������: {file_path}")
+            self.prefetchNeighbours(file_path)
+
+        def preview(image):
+            # the cached or reduced copy is on screen while the full resolution is still decoding
+            if image is not None:
+                self.displayImage(image)
+            self.tasks.submit(
+                lambda task: ImageProcessor.decode_image(file_path),
+                loaded,
+                "Загрузка изображения...",
+            )
+
+        self.tasks.submit(
+            # a preview that needs a full decode of its own would only delay the full image
+            lambda task: self.thumbnails.get(file_path, full_decode=False),
+            preview,
+            "Загрузка изображения...",
+        )
+
+    def folderImages(self, file_path):
+        directory = os.path.dirname(os.path.abspath(file_path))
+        paths = list(iter_images(directory))
+        try:
+            return paths, paths.index(os.path.abspath(file_path))
+        except ValueError:
+            return paths, None
+
+    def openNeighbour(self, offset):
+        if self.file_path is None:
+            return
+        paths, index = self.folderImages(self.file_path)
+        if index is not None and 0 <= index + offset < len(paths):
+            self.openFile(paths[index + offset])
+
+    def prefetchNeighbours(self, file_path):
+        # thumbnails of the files around the open one are ready before the user pages to them
+        paths, index = self.folderImages(file_path)
+        if index is None:
+            return
+        self.thumbnails.prefetch(
+            paths[index + offset]
+            for offset in (1, -1, 2, -2)
+            if 0 <= index + offset < len(paths)
+        )
 
     def saveImage(self):
         if self.processor.image is None:
             QMessageBox.warning(self, "��������������", "���������� ��������� ����")
             return
         file_dialog = QFileDialog(self)
-        file_dialog.setAcceptMode(QFileDialog.AcceptSave)
-        file_dialog.setNameFilter("����������� (*.png *.jpg *.jpeg *.bmp)")
+        file_dialog.setAcceptMode(QFileDialog.AcceptMode.AcceptSave)
+        file_dialog.setNameFilter("����������� (*.png *.jpg *.jpeg *.bmp *.webp)")
         if file_dialog.exec():
             file_path = file_dialog.selectedFiles()[0]
-            self.processor.save_image(file_path)
-            self.statusBar.showMessage(f"����������� ���������: {file_path}")
+            future = self.processor.save_image(file_path, self.save_options)
+            # the writer thread reports back through a queued signal, the window never waits for the encoder
+            future.add_done_callback(
+                lambda future: self.saveFinished.emit(file_path, future),
+            )
+            self.statusBar.showMessage(f"Сохранение: {file_path}")
+
+    def imageSaved(self, file_path, future):
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except (OSError, ValueError, cv2.error) as error:
+            QMessageBox.warning(
+                self,
+                "Ошибка",
+                f"Не удалось сохранить изображение: {error}",
+            )
+            return
+        self.statusBar.showMessage(
+            f"����������� ���������: {file_path} ({result['bytes'] / 1024:.0f} КБ, "
+            f"кодирование {result['encode_seconds'] * 1000:.0f} мс)",
+        )
+
+    def projectSettings(self):
+        return {"file_path": self.file_path, "save_options": self.save_options}
+
+    def askProjectPath(self):
+        file_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Сохранить проект",
+            "",
+            f"Проекты (*{project.EXTENSION})",
+        )
+        if file_path and not file_path.endswith(project.EXTENSION):
+            file_path += project.EXTENSION
+        return file_path
+
+    def saveProject(self):
+        if self.processor.image is None:
+            QMessageBox.warning(self, "Предупреждение", "Сначала откройте изображение")
+            return
+        file_path = self.askProjectPath()
+        if not file_path:
+            return
+        # the snapshot is taken here, edits made while the file is written do not end up in it
+        captured = project.capture(self.processor, self.projectSettings())
+        history = self.processor.history
+
+        def saved(result):
+            # the saved entries are read from the project from now on, their copies in RAM are released
+            if history is self.processor.history:
+                history.relocate(result["mapping"], result["offsets"])
+            self.statusBar.showMessage(
+                f"Проект сохранён: {file_path} ({result['bytes'] / 1e6:.1f} МБ, "
+                f"шагов истории: {result['entries']}, {result['seconds'] * 1000:.0f} мс)",
+            )
+
+        # a job of its own, an edit made while the file is written must not cancel the save
+        self.startJob(
+            lambda task: project.save_project(
+                file_path,
+                captured,
+                task.progress,
+                task.cancelled,
+            ),
+            saved,
+            "Сохранение проекта...",
+        )
+
+    def openProject(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self,
+            "Открыть проект",
+            "",
+            f"Проекты (*{project.EXTENSION})",
+        )
+        if not file_path:
+            return
+        if self.jobs.busy():
+            # a project save reads the history that is about to be replaced, it is finished or stopped first
+            reply = QMessageBox.question(
+                self,
+                "Подтверждение",
+                f"Уже выполняется: {self.jobs.current.message}\nПрервать её и открыть проект?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                QMessageBox.StandardButton.No,
+            )
+            if reply != QMessageBox.StandardButton.Yes:
+                return
+            self.jobs.cancel()
+            self.jobs.wait()
+        if self.tasks.busy():
+            # a running operation would finish on top of the history that is about to be replaced
+            self.tasks.cancel()
+            self.tasks.wait()
+        start = time.perf_counter()
+        try:
+            settings = self.processor.load_project(file_path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as error:
+            QMessageBox.warning(self, "Ошибка", f"Не удалось открыть проект: {error}")
+            return
+        self.file_path = settings.get("file_path")
+        self.save_options.update(settings.get("save_options", {}))
+        self.displayImage(self.processor.image)
+        self.statusBar.showMessage(
+            f"Проект открыт: {file_path} (шагов истории: {len(self.processor.history)}, "
+            f"{(time.perf_counter() - start) * 1000:.0f} мс)",
+        )
+
+    def saveOptions(self):
+        dialog = QDialog(self)
+        dialog.setWindowTitle("Параметры сохранения")
+        form_layout = QFormLayout()
+        png_compression = QSpinBox()
+        png_compression.setRange(0, 9)
+        png_compression.setValue(self.save_options["png_compression"])
+        jpeg_quality = QSpinBox()
+        jpeg_quality.setRange(0, 100)
+        jpeg_quality.setValue(self.save_options["jpeg_quality"])
+        jpeg_progressive = QCheckBox()
+        jpeg_progressive.setChecked(self.save_options["jpeg_progressive"])
+        webp_quality = QSpinBox()
+        webp_quality.setRange(1, 101)
+        webp_quality.setValue(self.save_options["webp_quality"])
+        form_layout.addRow("Сжатие PNG (0-9):", png_compression)
+        form_layout.addRow("Качество JPEG:", jpeg_quality)
+        form_layout.addRow("Прогрессивный JPEG:", jpeg_progressive)
+        form_layout.addRow("Качество WebP (101 — без потерь):", webp_quality)
+
+        apply_button = QPushButton("Применить")
+        apply_button.clicked.connect(dialog.accept)
+        layout = QVBoxLayout()
+        layout.addLayout(form_layout)
+        layout.addWidget(apply_button)
+        dialog.setLayout(layout)
+
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            self.save_options = {
+                "png_compression": png_compression.value(),
+                "jpeg_quality": jpeg_quality.value(),
+                "jpeg_progressive": jpeg_progressive.isChecked(),
+                "webp_quality": webp_quality.value(),
+            }
 
     def displayImage(self, image):
-        qformat = QImage.Format.Format_Indexed8
-        if len(image.shape) == 3:
-            if image.shape[2] == 4:
-                qformat = QImage.Format.Format_RGBA8888
-            else:
-                qformat = QImage.Format.Format_RGB888
-        img = QImage(image, image.shape[1], image.shape[0], image.strides[0], qformat)
-        img = img.rgbSwapped()
-        self.image_label.setPixmap(QPixmap.fromImage(img))
+        with span("MainWindow.displayImage", "display", shape=list(image.shape)):
+            if image is not self.processor.image:
+                self.viewer.setImage(image)
+                return
+            self.viewer.showComposited(
+                self.compositor,
+                image,
+                self.processor.annotations,
+            )
+
+    def updateTraceSummary(self):
+        event = tracer.last
+        if event is None or event is self._trace_last:
+            return
+        self._trace_last = event
+        summary = f"{event['name']}: {event['dur'] / 1000:.1f} мс"
+        if "allocated_bytes" in event["args"]:
+            summary += f", {event['args']['allocated_bytes'] / 1e6:+.1f} МБ"
+        stats = self.processor.history.stats()
+        summary += (
+            f" | история: {(stats['ram_bytes'] + stats['state_bytes']) / 1e6:.1f} МБ в памяти, "
+            f"{stats['disk_bytes'] / 1e6:.1f} МБ на диске, попаданий {stats['hits']}, "
+            f"промахов {stats['misses']}, выгружено {stats['spills']}"
+        )
+        summary += f" | кэш рецепта: {self.processor.recipe.cache_nbytes / 1e6:.1f} МБ"
+        summary += f" | событий: {len(tracer.events)}"
+        self.trace_label.setText(summary)
+
+    def setWorkers(self):
+        cores = os.cpu_count()
+        workers, ok = QInputDialog.getInt(
+            self,
+            "Потоки обработки",
+            f"Сколько полос большого изображения обрабатывать одновременно (ядер: {cores}):",
+            self.processor.workers or cores,
+            1,
+            cores * 4,
+        )
+        if ok:
+            self.processor.workers = workers
+            self.statusBar.showMessage(f"Потоков обработки: {workers}")
+
+    def setHistoryBudget(self):
+        budget = self.processor.history.ram_budget
+        megabytes, ok = QInputDialog.getInt(
+            self,
+            "Память для истории",
+            "Сколько мегабайт истории отмены держать в памяти (0 — без ограничения):",
+            0 if budget is None else budget // (1024 * 1024),
+            0,
+            1024 * 1024,
+        )
+        if ok:
+            self.processor.history.set_budget(megabytes * 1024 * 1024 or None)
+            self.statusBar.showMessage(
+                (
+                    f"Память для истории: {megabytes} МБ"
+                    if megabytes
+                    else "Память для истории не ограничена"
+                ),
+            )
+
+    def exportTrace(self):
+        file_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Экспорт трассировки",
+            "trace.json",
+            "Chrome Trace / Perfetto (*.json)",
+        )
+        if not file_path:
+            return
+        try:
+            count = tracer.export(file_path)
+        except OSError as error:
+            QMessageBox.warning(
+                self,
+                "Ошибка",
+                f"Не удалось сохранить трассировку: {error}",
+            )
+            return
+        self.statusBar.showMessage(
+            f"Трассировка сохранена: {file_path} (событий: {count})",
+        )
+
+    def runOperation(self, name, message, **params):
+        source = self.processor.flatten()
+        prepared = self.processor.history.prepare()
+        if name in operations.GEOMETRY:
+            recipe = self.processor.prepare_step(name, **params)
+
+            def commit_transform(result):
+                image = self.processor.commit_recipe(source, recipe, *result)
+                if image is not None:
+                    self.displayImage(image)
+                    self.statusBar.showMessage(message)
+
+            self.tasks.submit(
+                lambda task: self.processor.encode_result(prepared, recipe.result()),
+                commit_transform,
+                "Обработка...",
+            )
+            return
+
+        def commit(result):
+            image = self.processor.commit(source, [(name, params)], *result)
+            if image is not None:
+                self.displayImage(image)
+                self.statusBar.showMessage(message)
+
+        self.tasks.submit(
+            lambda task: self.processor.encode_result(
+                prepared,
+                self.processor.process(source, [(name, params)]),
+            ),
+            commit,
+            "Обработка...",
+        )
+
+    def annotate(self, kind, message, **params):
+        self.processor.annotate(kind, **params)
+        self.displayImage(self.processor.image)
+        self.statusBar.showMessage(message)
+
+    def taskStarted(self, message):
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.cancel_button.show()
+        self.statusBar.showMessage(message)
+
+    def taskIdle(self):
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+
+    def taskFailed(self, message):
+        QMessageBox.warning(self, "Ошибка", f"Не удалось выполнить операцию: {message}")
+
+    def cancelTask(self):
+        self.tasks.cancel()
+        self.statusBar.showMessage("Операция отменена")
+
+    def startJob(self, function, on_finished, message):
+        if self.jobs.busy():
+            reply = QMessageBox.question(
+                self,
+                "Подтверждение",
+                f"Уже выполняется: {self.jobs.current.message}\nПрервать её и начать новую задачу?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                QMessageBox.StandardButton.No,
+            )
+            if reply != QMessageBox.StandardButton.Yes:
+                return None
+        return self.jobs.submit(function, on_finished, message)
+
+    def jobStarted(self, message):
+        self.job_label.setText(message)
+        self.job_label.show()
+        self.job_progress_bar.setValue(0)
+        self.job_progress_bar.show()
+        self.job_cancel_button.show()
+        self.statusBar.showMessage(message)
+
+    def jobIdle(self):
+        self.job_label.hide()
+        self.job_progress_bar.hide()
+        self.job_cancel_button.hide()
+
+    def cancelJob(self):
+        message = self.jobs.current.message if self.jobs.busy() else ""
+        self.jobs.cancel()
+        self.statusBar.showMessage(f"Задача прервана: {message}")
 
     def show_warning(self, title, message):
         msg = QMessageBox()
@@ -460,9 +1244,10 @@ class MainWindow(QMainWindow):
                 "���������� ��������� ����, ����� ���� ������ ��������������",
             )
             return
-        image = self.processor.apply_grayscale()
-        self.displayImage(image)
-        self.statusBar.showMessage("�������� ������ ���������")
+        self.runOperation(
+            "grayscale",
+            "�������� ������ ���������",
+        )
 
     def applyBlur(self):
         if self.processor.image is None:
@@ -472,18 +1257,23 @@ class MainWindow(QMainWindow):
                 "���������� ��������� ����, ����� ���� ������ ��������������",
             )
             return
-        kernel_size, ok = QInputDialog.getInt(
+        proxy, scale = self.processor.preview_proxy()
+        dialog = PreviewDialog(
             self,
-            "��������",
-            "������ ���� (�������� �����):",
-            min=1,
-            max=49,
-            step=2,
+            "Размытие",
+            proxy,
+            lambda image, kernel_size: operations.blur(
+                image,
+                max(1, round(kernel_size * scale)),
+            ),
+            [("Размер ядра:", 1, 1001, 1, 2)],
         )
-        if ok:
-            self.displayImage(self.processor.apply_blur(kernel_size))
-            self.statusBar.showMessage(
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            (kernel_size,) = dialog.values()
+            self.runOperation(
+                "blur",
                 f"�������� ��������� � �������� ���� {kernel_size}",
+                kernel_size=kernel_size,
             )
 
     def applyCanny(self):
@@ -494,24 +1284,21 @@ class MainWindow(QMainWindow):
                 "���������� ��������� ����, ����� ���� ������ ��������������",
             )
             return
-        threshold1, ok1 = QInputDialog.getInt(
+        proxy, _ = self.processor.preview_proxy()
+        dialog = PreviewDialog(
             self,
-            "�������� ������",
-            "����� 1:",
-            min=0,
-            max=255,
+            "Выделение границ",
+            proxy,
+            operations.canny,
+            [("Порог 1:", 0, 255, 100, 1), ("Порог 2:", 0, 255, 200, 1)],
         )
-        threshold2, ok2 = QInputDialog.getInt(
-            self,
-            "�������� ������",
-            "����� 2:",
-            min=0,
-            max=255,
-        )
-        if ok1 and ok2:
-            self.displayImage(self.processor.apply_canny(threshold1, threshold2))
-            self.statusBar.showMessage(
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            threshold1, threshold2 = dialog.values()
+            self.runOperation(
+                "canny",
                 f"�������� �������� � �������� {threshold1} � {threshold2}",
+                threshold1=threshold1,
+                threshold2=threshold2,
             )
 
     def applyRotate(self):
@@ -529,9 +1316,27 @@ class MainWindow(QMainWindow):
             min=-360,
             max=360,
         )
+        if not ok:
+            return
+        interpolation, ok = self.askInterpolation("Поворот")
+        if not ok:
+            return
+        canvas, ok = QInputDialog.getItem(
+            self,
+            "Поворот",
+            "Холст:",
+            ["Сохранить размер", "Расширить, чтобы углы не обрезались"],
+            0,
+            False,
+        )
         if ok:
-            self.displayImage(self.processor.rotate_image(angle))
-            self.statusBar.showMessage(f"����������� ��������� �� {angle} ��������")
+            self.runOperation(
+                "rotate",
+                f"����������� ��������� �� {angle} ��������",
+                angle=angle,
+                interpolation=interpolation,
+                expand=canvas != "Сохранить размер",
+            )
 
     def applyResize(self):
         if self.processor.image is None:
@@ -543,12 +1348,35 @@ class MainWindow(QMainWindow):
             return
         width, ok1 = QInputDialog.getInt(self, "�������� ������", "������:", min=1)
         height, ok2 = QInputDialog.getInt(self, "�������� ������", "������:", min=1)
-        if ok1 and ok2:
-            self.displayImage(self.processor.resize_image(width, height))
-            self.statusBar.showMessage(
+        if not (ok1 and ok2):
+            return
+        interpolation, ok = self.askInterpolation("Изменить размер")
+        if ok:
+            self.runOperation(
+                "resize",
                 f"������ ����������� ������� �� {width}x{height}",
+                width=width,
+                height=height,
+                interpolation=interpolation,
             )
 
+    def askInterpolation(self, title):
+        names = {
+            "Ближайший сосед": "nearest",
+            "Билинейная": "linear",
+            "Бикубическая": "cubic",
+            "Ланцош": "lanczos",
+        }
+        label, ok = QInputDialog.getItem(
+            self,
+            title,
+            "Интерполяция:",
+            list(names),
+            1,
+            False,
+        )
+        return names.get(label), ok
+
     def applyBrightnessContrast(self):
         if self.processor.image is None:
             QMessageBox.warning(
@@ -557,33 +1385,21 @@ class MainWindow(QMainWindow):
                 "���������� ��������� ����, ����� ���� ������ ��������������",
             )
             return
-        dialog = QDialog(self)
-        dialog.setWindowTitle("�������/��������")
-        layout = QVBoxLayout()
-
-        form_layout = QFormLayout()
-        brightness = QSlider(Qt.Horizontal)
-        brightness.setRange(-255, 255)
-        contrast = QSlider(Qt.Horizontal)
-        contrast.setRange(-127, 127)
-        form_layout.addRow("�������:", brightness)
-        form_layout.addRow("��������:", contrast)
-
-        apply_button = QPushButton("���������")
-        apply_button.clicked.connect(dialog.accept)
-
-        layout.addLayout(form_layout)
-        layout.addWidget(apply_button)
-        dialog.setLayout(layout)
-
-        if dialog.exec() == QDialog.accepted:
-            image = self.processor.change_brightness_contrast(
-                brightness.value(),
-                contrast.value(),
-            )
-            self.displayImage(image)
-            self.statusBar.showMessage(
+        proxy, _ = self.processor.preview_proxy()
+        dialog = PreviewDialog(
+            self,
+            "Яркость/контраст",
+            proxy,
+            operations.brightness_contrast,
+            [("Яркость:", -255, 255, 0, 1), ("Контраст:", -127, 127, 0, 1)],
+        )
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            brightness, contrast = dialog.values()
+            self.runOperation(
+                "brightness_contrast",
                 f"������� �������� �� {brightness}, �������� �� {contrast}",
+                brightness=brightness,
+                contrast=contrast,
             )
 
     def choose_color(self, button):
@@ -638,16 +1454,14 @@ class MainWindow(QMainWindow):
             text = text_input.text()
             color = color_button.palette().button().color().getRgb()[:3]
             bgr_color = (color[2], color[1], color[0])
-            image = self.processor.draw_text(
-                text,
-                x.value(),
-                y.value(),
-                font_scale.value(),
-                bgr_color,
-            )
-            self.displayImage(image)
-            self.statusBar.showMessage(
+            self.annotate(
+                "text",
                 f'����� "{text}" �������� � ��������� ������ {font_scale.value()}',
+                text=text,
+                x=x.value(),
+                y=y.value(),
+                font_scale=font_scale.value(),
+                color=bgr_color,
             )
 
     def drawLine(self):
@@ -692,15 +1506,15 @@ class MainWindow(QMainWindow):
         if dialog.exec() == QDialog.accept:
             color = color_button.palette().button().color().getRgb()[:3]
             bgr_color = (color[2], color[1], color[0])
-            image = self.processor.draw_line(
-                x1.value(),
-                y1.value(),
-                x2.value(),
-                y2.value(),
-                bgr_color,
+            self.annotate(
+                "line",
+                "����� ����������",
+                x1=x1.value(),
+                y1=y1.value(),
+                x2=x2.value(),
+                y2=y2.value(),
+                color=bgr_color,
             )
-            self.displayImage(image)
-            self.statusBar.showMessage("����� ����������")
 
     def drawCircle(self):
         if self.processor.image is None:
@@ -741,14 +1555,14 @@ class MainWindow(QMainWindow):
         if dialog.exec() == QDialog.Accepted:
             color = color_button.palette().button().color().getRgb()[:3]
             bgr_color = (color[2], color[1], color[0])
-            image = self.processor.draw_circle(
-                center_x.value(),
-                center_y.value(),
-                radius.value(),
-                bgr_color,
+            self.annotate(
+                "circle",
+                "���� ���������",
+                center_x=center_x.value(),
+                center_y=center_y.value(),
+                radius=radius.value(),
+                color=bgr_color,
             )
-            self.displayImage(image)
-            self.statusBar.showMessage("���� ���������")
 
     def drawRectangle(self):
         if self.processor.image is None:
@@ -792,18 +1606,247 @@ class MainWindow(QMainWindow):
         if dialog.exec() == QDialog.accept:
             color = color_button.palette().button().color().getRgb()[:3]
             bgr_color = (color[2], color[1], color[0])
-            image = self.processor.draw_rectangle(
-                x.value(),
-                y.value(),
-                w.value(),
-                h.value(),
-                bgr_color,
+            self.annotate(
+                "rectangle",
+                f"������������� ��������� � ������� {w.value()} � ������� {h.value()}",
+                x=x.value(),
+                y=y.value(),
+                w=w.value(),
+                h=h.value(),
+                color=bgr_color,
             )
-            self.displayImage(image)
+
+    def saveRecipe(self):
+        if not self.processor.recipe.steps:
+            QMessageBox.warning(
+                self,
+                "Предупреждение",
+                "Рецепт пока не содержит ни одного шага",
+            )
+            return
+        file_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Сохранить рецепт",
+            "",
+            "Рецепт (*.json)",
+        )
+        if file_path:
+            self.processor.save_recipe(file_path)
+            self.statusBar.showMessage(f"Рецепт сохранён: {file_path}")
+
+    def applyRecipe(self):
+        if self.processor.image is None:
+            QMessageBox.warning(
+                self,
+                "Предупреждение",
+                "Необходимо загрузить файл, чтобы начать редактирование",
+            )
+            return
+        file_path, _ = QFileDialog.getOpenFileName(
+            self,
+            "Применить рецепт",
+            "",
+            "Рецепт (*.json)",
+        )
+        if not file_path:
+            return
+        try:
+            steps = Recipe.load(file_path).steps
+        except (OSError, ValueError, TypeError) as error:
+            QMessageBox.warning(self, "Ошибка", f"Не удалось применить рецепт: {error}")
+            return
+        source = self.processor.flatten()
+        prepared = self.processor.history.prepare()
+
+        def commit(result):
+            image = self.processor.commit(source, steps, *result)
+            if image is not None:
+                self.displayImage(image)
+                self.statusBar.showMessage(f"Рецепт применён: {file_path}")
+
+        self.tasks.submit(
+            lambda task: self.processor.encode_result(
+                prepared,
+                self.processor.process(source, steps),
+            ),
+            commit,
+            "Применение рецепта...",
+        )
+
+    def processLargeImage(self):
+        # the same steps process_large streams, pending strokes included
+        steps = self.processor.steps()
+        if not steps:
+            QMessageBox.warning(
+                self,
+                "Предупреждение",
+                "Рецепт пока не содержит ни одного шага",
+            )
+            return
+        if any(name in operations.DRAWINGS for name, _ in steps):
+            QMessageBox.warning(
+                self,
+                "Предупреждение",
+                "Надписи и фигуры нельзя наложить по тайлам. Отмените их или сохраните рецепт "
+                "и примените его к изображению целиком.",
+            )
+            return
+        try:
+            tiles.pipeline_halo(steps)
+        except ValueError:
+            QMessageBox.warning(
+                self,
+                "Предупреждение",
+                "По тайлам можно обработать только оттенки серого, размытие, выделение границ и яркость/контраст",
+            )
+            return
+        source_path, _ = QFileDialog.getOpenFileName(
+            self,
+            "Исходное изображение",
+            "",
+            "Изображения (*.npy *.ppm *.pgm *.png *.jpg *.jpeg *.bmp *.tif *.tiff)",
+        )
+        if not source_path:
+            return
+        target_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Сохранить результат",
+            "",
+            "Изображения (*.npy *.ppm *.pgm *.png *.jpg *.jpeg *.bmp *.tif *.tiff)",
+        )
+        if not target_path:
+            return
+        self.startJob(
+            lambda task: self.processor.process_large(
+                source_path,
+                target_path,
+                progress=task.progress,
+                cancelled=task.cancelled,
+            ),
+            lambda shape: self.statusBar.showMessage(
+                f"Изображение {shape[1]}x{shape[0]} обработано по тайлам: {target_path}",
+            ),
+            "Обработка по тайлам...",
+        )
+
+    def processVideo(self):
+        source_path, _ = QFileDialog.getOpenFileName(
+            self,
+            "Исходное видео",
+            "",
+            "Видео (*.mp4 *.avi *.mov *.mkv)",
+        )
+        if not source_path:
+            return
+        target_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Сохранить видео",
+            "",
+            "Видео (*.mp4 *.avi)",
+        )
+        if not target_path:
+            return
+        detect = QMessageBox.question(
+            self,
+            "Видео",
+            "Отмечать лица на каждом кадре?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+            QMessageBox.StandardButton.No,
+        )
+        pipeline = VideoPipeline(
+            source_path,
+            target_path,
+            self.processor.steps(),
+            detect_faces=detect == QMessageBox.StandardButton.Yes,
+        )
+
+        def finished(report):
+            decode, process, encode = report["stages"]
             self.statusBar.showMessage(
-                f"������������� ��������� � ������� {w.value()} � ������� {h.value()}",
+                f"Видео обработано: {encode['frames']} кадров за {report['seconds']:.1f} с, "
+                f"{encode['fps']:.1f} кадр/с (обработка до {process['capacity_fps']:.1f} кадр/с), "
+                f"пропущено кадров: {decode['dropped']}",
             )
 
+        self.startJob(
+            lambda task: pipeline.run(task.progress, task.cancelled),
+            finished,
+            "Обработка видео...",
+        )
+
+    def editRecipeStep(self):
+        steps = self.processor.recipe.steps
+        if not steps:
+            QMessageBox.warning(
+                self,
+                "Предупреждение",
+                "Рецепт пока не содержит ни одного шага",
+            )
+            return
+        items = [
+            f"{index + 1}. {name} ({', '.join(f'{key}={value}' for key, value in params.items())})"
+            for index, (name, params) in enumerate(steps)
+        ]
+        item, ok = QInputDialog.getItem(
+            self,
+            "Изменить шаг рецепта",
+            "Шаг:",
+            items,
+            len(items) - 1,
+            False,
+        )
+        if not ok:
+            return
+        index = items.index(item)
+        name, params = steps[index]
+
+        new_params = {}
+        for key, value in params.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+                continue
+            if isinstance(value, int):
+                value, ok = QInputDialog.getInt(
+                    self,
+                    name,
+                    f"{key}:",
+                    value,
+                    -100000,
+                    100000,
+                )
+            elif isinstance(value, float):
+                value, ok = QInputDialog.getDouble(
+                    self,
+                    name,
+                    f"{key}:",
+                    value,
+                    -100000,
+                    100000,
+                    2,
+                )
+            else:
+                value, ok = QInputDialog.getText(self, name, f"{key}:", text=value)
+            if not ok:
+                return
+            new_params[key] = value
+
+        source = self.processor.flatten()
+        prepared = self.processor.history.prepare()
+        recipe = self.processor.prepare_edit(index, **new_params)
+
+        def commit(result):
+            image = self.processor.commit_recipe(source, recipe, *result)
+            if image is not None:
+                self.displayImage(image)
+                self.statusBar.showMessage(
+                    f"Шаг {index + 1} изменён, пересчитано шагов: {len(steps) - index}",
+                )
+
+        self.tasks.submit(
+            lambda task: self.processor.encode_result(prepared, recipe.result()),
+            commit,
+            "Пересчёт рецепта...",
+        )
+
     def undoAction(self):
         image = self.processor.undo()
         if image is not None:
@@ -817,15 +1860,66 @@ class MainWindow(QMainWindow):
             self.statusBar.showMessage("������ ���������� ��������")
 
     def closeEvent(self, event):
-        reply = QMessageBox.question(
-            self,
-            "Подтверждение",
-            "Вы уверены, что хотите закрыть приложение?",
-            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
-            QMessageBox.StandardButton.No,
-        )
-
-        if reply == QMessageBox.StandardButton.Yes:
+        if self.jobs.busy():
+            reply = QMessageBox.question(
+                self,
+                "Подтверждение",
+                f"Ещё выполняется: {self.jobs.current.message}\nПрервать её и закрыть приложение?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                QMessageBox.StandardButton.No,
+            )
+            if reply != QMessageBox.StandardButton.Yes:
+                event.ignore()
+                return
+        if self.processor.image is None:
+            reply = QMessageBox.question(
+                self,
+                "Подтверждение",
+                "Вы уверены, что хотите закрыть приложение?",
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                QMessageBox.StandardButton.No,
+            )
+        else:
+            # the whole session, history included, can be kept and reopened later
+            reply = QMessageBox.question(
+                self,
+                "Подтверждение",
+                "Сохранить проект перед закрытием?",
+                QMessageBox.StandardButton.Save
+                | QMessageBox.StandardButton.Discard
+                | QMessageBox.StandardButton.Cancel,
+                QMessageBox.StandardButton.Cancel,
+            )
+            if reply == QMessageBox.StandardButton.Save:
+                file_path = self.askProjectPath()
+                if not file_path:
+                    event.ignore()
+                    return
+                self.tasks.cancel()
+                self.tasks.wait()
+                try:
+                    self.processor.save_project(file_path, self.projectSettings())
+                except OSError as error:
+                    QMessageBox.warning(
+                        self,
+                        "Ошибка",
+                        f"Не удалось сохранить проект: {error}",
+                    )
+                    event.ignore()
+                    return
+
+        if reply in (
+            QMessageBox.StandardButton.Yes,
+            QMessageBox.StandardButton.Save,
+            QMessageBox.StandardButton.Discard,
+        ):
+            self.tasks.cancel()
+            self.jobs.cancel()
+            self.tasks.wait()
+            self.jobs.wait()
+            self.thumbnails.close()
+            # saves still in the queue are finished, not lost
+            self.processor.saver.close()
             event.accept()
         else:
             event.ignore()
@@ -0,0 +1,382 @@
+import inspect
+import json
+import math
+import os
+
+import cv2
+import numpy as np
+from tracing import span
+
+
+IDENTITY_LUT = np.arange(256, dtype=np.uint8)
+# kernels up to this size go straight to GaussianBlur, larger ones cost the same whatever their size
+DIRECT_BLUR_LIMIT = 15
+BOX_PASSES = 3
+# above this sigma the image is blurred at a reduced resolution, a level keeps at least PYRAMID_LEVEL_SIGMA
+PYRAMID_BLUR_SIGMA = 32
+PYRAMID_LEVEL_SIGMA = 8
+# the box and pyramid approximations stay at least this close to cv2.GaussianBlur, in dB of PSNR
+BLUR_MIN_PSNR = 45.0
+# in order of increasing quality, a combined transform uses the best one any of its steps asked for
+INTERPOLATIONS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "lanczos": cv2.INTER_LANCZOS4,
+}
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+THICKNESS = 2
+
+
+def layout(image):
+    if image.ndim == 2 or image.shape[2] == 1:
+        return "gray"
+    return "bgra" if image.shape[2] == 4 else "bgr"
+
+
+def to_gray(image):
+    code = {
+        "gray": None,
+        "bgr": cv2.COLOR_BGR2GRAY,
+        "bgra": cv2.COLOR_BGRA2GRAY,
+    }[layout(image)]
+    if code is None:
+        return image.reshape(image.shape[:2])
+    return cv2.cvtColor(image, code)
+
+
+def to_color(image):
+    # only for operations that really put colour into the image, everything else keeps a single channel
+    if layout(image) != "gray":
+        return image
+    return cv2.cvtColor(image.reshape(image.shape[:2]), cv2.COLOR_GRAY2BGR)
+
+
+def canvas(image, color):
+    color = tuple(color)
+    if layout(image) == "gray" and len(set(color)) == 1:
+        return image.copy(), color[:1]
+    return to_color(image).copy(), color
+
+
+def grayscale(image, lut=None):
+    gray_image = to_gray(image)
+    if lut is not None:
+        gray_image = cv2.LUT(gray_image, lut)
+    return gray_image
+
+
+def gaussian_sigma(kernel_size):
+    # the sigma cv2.GaussianBlur derives from the kernel size when none is given
+    return 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+
+
+def box_sizes(sigma, passes=BOX_PASSES):
+    # odd widths whose variances add up to sigma², after Kovesi, "Fast Almost-Gaussian Filtering"
+    ideal = math.sqrt(12 * sigma**2 / passes + 1)
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    upper = lower + 2
+    count = round(
+        (12 * sigma**2 - passes * lower**2 - 4 * passes * lower - 3 * passes)
+        / (-4 * lower - 4),
+    )
+    count = min(max(count, 0), passes)
+    return [lower] * count + [upper] * (passes - count)
+
+
+def box_blur(image, sigma):
+    # cv2.blur keeps running sums, so every pass costs the same whatever the width of the box
+    for size in box_sizes(sigma):
+        image = cv2.blur(image, (size, size))
+    return image
+
+
+def pyramid_factor(sigma):
+    return 2 ** max(0, int(math.log2(sigma / PYRAMID_LEVEL_SIGMA)))
+
+
+def pyramid_blur(image, sigma):
+    (h, w) = image.shape[:2]
+    factor = pyramid_factor(sigma)
+    # padded to whole level pixels, so a crop that starts on a multiple of the factor is reduced the same way
+    padded = cv2.copyMakeBorder(
+        image,
+        0,
+        -h % factor,
+        0,
+        -w % factor,
+        cv2.BORDER_REFLECT_101,
+    )
+    (ph, pw) = padded.shape[:2]
+    small = cv2.resize(
+        padded,
+        (pw // factor, ph // factor),
+        interpolation=cv2.INTER_AREA,
+    )
+    # the averaging on the way down already blurs by about half a level pixel
+    small = box_blur(small, math.sqrt(max(sigma**2 - factor**2 / 4, 1)) / factor)
+    return cv2.resize(small, (pw, ph), interpolation=cv2.INTER_LINEAR)[:h, :w]
+
+
+def blur_strategy(kernel_size):
+    if kernel_size <= DIRECT_BLUR_LIMIT:
+        return "gaussian"
+    return "box" if gaussian_sigma(kernel_size) <= PYRAMID_BLUR_SIGMA else "pyramid"
+
+
+def blur_alignment(kernel_size):
+    # a crop of the image is only reduced the same way as the whole when it starts on a multiple of this
+    kernel_size |= 1
+    if blur_strategy(kernel_size) != "pyramid":
+        return 1
+    return pyramid_factor(gaussian_sigma(kernel_size))
+
+
+def blur(image, kernel_size):
+    if kernel_size % 2 == 0:
+        kernel_size += 1
+    strategy = blur_strategy(kernel_size)
+    if strategy == "gaussian":
+        return cv2.GaussianBlur(image, (kernel_size, kernel_size), 0)
+    sigma = gaussian_sigma(kernel_size)
+    if strategy == "box":
+        return box_blur(image, sigma)
+    return pyramid_blur(image, sigma)
+
+
+def canny(image, threshold1, threshold2):
+    return cv2.Canny(to_gray(image), threshold1, threshold2)
+
+
+def rotation_matrix(size, angle, interpolation="linear", expand=False):
+    (w, h) = size
+    center = (w // 2, h // 2)
+    M = cv2.getRotationMatrix2D(center, angle, 1.0)
+    if expand:
+        # the canvas grows to the bounding box of the rotated image, so no corner is cut off
+        cos, sin = abs(M[0, 0]), abs(M[0, 1])
+        w, h = int(round(h * sin + w * cos)), int(round(h * cos + w * sin))
+        M[0, 2] += w / 2 - center[0]
+        M[1, 2] += h / 2 - center[1]
+    return M, (w, h)
+
+
+def resize_matrix(size, width, height, interpolation="linear"):
+    sx, sy = width / size[0], height / size[1]
+    # pixel centres map onto pixel centres, as in cv2.resize
+    return np.array([[sx, 0, (sx - 1) / 2], [0, sy, (sy - 1) / 2]]), (width, height)
+
+
+def rotate(image, angle, interpolation="linear", expand=False):
+    (h, w) = image.shape[:2]
+    M, size = rotation_matrix((w, h), angle, expand=expand)
+    return cv2.warpAffine(image, M, size, flags=INTERPOLATIONS[interpolation])
+
+
+def resize(image, width, height, interpolation="linear"):
+    return cv2.resize(
+        image,
+        (width, height),
+        interpolation=INTERPOLATIONS[interpolation],
+    )
+
+
+def warp(image, steps):
+    # a chain of rotations and resizes becomes one matrix and the image is resampled only once
+    (h, w) = image.shape[:2]
+    size = (w, h)
+    matrix = np.eye(3)
+    quality = 0
+    for name, params in steps:
+        M, size = GEOMETRY[name](size, **params)
+        matrix = np.vstack([M, (0, 0, 1)]) @ matrix
+        interpolation = params.get("interpolation", "linear")
+        quality = max(quality, list(INTERPOLATIONS).index(interpolation))
+    flags = list(INTERPOLATIONS.values())[quality]
+    with span("warp", "opencv", shape=list(image.shape), steps=len(steps)):
+        return cv2.warpAffine(image, matrix[:2], size, flags=flags)
+
+
+def brightness_contrast_lut(brightness=0, contrast=0):
+    # built with the same kernel as the per-pixel path, so the table is exact rather than an approximation
+    return cv2.convertScaleAbs(
+        IDENTITY_LUT,
+        alpha=(contrast / 127 + 1),
+        beta=brightness,
+    ).ravel()
+
+
+def brightness_contrast(image, brightness=0, contrast=0):
+    if image.dtype != np.uint8:
+        return cv2.convertScaleAbs(
+            image,
+            alpha=(contrast / 127 + 1),
+            beta=brightness,
+        )
+    return cv2.LUT(image, brightness_contrast_lut(brightness, contrast))
+
+
+def draw_text(image, text, x, y, font_scale, color):
+    cv2.putText(image, text, (x, y), FONT, font_scale, color, THICKNESS)
+
+
+def draw_rectangle(image, x, y, w, h, color):
+    cv2.rectangle(image, (x, y), (x + w, y + h), color, THICKNESS)
+
+
+def draw_line(image, x1, y1, x2, y2, color):
+    cv2.line(image, (x1, y1), (x2, y2), color, THICKNESS)
+
+
+def draw_circle(image, center_x, center_y, radius, color):
+    cv2.circle(image, (center_x, center_y), radius, color, THICKNESS)
+
+
+def text(image, text, x, y, font_scale, color):
+    image, color = canvas(image, color)
+    draw_text(image, text, x, y, font_scale, color)
+    return image
+
+
+def rectangle(image, x, y, w, h, color):
+    image, color = canvas(image, color)
+    draw_rectangle(image, x, y, w, h, color)
+    return image
+
+
+def line(image, x1, y1, x2, y2, color):
+    image, color = canvas(image, color)
+    draw_line(image, x1, y1, x2, y2, color)
+    return image
+
+
+def circle(image, center_x, center_y, radius, color):
+    image, color = canvas(image, color)
+    draw_circle(image, center_x, center_y, radius, color)
+    return image
+
+
+OPERATIONS = {
+    "grayscale": grayscale,
+    "blur": blur,
+    "canny": canny,
+    "rotate": rotate,
+    "resize": resize,
+    "brightness_contrast": brightness_contrast,
+    "text": text,
+    "rectangle": rectangle,
+    "line": line,
+    "circle": circle,
+}
+
+# drawn in place, for callers that already own a writable canvas
+DRAWINGS = {
+    "text": draw_text,
+    "rectangle": draw_rectangle,
+    "line": draw_line,
+    "circle": draw_circle,
+}
+
+GEOMETRY = {
+    "rotate": rotation_matrix,
+    "resize": resize_matrix,
+}
+
+POINT_OPERATIONS = {
+    "brightness_contrast": brightness_contrast_lut,
+}
+
+
+def apply(image, name, params):
+    with span(name, "opencv", shape=list(image.shape)):
+        return OPERATIONS[name](image, **params)
+
+
+def fuse_pipeline(steps, luts=True):
+    fused = []
+    pending = None
+    for name, params in steps:
+        if (
+            name in GEOMETRY
+            and pending is None
+            and fused
+            and fused[-1][0] in (*GEOMETRY, "warp")
+        ):
+            # consecutive rotations and resizes are merged, a single one keeps its own faster path
+            run = fused.pop()
+            run = run[1]["steps"] if run[0] == "warp" else [run]
+            fused.append(("warp", {"steps": run + [(name, params)]}))
+            continue
+        if luts and name in POINT_OPERATIONS:
+            table = POINT_OPERATIONS[name](**params)
+            pending = table if pending is None else table[pending]
+            continue
+        if pending is not None:
+            fused.append(("lut", {"lut": pending}))
+            pending = None
+        fused.append((name, params))
+    if pending is not None:
+        fused.append(("lut", {"lut": pending}))
+
+    # a table after grayscale is folded into that step and runs on the gray image right after conversion
+    merged = []
+    for name, params in fused:
+        if (
+            name == "lut"
+            and merged
+            and merged[-1][0] == "grayscale"
+            and "lut" not in merged[-1][1]
+        ):
+            merged[-1] = ("grayscale", {"lut": params["lut"]})
+        else:
+            merged.append((name, params))
+    return merged
+
+
+def run_pipeline(image, steps):
+    # a lookup table covers 8-bit values only, other depths run every point operation on its own
+    for name, params in fuse_pipeline(steps, luts=image.dtype == np.uint8):
+        if name == "warp":
+            image = warp(image, params["steps"])
+        elif name != "lut":
+            image = apply(image, name, params)
+        else:
+            with span("lut", "opencv", shape=list(image.shape)):
+                image = cv2.LUT(image, params["lut"])
+    return image
+
+
+def parse_pipeline(spec):
+    if isinstance(spec, str):
+        if os.path.isfile(spec):
+            with open(spec, encoding="utf-8") as file:
+                spec = json.load(file)
+        else:
+            spec = json.loads(spec)
+
+    steps = []
+    for step in spec:
+        params = dict(step)
+        name = params.pop("op", None)
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {name}")
+        check_step(name, params)
+        steps.append((name, params))
+    return steps
+
+
+def check_step(name, params):
+    # a misspelt parameter or value is reported once, before any image is read, instead of failing every file
+    try:
+        inspect.signature(OPERATIONS[name]).bind(None, **params)
+    except TypeError as error:
+        raise ValueError(f"Invalid parameters for {name}: {error}") from None
+    interpolation = params.get("interpolation", "linear")
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f"Unknown interpolation: {interpolation}")
+
+
+def format_pipeline(steps):
+    return [{"op": name, **params} for name, params in steps]
@@ -0,0 +1,177 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+import operations
+import tiles
+from tracing import span
+
+
+# strip borders and halos are rounded to whole blocks, so the reduced copies of a pyramid blur line up
+ALIGNMENT = 64
+# smaller strips would spend more time on their halo than on their own rows
+STRIP_ROWS = 256
+# Canny in strips does about three times the serial work of a single call, it only pays off from this many cores
+CANNY_STRIP_WORKERS = 4
+
+
+# OpenCV has one thread count for the whole process. Holders asking for the same count share it, the first one
+# saves the previous count and the last one restores it; a holder asking for another count waits until they are
+# done rather than changing it under them, and while it waits no new holder joins, so it is not starved.
+# Code that runs OpenCV without holding it, e.g. a video export or the service in the same process, still sees
+# whatever count the current holders set.
+_threads_changed = threading.Condition()
+_threads_holders = 0
+_threads_waiting = 0
+_threads_count = None
+_threads_previous = None
+
+
+@contextmanager
+def opencv_threads(count):
+    global _threads_holders, _threads_waiting, _threads_count, _threads_previous
+    if count is None:
+        # nothing to set, the pipeline runs with the count in effect
+        yield cv2.getNumThreads()
+        return
+    with _threads_changed:
+        if _threads_holders and (_threads_count != count or _threads_waiting):
+            _threads_waiting += 1
+            while _threads_holders:
+                _threads_changed.wait()
+            _threads_waiting -= 1
+        if _threads_holders == 0:
+            _threads_previous = cv2.getNumThreads()
+            _threads_count = count
+            cv2.setNumThreads(count)
+        _threads_holders += 1
+        previous = _threads_previous
+    try:
+        yield previous
+    finally:
+        with _threads_changed:
+            _threads_holders -= 1
+            if _threads_holders == 0:
+                cv2.setNumThreads(_threads_previous)
+                _threads_changed.notify_all()
+
+
+def strips(height, workers, halo, alignment=ALIGNMENT):
+    # twice as many strips as workers, so a slow strip does not leave the other cores idle at the end
+    rows = max(STRIP_ROWS, -(-height // (workers * 2)))
+    alignment = max(alignment, ALIGNMENT)
+    rows = tiles.align(rows, alignment)
+    halo = tiles.align(halo, alignment)
+    return [
+        (y, min(y + rows, height), max(y - halo, 0), min(y + rows + halo, height))
+        for y in range(0, height, rows)
+    ]
+
+
+def map_strips(image, function, parts, workers):
+    def run(part):
+        y, y_end, y0, y1 = part
+        with span("strip", "parallel", y=y, rows=y_end - y):
+            result = function(image[y0:y1])
+        top = y - y0
+        bottom = top + y_end - y
+        return y, y_end, result[top:bottom]
+
+    target = None
+    # every strip is already processed in parallel, OpenCV's own threads would only compete with the pool;
+    # a concurrent whole-image step waits for the strips, OpenCV calls outside this module run single-threaded
+    with opencv_threads(1), ThreadPoolExecutor(max_workers=workers) as executor:
+        for y, y_end, result in executor.map(run, parts):
+            if target is None:
+                target = np.empty(
+                    (image.shape[0],) + result.shape[1:],
+                    result.dtype,
+                )
+            target[y:y_end] = result
+    return target
+
+
+def canny(image, threshold1, threshold2, workers):
+    parts = strips(image.shape[0], workers, tiles.CANNY_HALO)
+    edges = map_strips(
+        image,
+        lambda strip: tiles.edge_classes(strip, threshold1, threshold2),
+        parts,
+        workers,
+    )
+    # hysteresis follows edges across the whole image: components are found per strip
+    # and joined at the borders, then every strip keeps the ones that reach a strong pixel
+    rows = [edges[y:y_end] for y, y_end, _, _ in parts]
+    with opencv_threads(1), ThreadPoolExecutor(max_workers=workers) as executor:
+        labelled = list(executor.map(tiles.label_edges, rows))
+        strong = [part for _, part in labelled]
+        offsets = tiles.label_offsets(strong)
+        seams = [
+            (
+                tiles.seam(labelled[index][0][-1], offsets[index]),
+                tiles.seam(labelled[index + 1][0][0], offsets[index + 1]),
+            )
+            for index in range(len(labelled) - 1)
+        ]
+        with span("hysteresis", "parallel", strips=len(parts)):
+            luts = tiles.link_labels(strong, seams)
+        for (y, y_end, _, _), result in zip(
+            parts,
+            executor.map(
+                lambda lut, labels: lut[labels],
+                luts,
+                [labels for labels, _ in labelled],
+            ),
+        ):
+            edges[y:y_end] = result
+    return edges
+
+
+def segments(steps):
+    # consecutive local operations share one pass over the strips, the rest runs on the whole image
+    segment_kind, segment = None, []
+    for name, params in steps:
+        if name == "canny":
+            kind = "canny"
+        elif name in tiles.HALOS:
+            kind = "strips"
+        else:
+            kind = "whole"
+        if segment and (kind != segment_kind or kind == "canny"):
+            yield segment_kind, segment
+            segment = []
+        segment_kind = kind
+        segment.append((name, params))
+    if segment:
+        yield segment_kind, segment
+
+
+def run_pipeline(image, steps, workers=None, threads=None):
+    workers = workers or os.cpu_count()
+    if workers <= 1 or image.shape[0] < 2 * STRIP_ROWS:
+        # without threads the count is left alone, so a small image may run on the single thread strips set
+        with opencv_threads(threads):
+            return operations.run_pipeline(image, steps)
+
+    for kind, segment in segments(steps):
+        if kind == "strips":
+            image = map_strips(
+                image,
+                lambda strip, segment=segment: operations.run_pipeline(strip, segment),
+                strips(
+                    image.shape[0],
+                    workers,
+                    tiles.pipeline_halo(segment),
+                    tiles.pipeline_alignment(segment),
+                ),
+                workers,
+            )
+        elif kind == "canny" and workers >= CANNY_STRIP_WORKERS:
+            image = canny(image, workers=workers, **segment[0][1])
+        else:
+            with opencv_threads(threads or workers):
+                image = operations.run_pipeline(image, segment)
+    return image
@@ -0,0 +1,283 @@
+import argparse
+import json
+import struct
+import sys
+import time
+import zipfile
+from concurrent.futures import CancelledError
+
+import numpy as np
+import operations
+import saving
+from history import (
+    History,
+    HistoryEntry,
+)
+from recipe import Recipe
+from tracing import traced
+
+
+FORMAT_VERSION = 1
+EXTENSION = ".imgproj"
+MANIFEST = "manifest.json"
+CURRENT = "current"
+# the fixed part of a zip local file header, the file name and the extra field follow it
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+
+def chunk_name(index):
+    return f"history/{index:08d}"
+
+
+def lazy_state(history, index):
+    state = []
+
+    def load():
+        if not state:
+            state.append(history.get(index))
+        return state[0]
+
+    return load
+
+
+def log_delta(previous, current):
+    # consecutive entries share most of their operation log, only what changed after the common prefix is stored
+    keep = 0
+    for old, new in zip(previous, current):
+        if old != new:
+            break
+        keep += 1
+    return {"keep": keep, "add": operations.format_pipeline(current[keep:])}
+
+
+def apply_log_delta(previous, delta):
+    keep = delta["keep"]
+    # JSON has no tuples, colours come back as lists and would no longer compare equal to the ones in memory
+    added = tuple(
+        (
+            name,
+            {
+                key: tuple(value) if isinstance(value, list) else value
+                for key, value in params.items()
+            },
+        )
+        for name, params in operations.parse_pipeline(delta["add"])
+    )
+    return tuple(previous[:keep]) + added
+
+
+def chunk_offsets(file):
+    # chunks are stored uncompressed, so each one is a plain byte range of the file and can be mapped directly
+    offsets = {}
+    with zipfile.ZipFile(file) as archive:
+        for info in archive.infolist():
+            file.seek(info.header_offset)
+            header = LOCAL_HEADER.unpack(file.read(LOCAL_HEADER.size))
+            offsets[info.filename] = (
+                info.header_offset + LOCAL_HEADER.size + header[-2] + header[-1]
+            )
+    return offsets
+
+
+def describe(entry):
+    return {
+        "keyframe": entry.keyframe,
+        "shape": list(entry.shape),
+        "dtype": entry.dtype.str,
+        # delta tiles are placed from np.argwhere, their coordinates are numpy integers that JSON does not take
+        "tiles": [[int(value) for value in tile] for tile in entry.tiles],
+        "nbytes": entry.nbytes,
+    }
+
+
+@traced("project")
+def capture(processor, settings=None):
+    # taken on the GUI thread, entries never change once encoded, so the file can be written from a worker
+    history = processor.history
+    source, steps = processor.recipe.snapshot()
+    return {
+        "history": history,
+        "entries": list(history.entries),
+        "index": history.index,
+        "image": processor.image,
+        "in_history": history.is_state(history.index, processor.image),
+        "source": source,
+        "steps": steps,
+        "annotations": processor.annotations,
+        "settings": settings or {},
+    }
+
+
+@traced("project")
+def save_project(file_path, captured, progress=None, cancelled=None):
+    start = time.perf_counter()
+    history = captured["history"]
+    entries = captured["entries"]
+
+    # a source is the state pushed when the image was opened, so it is stored as the index of that entry
+    sources = {}
+    for index, entry in enumerate(entries):
+        sources.setdefault(id(entry.meta[0][0]), index)
+
+    records = []
+    steps, annotations = (), ()
+    for index, entry in enumerate(entries):
+        (source, entry_steps), entry_annotations = entry.meta
+        records.append(
+            {
+                **describe(entry),
+                "chunk": chunk_name(index),
+                "source": sources.get(id(source)),
+                "steps": log_delta(steps, entry_steps),
+                "annotations": log_delta(annotations, entry_annotations),
+            },
+        )
+        steps, annotations = entry_steps, entry_annotations
+
+    # the current state is stored whole, so opening a project shows it without replaying any deltas
+    current = history.encode_state(captured["image"])
+    if 0 <= captured["index"] < len(entries):
+        (_, steps), annotations = entries[captured["index"]].meta
+    manifest = {
+        "version": FORMAT_VERSION,
+        "history": {
+            "tile_size": history.tile_size,
+            "compression": history.compression,
+            "keyframe_interval": history.keyframe_interval,
+            "keyframe_ratio": history.keyframe_ratio,
+        },
+        "index": captured["index"],
+        "entries": records,
+        "current": {
+            **describe(current),
+            "chunk": CURRENT,
+            "in_history": captured["in_history"],
+            "source": sources.get(id(captured["source"])),
+            "steps": log_delta(steps, captured["steps"]),
+            "annotations": log_delta(annotations, captured["annotations"]),
+        },
+        "settings": captured["settings"],
+    }
+
+    with saving.replacing(file_path, ".project-", EXTENSION) as temporary:
+        # payloads are compressed already, deflating them again would only cost time
+        with zipfile.ZipFile(temporary, "w", zipfile.ZIP_STORED) as archive:
+            archive.writestr(MANIFEST, json.dumps(manifest, ensure_ascii=False))
+            archive.writestr(CURRENT, bytes(current.payload))
+            for index, entry in enumerate(entries):
+                if cancelled is not None and cancelled():
+                    raise CancelledError()
+                with archive.open(chunk_name(index), "w", force_zip64=True) as chunk:
+                    chunk.write(history.read_payload(entry))
+                if progress is not None:
+                    progress((index + 1) / len(entries))
+        # mapped before the rename, so the mapping is of this very file whatever later happens at its path
+        with open(temporary, "rb") as file:
+            offsets = chunk_offsets(file)
+            mapping = np.memmap(file, dtype=np.uint8, mode="r")
+    return {
+        "path": file_path,
+        "bytes": mapping.size,
+        "entries": len(entries),
+        "seconds": time.perf_counter() - start,
+        "mapping": mapping,
+        "offsets": {
+            entry: offsets[chunk_name(index)] for index, entry in enumerate(entries)
+        },
+    }
+
+
+@traced("project")
+def load_project(file_path, history_budget=None):
+    # opened once, a save over the same path meanwhile cannot mix the manifest of one file with chunks of another
+    with open(file_path, "rb") as file:
+        with zipfile.ZipFile(file) as archive:
+            manifest = json.loads(archive.read(MANIFEST))
+            if manifest.get("version") != FORMAT_VERSION:
+                raise ValueError(
+                    f"Unsupported project version: {manifest.get('version')}",
+                )
+            current_payload = archive.read(CURRENT)
+        offsets = chunk_offsets(file)
+        mapping = np.memmap(file, dtype=np.uint8, mode="r")
+
+    history = History(**manifest["history"], ram_budget=history_budget)
+    loaders = {}
+
+    def source(index):
+        # one loader per source, so every snapshot that shares a source still shares it after loading
+        if index is None:
+            return None
+        if index not in loaders:
+            loaders[index] = lazy_state(history, index)
+        return loaders[index]
+
+    entries = []
+    steps, annotations = (), ()
+    for record in manifest["entries"]:
+        entry = HistoryEntry(
+            record["keyframe"],
+            tuple(record["shape"]),
+            np.dtype(record["dtype"]),
+            [tuple(tile) for tile in record["tiles"]],
+            None,
+            nbytes=record["nbytes"],
+        )
+        # nothing is read yet, the payload is paged in from the project file when a state needs it
+        entry.chunk = (mapping, offsets[record["chunk"]])
+        steps = apply_log_delta(steps, record["steps"])
+        annotations = apply_log_delta(annotations, record["annotations"])
+        entry.meta = ((source(record["source"]), steps), annotations)
+        entries.append(entry)
+
+    current = manifest["current"]
+    image = history.decode_state(
+        HistoryEntry(
+            True,
+            tuple(current["shape"]),
+            np.dtype(current["dtype"]),
+            [tuple(tile) for tile in current["tiles"]],
+            current_payload,
+        ),
+    )
+    index = manifest["index"]
+    if 0 <= index < len(entries):
+        (_, steps), annotations = entries[index].meta
+    history.restore(entries, index, image if current["in_history"] else None)
+    return {
+        "history": history,
+        "image": image,
+        "recipe": Recipe(
+            source(current["source"]),
+            apply_log_delta(steps, current["steps"]),
+        ),
+        "annotations": apply_log_delta(annotations, current["annotations"]),
+        "settings": manifest["settings"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сведения о файле проекта")
+    parser.add_argument("project", help=f"Файл проекта ({EXTENSION})")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        loaded = load_project(args.project)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as error:
+        print(f"Ошибка: {error}", file=sys.stderr)
+        return 1
+    seconds = time.perf_counter() - start
+    history = loaded["history"]
+    print(
+        f"Открыт за {seconds * 1000:.0f} мс: {loaded['image'].shape[1]}x{loaded['image'].shape[0]}, "
+        f"шагов истории: {len(history)} (текущий {history.index + 1}), "
+        f"шагов рецепта: {len(loaded['recipe'])}, фигур: {len(loaded['annotations'])}, "
+        f"история: {history.nbytes / 1e6:.1f} МБ, несжатая {history.raw_nbytes / 1e6:.1f} МБ",
+    )
+    history.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import json
+from collections import OrderedDict
+
+import operations
+
+
+# intermediate results are full frames, so the cache is bounded by their size and not only by their number
+CACHE_BUDGET = 256 * 1024 * 1024
+
+
+class Recipe:
+    def __init__(self, source=None, steps=(), cache_size=8, cache_budget=CACHE_BUDGET):
+        self._source = source
+        self.steps = list(steps)
+        self.cache_size = cache_size
+        self.cache_budget = cache_budget
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+
+    @property
+    def source(self):
+        # a project restores the source as a loader, it is only decoded when a replay starts from it;
+        # the loader stays in place, so snapshots taken before and after still compare as the same source
+        return self._source() if callable(self._source) else self._source
+
+    def load_source(self):
+        # a lazy source reads the history, which only the GUI thread may do, so workers get it decoded already
+        return self.source
+
+    def __len__(self):
+        return len(self.steps)
+
+    @classmethod
+    def load(cls, path):
+        return cls(steps=operations.parse_pipeline(path))
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(
+                operations.format_pipeline(self.steps),
+                file,
+                ensure_ascii=False,
+                indent=4,
+            )
+
+    def copy(self):
+        recipe = Recipe(self._source, self.steps, self.cache_size, self.cache_budget)
+        recipe._cache = OrderedDict(self._cache)
+        recipe._cache_nbytes = self._cache_nbytes
+        return recipe
+
+    def snapshot(self):
+        return self._source, tuple(self.steps)
+
+    def restore(self, snapshot):
+        source, steps = snapshot
+        if source is not self._source:
+            self._source = source
+            self._cache.clear()
+            self._cache_nbytes = 0
+        self.steps = list(steps)
+
+    def append(self, name, params, result=None):
+        self.steps.append((name, dict(params)))
+        if result is not None:
+            self._store(len(self.steps), result)
+
+    def extend(self, steps, result=None):
+        self.steps.extend((name, dict(params)) for name, params in steps)
+        if result is not None:
+            self._store(len(self.steps), result)
+
+    def edit(self, index, **params):
+        name, old_params = self.steps[index]
+        # a new dict, so snapshots taken before the edit keep the old parameters
+        self.steps[index] = (name, {**old_params, **params})
+
+    def result(self, count=None):
+        count = len(self.steps) if count is None else count
+        start = count
+        while start > 0 and self._key(start) not in self._cache:
+            start -= 1
+        image = self._cache[self._key(start)] if start else self.source
+        if start:
+            self._cache.move_to_end(self._key(start))
+        for index in range(start, count):
+            name, params = self.steps[index]
+            run = self._geometry_start(index) if name in operations.GEOMETRY else index
+            if run < index:
+                # the whole run of rotations and resizes is resampled once from the image it started on
+                stop = index + 1
+                image = operations.warp(self.result(run), self.steps[run:stop])
+            else:
+                image = operations.apply(image, name, params)
+            self._store(index + 1, image)
+        return image
+
+    def _geometry_start(self, index):
+        while index > 0 and self.steps[index - 1][0] in operations.GEOMETRY:
+            index -= 1
+        return index
+
+    def replay(self, image):
+        return operations.run_pipeline(image, self.steps)
+
+    def _key(self, count):
+        return tuple(
+            (name, json.dumps(params, sort_keys=True))
+            for name, params in self.steps[:count]
+        )
+
+    @property
+    def cache_nbytes(self):
+        return self._cache_nbytes
+
+    def _store(self, count, image):
+        key = self._key(count)
+        if key in self._cache:
+            self._cache_nbytes -= self._cache.pop(key).nbytes
+        self._cache[key] = image
+        self._cache_nbytes += image.nbytes
+        # the newest result stays even when it alone is over the budget, the next step starts from it
+        while len(self._cache) > 1 and (
+            len(self._cache) > self.cache_size
+            or self.cache_budget is not None
+            and self._cache_nbytes > self.cache_budget
+        ):
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_nbytes -= evicted.nbytes
@@ -0,0 +1,137 @@
+import os
+import queue
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import annotations
+import cv2
+from tracing import span
+
+
+DEFAULT_OPTIONS = {
+    "png_compression": 3,
+    "jpeg_quality": 95,
+    "jpeg_progressive": False,
+    "webp_quality": 90,
+}
+
+
+def encode_params(extension, options=None):
+    options = {**DEFAULT_OPTIONS, **(options or {})}
+    extension = extension.lower()
+    if extension == ".png":
+        # levels above 3 mostly buy a few percent of size for several times the encode time
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(options["png_compression"])]
+    if extension in (".jpg", ".jpeg"):
+        return [
+            cv2.IMWRITE_JPEG_QUALITY,
+            int(options["jpeg_quality"]),
+            cv2.IMWRITE_JPEG_PROGRESSIVE,
+            int(bool(options["jpeg_progressive"])),
+        ]
+    if extension == ".webp":
+        # a quality above 100 selects lossless WebP
+        return [cv2.IMWRITE_WEBP_QUALITY, int(options["webp_quality"])]
+    return []
+
+
+@contextmanager
+def replacing(file_path, prefix, suffix):
+    # the old file stays intact until the new one is complete, a crash never leaves half a file behind
+    directory = os.path.dirname(os.path.abspath(file_path))
+    descriptor, temporary = tempfile.mkstemp(
+        prefix=prefix,
+        suffix=suffix,
+        dir=directory,
+    )
+    os.close(descriptor)
+    try:
+        yield temporary
+        # mkstemp creates the file private to the owner, an overwritten file keeps its own permissions
+        mode = (
+            stat.S_IMODE(os.stat(file_path).st_mode)
+            if os.path.exists(file_path)
+            else 0o644
+        )
+        os.chmod(temporary, mode)
+        os.replace(temporary, file_path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def write_image(file_path, image, options=None):
+    extension = os.path.splitext(file_path)[1] or ".png"
+    start = time.perf_counter()
+    with span("encode", "io", format=extension):
+        ok, encoded = cv2.imencode(extension, image, encode_params(extension, options))
+    if not ok:
+        raise ValueError(f"Cannot encode image as {extension}")
+    encode_seconds = time.perf_counter() - start
+
+    with replacing(file_path, ".saving-", extension) as temporary:
+        with span("write", "io", path=file_path, bytes=encoded.nbytes):
+            with open(temporary, "wb") as file:
+                file.write(encoded.data)
+    return {
+        "path": file_path,
+        "bytes": encoded.nbytes,
+        "encode_seconds": encode_seconds,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+class SaveQueue:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="saving", daemon=True)
+        self._thread.start()
+
+    def submit(self, file_path, image, options=None, layer=()):
+        # the image must not change afterwards, history states are read-only so they can be queued as they are
+        future = Future()
+        key = os.path.abspath(file_path)
+        with self._lock:
+            self._latest[key] = future
+        self._queue.put(
+            (key, file_path, image, dict(options or {}), tuple(layer), future),
+        )
+        return future
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, file_path, image, options, layer, future = item
+            with self._lock:
+                superseded = self._latest.get(key) is not future
+                if not superseded:
+                    del self._latest[key]
+            if superseded:
+                # a newer save to the same file is queued behind this one, writing this one is wasted work
+                future.cancel()
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if layer:
+                    # annotations are burned in here, off the GUI thread
+                    image = annotations.render(image, layer)
+                future.set_result(write_image(file_path, image, options))
+            except Exception as error:
+                future.set_exception(error)
+
+    def close(self, wait=True):
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
@@ -0,0 +1,556 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import (
+    deque,
+    OrderedDict,
+)
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+)
+from http import HTTPStatus
+from http.client import HTTPConnection
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+from urllib.parse import (
+    parse_qsl,
+    urlencode,
+    urlsplit,
+)
+
+import cv2
+import faces
+import numpy as np
+import operations
+from tracing import span
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_BATCH = 16
+# extra time the first request of a batch may wait for others, by default batches only form while all workers are busy
+MAX_DELAY = 0.0
+LATENCY_WINDOW = 4096
+PERCENTILES = (50, 90, 99)
+# these work pixel by pixel, so inputs of the same size can be stacked and processed in a single call
+STACKABLE = ("grayscale", "lut")
+# past this size the copy into one stacked array costs more than the calls it saves
+STACK_PIXELS = 1 << 17
+RAW_TYPE = "application/octet-stream"
+
+
+class Request:
+    def __init__(self, kind, image, steps=(), fast=False):
+        self.kind = kind
+        self.image = image
+        self.steps = list(steps)
+        self.fast = fast
+        if kind == "faces":
+            self.key = (kind, fast)
+            self.label = kind
+        else:
+            pipeline = json.dumps(
+                operations.format_pipeline(self.steps),
+                sort_keys=True,
+            )
+            self.key = (kind, pipeline, image.shape, image.dtype.str)
+            self.label = "+".join(name for name, _ in self.steps) or "identity"
+        self.future = Future()
+        self.received = time.perf_counter()
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    values = np.asarray(samples) * 1000
+    report = {
+        f"p{percentile}": float(value)
+        for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES))
+    }
+    report["max"] = float(values.max())
+    return report
+
+
+class LatencyStats:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        # only the most recent requests count, so the percentiles follow the current load
+        self.latency = deque(maxlen=window)
+        self.waiting = deque(maxlen=window)
+
+    def record(self, batch, started, finished, errors):
+        self.requests += len(batch)
+        self.errors += errors
+        self.batches += 1
+        for request in batch:
+            self.latency.append(finished - request.received)
+            self.waiting.append(started - request.received)
+
+    def report(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch": self.requests / self.batches if self.batches else 0.0,
+            "latency_ms": percentiles(self.latency),
+            "queue_ms": percentiles(self.waiting),
+        }
+
+
+def run_pipelines(batch):
+    steps = batch[0].steps
+    image = batch[0].image
+    if (
+        len(batch) > 1
+        and image.shape[0] * image.shape[1] <= STACK_PIXELS
+        and all(
+            name in STACKABLE
+            for name, _ in operations.fuse_pipeline(steps, luts=image.dtype == np.uint8)
+        )
+    ):
+        stacked = operations.run_pipeline(
+            np.concatenate([request.image for request in batch]),
+            steps,
+        )
+        return np.split(stacked, len(batch))
+    return [operations.run_pipeline(request.image, steps) for request in batch]
+
+
+def run_faces(batch):
+    return [
+        [
+            [int(value) for value in box]
+            for box in faces.detect_faces(request.image, fast=request.fast)
+        ]
+        for request in batch
+    ]
+
+
+RUNNERS = {
+    "pipeline": run_pipelines,
+    "faces": run_faces,
+}
+
+
+class Service:
+    def __init__(self, workers=None, max_batch=MAX_BATCH, max_delay=MAX_DELAY):
+        self.workers = workers or os.cpu_count()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="service",
+        )
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.queued = 0
+        self.running = 0
+        self.busy = 0
+        self.stats = {}
+        self.closed = False
+        self.started = time.perf_counter()
+        self.dispatcher = threading.Thread(
+            target=self._dispatch,
+            name="service-dispatch",
+            daemon=True,
+        )
+        self.dispatcher.start()
+
+    def submit(self, request):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Service is closed")
+            self.pending.setdefault(request.key, []).append(request)
+            self.queued += 1
+            self.condition.notify()
+        return request.future
+
+    def process(self, image, steps):
+        return self.submit(Request("pipeline", image, steps)).result()
+
+    def detect_faces(self, image, fast=False):
+        return self.submit(Request("faces", image, fast=fast)).result()
+
+    def report(self):
+        with self.condition:
+            return {
+                "uptime_seconds": time.perf_counter() - self.started,
+                "workers": self.workers,
+                "max_batch": self.max_batch,
+                "max_delay_ms": self.max_delay * 1000,
+                "queue_depth": self.queued,
+                "in_flight": self.running,
+                "operations": {
+                    label: stats.report() for label, stats in self.stats.items()
+                },
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+
+    def _ready(self, now):
+        # the oldest batch goes first once it is full or has waited long enough, the rest keeps collecting
+        timeout = None
+        for key, batch in self.pending.items():
+            deadline = batch[0].received + self.max_delay
+            if len(batch) >= self.max_batch or deadline <= now or self.closed:
+                return key, None
+            timeout = (
+                deadline - now if timeout is None else min(timeout, deadline - now)
+            )
+        return None, timeout
+
+    def _dispatch(self):
+        with self.condition:
+            while True:
+                if self.closed and not self.pending:
+                    return
+                key, timeout = None, None
+                # requests stay here while every worker is busy, which is when batches grow by themselves
+                if self.busy < self.workers:
+                    key, timeout = self._ready(time.perf_counter())
+                if key is None:
+                    self.condition.wait(timeout)
+                    continue
+                batch = self.pending.pop(key)
+                if len(batch) > self.max_batch:
+                    size = self.max_batch
+                    batch, rest = batch[:size], batch[size:]
+                    self.pending[key] = rest
+                    self.pending.move_to_end(key, last=False)
+                self.queued -= len(batch)
+                self.running += len(batch)
+                self.busy += 1
+                self.executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        started = time.perf_counter()
+        errors = 0
+        try:
+            with span("batch", "service", operation=batch[0].label, size=len(batch)):
+                try:
+                    results = RUNNERS[batch[0].kind](batch)
+                except Exception:
+                    # one bad input must not fail the requests it happened to be batched with
+                    results = None
+            for index, request in enumerate(batch):
+                try:
+                    result = (
+                        results[index]
+                        if results is not None
+                        else RUNNERS[request.kind]([request])[0]
+                    )
+                except Exception as error:
+                    errors += 1
+                    request.future.set_exception(error)
+                else:
+                    request.future.set_result(result)
+        finally:
+            finished = time.perf_counter()
+            with self.condition:
+                self.running -= len(batch)
+                self.busy -= 1
+                self.stats.setdefault(batch[0].label, LatencyStats()).record(
+                    batch,
+                    started,
+                    finished,
+                    errors,
+                )
+                self.condition.notify()
+
+
+def parse_value(value):
+    # numbers and lists come as JSON, anything that is not valid JSON is a plain string such as a text to draw
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def decode_body(body, headers):
+    content_type = headers.get("Content-Type", RAW_TYPE)
+    if content_type == RAW_TYPE:
+        # raw pixels are used as they are, without an encode and decode on either side
+        shape = (int(headers["X-Height"]), int(headers["X-Width"]))
+        channels = int(headers.get("X-Channels", 1))
+        if channels > 1:
+            shape += (channels,)
+        return np.frombuffer(
+            body,
+            dtype=np.dtype(headers.get("X-Dtype", "uint8")),
+        ).reshape(shape)
+    image = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_ANYCOLOR)
+    if image is None:
+        raise ValueError(f"Cannot decode image of type {content_type}")
+    return image
+
+
+def raw_headers(image):
+    return {
+        "Content-Type": RAW_TYPE,
+        "X-Width": str(image.shape[1]),
+        "X-Height": str(image.shape[0]),
+        "X-Channels": str(image.shape[2] if image.ndim == 3 else 1),
+        "X-Dtype": image.dtype.str,
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/stats":
+            self.send_json(self.service.report())
+        elif path == "/operations":
+            self.send_json(
+                {"operations": [*operations.OPERATIONS, "pipeline", "faces"]},
+            )
+        else:
+            self.send_json({"error": f"Unknown path: {path}"}, HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        name = url.path.strip("/")
+        query = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length", 0))
+        # read straight into a writable buffer, the array is a view on it
+        body = bytearray(length)
+        self.rfile.readinto(memoryview(body))
+        try:
+            image = decode_body(body, self.headers)
+            if name == "faces":
+                boxes = self.service.detect_faces(
+                    image,
+                    fast=parse_value(query.get("fast", "false")),
+                )
+                self.send_json({"faces": boxes})
+                return
+            if name == "pipeline":
+                steps = operations.parse_pipeline(query.get("steps", "[]"))
+            elif name in operations.OPERATIONS:
+                steps = [
+                    (name, {key: parse_value(value) for key, value in query.items()}),
+                ]
+            else:
+                self.send_json(
+                    {"error": f"Unknown operation: {name}"},
+                    HTTPStatus.NOT_FOUND,
+                )
+                return
+            result = self.service.process(image, steps)
+        except (KeyError, TypeError, ValueError, cv2.error) as error:
+            self.send_json({"error": str(error)}, HTTPStatus.BAD_REQUEST)
+            return
+        self.send_image(result)
+
+    def send_json(self, data, status=HTTPStatus.OK):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_image(self, image):
+        accept = self.headers.get("Accept", RAW_TYPE)
+        if accept.startswith("image/"):
+            extension = "." + accept.split("/", 1)[1].split(";")[0]
+            ok, encoded = cv2.imencode(extension, image)
+            if not ok:
+                self.send_json(
+                    {"error": f"Cannot encode image as {extension}"},
+                    HTTPStatus.NOT_ACCEPTABLE,
+                )
+                return
+            headers, body = {"Content-Type": accept}, encoded.data
+        else:
+            image = np.ascontiguousarray(image)
+            headers, body = raw_headers(image), memoryview(image).cast("B")
+        self.send_response(HTTPStatus.OK)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(body.nbytes))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # one line per request would cost more than the small requests themselves
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def create_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    handler = type("ServiceHandler", (Handler,), {"service": service})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        return UnixHTTPServer(socket_path, handler)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class Client:
+    def __init__(
+        self,
+        host=DEFAULT_HOST,
+        port=DEFAULT_PORT,
+        socket_path=None,
+        timeout=None,
+    ):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+        # one kept-alive connection per thread, a new TCP handshake per request would dominate small images
+        self._local = threading.local()
+
+    def connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self.socket_path is not None:
+                connection = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+            else:
+                connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def request(self, method, path, image=None):
+        connection = self.connection()
+        if image is None:
+            connection.request(method, path)
+        else:
+            image = np.ascontiguousarray(image)
+            connection.request(
+                method,
+                path,
+                memoryview(image).cast("B"),
+                raw_headers(image),
+            )
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != HTTPStatus.OK:
+            raise ValueError(json.loads(body)["error"])
+        if response.getheader("Content-Type") == RAW_TYPE:
+            return decode_body(bytearray(body), response.headers)
+        return json.loads(body)
+
+    def apply(self, image, name, **params):
+        query = urlencode({key: json.dumps(value) for key, value in params.items()})
+        return self.request("POST", f"/{name}?{query}", image)
+
+    def process(self, image, steps):
+        query = urlencode({"steps": json.dumps(operations.format_pipeline(steps))})
+        return self.request("POST", f"/pipeline?{query}", image)
+
+    def detect_faces(self, image, fast=False):
+        return self.request("POST", f"/faces?fast={json.dumps(fast)}", image)["faces"]
+
+    def stats(self):
+        return self.request("GET", "/stats")
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Локальный сервис обработки изображений: операции редактора по HTTP без окна программы",
+    )
+    parser.add_argument(
+        "--host",
+        default=DEFAULT_HOST,
+        help=f"Адрес (по умолчанию {DEFAULT_HOST})",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help=f"Порт (по умолчанию {DEFAULT_PORT})",
+    )
+    parser.add_argument(
+        "--socket",
+        default=None,
+        help="Слушать Unix-сокет вместо TCP-порта",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Число рабочих потоков (по умолчанию число ядер)",
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=MAX_BATCH,
+        help=f"Наибольшее число запросов с одной операцией в пакете (по умолчанию {MAX_BATCH})",
+    )
+    parser.add_argument(
+        "--max-delay-ms",
+        type=float,
+        default=MAX_DELAY * 1000,
+        help="Сколько первый запрос пакета может ждать остальные, мс (по умолчанию пакеты собираются, "
+        "только пока все потоки заняты)",
+    )
+    args = parser.parse_args(argv)
+
+    service = Service(args.workers, args.max_batch, args.max_delay_ms / 1000)
+    try:
+        server = create_server(service, args.host, args.port, args.socket)
+    except OSError as error:
+        print(f"Ошибка: {error}", file=sys.stderr)
+        service.close()
+        return 1
+    print(
+        f"Сервис запущен: {args.socket or f'http://{args.host}:{server.server_address[1]}'}, "
+        f"потоков: {service.workers}, пакет до {service.max_batch} запросов",
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
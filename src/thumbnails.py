@@ -0,0 +1,189 @@
+import hashlib
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+from tracing import traced
+
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "opencv-image-editor",
+    "thumbnails",
+)
+THUMBNAIL_SIZE = 1024
+REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+# start of frame markers, the ones that carry the image size; C4, C8 and CC are other segments in the same range
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+SEGMENT = struct.Struct(">H")
+FRAME = struct.Struct(">BHH")
+
+
+def jpeg_size(path):
+    # read from the headers in front of the compressed data, None for anything that is not a readable JPEG
+    try:
+        with open(path, "rb") as file:
+            return frame_size(file)
+    except OSError:
+        return None
+
+
+def frame_size(file):
+    if file.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        prefix, marker = file.read(1), file.read(1)
+        while marker == b"\xff":
+            marker = file.read(1)
+        if prefix != b"\xff" or not marker:
+            return None
+        if marker[0] == 0x01 or 0xD0 <= marker[0] <= 0xD7:
+            continue
+        header = file.read(SEGMENT.size)
+        if len(header) < SEGMENT.size:
+            return None
+        (length,) = SEGMENT.unpack(header)
+        if marker[0] in SOF_MARKERS:
+            frame = file.read(FRAME.size)
+            if len(frame) < FRAME.size:
+                return None
+            _, h, w = FRAME.unpack(frame)
+            return h, w
+        file.seek(length - SEGMENT.size, os.SEEK_CUR)
+
+
+def read_reduced(path, max_size=THUMBNAIL_SIZE):
+    # JPEG is scaled while decoding, so one reduced read costs a fraction of the full one; every other format is
+    # decoded whole once and scaled down afterwards
+    size = jpeg_size(path)
+    flag = cv2.IMREAD_COLOR
+    if size is not None:
+        for factor, reduced in REDUCED_FLAGS:
+            if max(size) // factor * 2 > max_size:
+                flag = reduced
+                break
+    image = cv2.imread(path, flag)
+    if image is None:
+        return None
+    h, w = image.shape[:2]
+    scale = max_size / max(h, w)
+    factor = int(1 / scale)
+    if factor >= 2:
+        # area averaging is quick for whole factors, what is left is less than a halving and linear is enough
+        image = cv2.resize(
+            image,
+            None,
+            fx=1 / factor,
+            fy=1 / factor,
+            interpolation=cv2.INTER_AREA,
+        )
+        scale *= factor
+    if scale < 1:
+        h, w = image.shape[:2]
+        image = cv2.resize(
+            image,
+            (max(1, round(w * scale)), max(1, round(h * scale))),
+            interpolation=cv2.INTER_LINEAR,
+        )
+    return image
+
+
+class ThumbnailCache:
+    def __init__(
+        self,
+        directory=CACHE_DIR,
+        size=THUMBNAIL_SIZE,
+        max_bytes=256 * 1024 * 1024,
+        quality=90,
+    ):
+        self.directory = directory
+        self.size = size
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self._executor = None
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            self.prune()
+        except OSError:
+            # an unwritable or broken cache location only costs speed, thumbnails are then decoded every time
+            self.directory = None
+
+    def key(self, path):
+        # an edited file gets a new key, its old thumbnail is simply never read again and is pruned later
+        stat = os.stat(path)
+        source = f"{os.path.abspath(path)}\0{stat.st_mtime_ns}\0{stat.st_size}"
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def path(self, path):
+        return os.path.join(self.directory, self.key(path) + ".jpg")
+
+    @traced("io")
+    def get(self, path, full_decode=True):
+        # without full_decode nothing but a cached thumbnail or a reduced JPEG read is returned, for callers that
+        # decode the whole file next anyway
+        if self.directory is not None:
+            try:
+                cached = self.path(path)
+            except OSError:
+                return None
+            if os.path.exists(cached):
+                image = cv2.imread(cached)
+                if image is not None:
+                    return image
+        if not full_decode and jpeg_size(path) is None:
+            return None
+        image = read_reduced(path, self.size)
+        if self.directory is None:
+            return image
+        if image is not None:
+            self.store(cached, image)
+        return image
+
+    def store(self, cached, image):
+        # written under a temporary name first, so a concurrent reader never sees half a file
+        temporary = f"{cached}.{threading.get_ident()}.tmp.jpg"
+        try:
+            if cv2.imwrite(temporary, image, [cv2.IMWRITE_JPEG_QUALITY, self.quality]):
+                os.replace(temporary, cached)
+        except (OSError, cv2.error):
+            # a full disk or a cache directory removed under us, the thumbnail is just not kept
+            pass
+
+    def prefetch(self, paths):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=2,
+                    thread_name_prefix="thumbnails",
+                )
+        for path in paths:
+            self._executor.submit(self.get, path)
+
+    def prune(self):
+        if self.directory is None:
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
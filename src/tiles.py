@@ -0,0 +1,433 @@
+import argparse
+import itertools
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import CancelledError
+
+import cv2
+import numpy as np
+import operations
+from tracing import span
+
+
+TILE_SIZE = 1024
+# with a single threshold Canny only needs the Sobel kernel and the neighbours of non-maximum suppression,
+# hysteresis follows edges across tiles in a pass of its own
+CANNY_HALO = 2
+NETPBM = (".ppm", ".pgm", ".pnm")
+# how far, in pixels, each operation reads around the pixel it writes
+HALOS = {
+    "grayscale": lambda **params: 0,
+    "brightness_contrast": lambda **params: 0,
+    "blur": lambda kernel_size: (kernel_size | 1) // 2,
+    "canny": lambda **params: CANNY_HALO,
+}
+
+
+def pipeline_halo(steps):
+    halo = 0
+    for name, params in steps:
+        if name not in HALOS:
+            raise ValueError(f"Operation cannot be processed in tiles: {name}")
+        # every step needs its own neighbourhood of valid output from the step before
+        halo += HALOS[name](**params)
+    return halo
+
+
+def pipeline_alignment(steps):
+    # tiles and their halos start on multiples of this, so every crop is reduced on the whole image's grid
+    return max(
+        [
+            operations.blur_alignment(**params)
+            for name, params in steps
+            if name == "blur"
+        ]
+        or [1],
+    )
+
+
+def align(value, alignment):
+    return -(-value // alignment) * alignment
+
+
+def stages(steps):
+    # a Canny step ends a stage, its hysteresis needs the edges of every tile before any of them is final
+    stage = []
+    for step in steps:
+        stage.append(step)
+        if step[0] == "canny":
+            yield stage
+            stage = []
+    if stage or not steps:
+        yield stage
+
+
+def edge_classes(image, threshold1, threshold2):
+    low, high = sorted((threshold1, threshold2))
+    gray = operations.to_gray(image)
+    # 1 for every pixel above the low threshold that survives non-maximum suppression, 2 above the high one
+    return cv2.Canny(gray, low, low) // 255 + cv2.Canny(gray, high, high) // 255
+
+
+def label_edges(edges):
+    count, labels = cv2.connectedComponents(
+        (edges > 0).view(np.uint8),
+        connectivity=8,
+    )
+    strong = np.zeros(count, bool)
+    strong[labels[edges == 2]] = True
+    strong[0] = False
+    return labels, strong
+
+
+def label_offsets(strong):
+    # the labels of all parts are numbered in one sequence, each part starts after the ones before it
+    return np.cumsum([0] + [len(part) for part in strong])
+
+
+def seam(labels, offset):
+    return np.where(labels > 0, labels.astype(np.int64) + offset, -1)
+
+
+def link_labels(strong, seams):
+    # a weak edge that crosses a seam is kept when a strong pixel is anywhere on it, only the few components
+    # touching a seam go through the union-find; a seam is two rows of numbered labels, a[i] touching b[i - 1:i + 2]
+    offsets = label_offsets(strong)
+    parent = {}
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for a, b in seams:
+        for first_side, second_side in ((a[1:], b[:-1]), (a, b), (a[:-1], b[1:])):
+            touching = (first_side >= 0) & (second_side >= 0)
+            pairs = np.stack([first_side, second_side], axis=1)[touching]
+            for first, second in np.unique(pairs, axis=0).tolist():
+                parent.setdefault(first, first)
+                parent.setdefault(second, second)
+                parent[find(first)] = find(second)
+
+    luts = [np.where(part, 255, 0).astype(np.uint8) for part in strong]
+    flat = np.concatenate(strong)
+    kept = {find(node) for node in parent if flat[node]}
+    for node in parent:
+        if find(node) in kept:
+            index = int(np.searchsorted(offsets, node, side="right")) - 1
+            luts[index][node - offsets[index]] = 255
+    return luts
+
+
+def hysteresis(edges, tile_size, progress=None, cancelled=None):
+    # edges holds the classes from edge_classes and is rewritten in place, one tile in memory at a time
+    h, w = edges.shape[:2]
+    grid = [
+        [
+            (y, min(y + tile_size, h), x, min(x + tile_size, w))
+            for x in range(0, w, tile_size)
+        ]
+        for y in range(0, h, tile_size)
+    ]
+    tiles = [tile for row in grid for tile in row]
+    strong = []
+    borders = []
+    for index, (y, y_end, x, x_end) in enumerate(tiles):
+        if cancelled is not None and cancelled():
+            raise CancelledError()
+        labels, tile_strong = label_edges(np.asarray(edges[y:y_end, x:x_end]))
+        offset = sum(len(part) for part in strong)
+        strong.append(tile_strong)
+        borders.append(
+            {
+                "top": seam(labels[0], offset),
+                "bottom": seam(labels[-1], offset),
+                "left": seam(labels[:, 0], offset),
+                "right": seam(labels[:, -1], offset),
+            },
+        )
+        if progress is not None:
+            progress((index + 1) / len(tiles) / 2)
+
+    cols = len(grid[0])
+    seams = []
+    # a seam runs along the whole image, so pixels diagonal across a tile corner are joined as well
+    for row in range(len(grid) - 1):
+        seams.append(
+            (
+                np.concatenate(
+                    [borders[row * cols + col]["bottom"] for col in range(cols)],
+                ),
+                np.concatenate(
+                    [borders[(row + 1) * cols + col]["top"] for col in range(cols)],
+                ),
+            ),
+        )
+    for col in range(cols - 1):
+        seams.append(
+            (
+                np.concatenate(
+                    [borders[row * cols + col]["right"] for row in range(len(grid))],
+                ),
+                np.concatenate(
+                    [borders[row * cols + col + 1]["left"] for row in range(len(grid))],
+                ),
+            ),
+        )
+    with span("hysteresis", "tiles", tiles=len(tiles)):
+        luts = link_labels(strong, seams)
+
+    for index, (y, y_end, x, x_end) in enumerate(tiles):
+        if cancelled is not None and cancelled():
+            raise CancelledError()
+        # labelling is deterministic, so the labels are found again rather than kept for every tile
+        labels, _ = label_edges(np.asarray(edges[y:y_end, x:x_end]))
+        edges[y:y_end, x:x_end] = luts[index][labels]
+        if progress is not None:
+            progress(0.5 + (index + 1) / len(tiles) / 2)
+    return edges
+
+
+def read_netpbm_header(file):
+    fields = []
+    while len(fields) < 4:
+        line = file.readline()
+        if not line:
+            raise ValueError("Truncated Netpbm header")
+        fields.extend(line.split(b"#", 1)[0].split())
+    magic, width, height, maxval = fields
+    if magic not in (b"P5", b"P6") or int(maxval) != 255:
+        raise ValueError("Only binary 8-bit PGM and PPM files can be streamed")
+    channels = 3 if magic == b"P6" else 1
+    return int(height), int(width), channels, file.tell()
+
+
+def open_image(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        return np.load(path, mmap_mode="r")
+    if extension in NETPBM:
+        with open(path, "rb") as file:
+            height, width, channels, offset = read_netpbm_header(file)
+        shape = (height, width, channels) if channels == 3 else (height, width)
+        image = np.memmap(path, dtype=np.uint8, mode="r", offset=offset, shape=shape)
+        # the file stores RGB, a reversed view gives OpenCV's order without reading anything
+        return image[:, :, ::-1] if channels == 3 else image
+    # compressed formats cannot be decoded in parts, so these are the one case that is read whole
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Cannot read image: {path}")
+    return image
+
+
+def create_image(path, shape, dtype):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy":
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    if extension in NETPBM:
+        if dtype != np.uint8 or len(shape) == 3 and shape[2] != 3:
+            raise ValueError("Netpbm output needs an 8-bit gray or BGR image")
+        magic = "P6" if len(shape) == 3 else "P5"
+        header = f"{magic}\n{shape[1]} {shape[0]}\n255\n".encode("ascii")
+        with open(path, "wb") as file:
+            file.write(header)
+            file.truncate(len(header) + int(np.prod(shape)))
+        image = np.memmap(
+            path,
+            dtype=np.uint8,
+            mode="r+",
+            offset=len(header),
+            shape=shape,
+        )
+        return image[:, :, ::-1] if len(shape) == 3 else image
+    raise ValueError(f"Cannot write tiles to {extension} files")
+
+
+def process_tiles(
+    source,
+    steps,
+    allocate,
+    tile_size=TILE_SIZE,
+    progress=None,
+    cancelled=None,
+    scratch=None,
+):
+    parts = list(stages(steps))
+    if len(parts) == 1:
+        return process_stage(source, parts[0], allocate, tile_size, progress, cancelled)
+    # every stage but the last writes to a file of its own, the next one reads it tile by tile
+    with tempfile.TemporaryDirectory(dir=scratch) as directory:
+        image = source
+        for index, stage in enumerate(parts):
+            last = index == len(parts) - 1
+            image = process_stage(
+                image,
+                stage,
+                (
+                    allocate
+                    if last
+                    else (
+                        lambda shape, dtype, index=index: create_image(
+                            os.path.join(directory, f"stage-{index}.npy"),
+                            shape,
+                            dtype,
+                        )
+                    )
+                ),
+                tile_size,
+                (
+                    None
+                    if progress is None
+                    else (
+                        lambda fraction, index=index: progress(
+                            (index + fraction) / len(parts),
+                        )
+                    )
+                ),
+                cancelled,
+            )
+        return image
+
+
+def process_stage(source, steps, allocate, tile_size, progress=None, cancelled=None):
+    alignment = pipeline_alignment(steps)
+    halo = align(pipeline_halo(steps), alignment)
+    tile_size = align(tile_size, alignment)
+    # a stage ending in Canny writes the classes of edge pixels first, hysteresis then joins them across tiles
+    canny = steps[-1][1] if steps and steps[-1][0] == "canny" else None
+    local = steps[:-1] if canny is not None else steps
+    scale = 0.5 if canny is not None else 1
+    h, w = source.shape[:2]
+    tiles = list(itertools.product(range(0, h, tile_size), range(0, w, tile_size)))
+    target = None
+    for index, (y, x) in enumerate(tiles):
+        if cancelled is not None and cancelled():
+            raise CancelledError()
+        y0, x0 = max(y - halo, 0), max(x - halo, 0)
+        y1, x1 = min(y + tile_size + halo, h), min(x + tile_size + halo, w)
+        with span("tile", "tiles", y=y, x=x):
+            result = operations.run_pipeline(
+                np.ascontiguousarray(source[y0:y1, x0:x1]),
+                local,
+            )
+            if canny is not None:
+                result = edge_classes(result, **canny)
+        if target is None:
+            # the output layout is only known once the pipeline has run on real data
+            target = allocate((h, w) + result.shape[2:], result.dtype)
+
+        tile_h, tile_w = min(tile_size, h - y), min(tile_size, w - x)
+        top, left = y - y0, x - x0
+        bottom, right = top + tile_h, left + tile_w
+        y_end, x_end = y + tile_h, x + tile_w
+        target[y:y_end, x:x_end] = result[top:bottom, left:right]
+        if progress is not None:
+            progress((index + 1) / len(tiles) * scale)
+    if canny is not None:
+        hysteresis(
+            target,
+            tile_size,
+            (
+                None
+                if progress is None
+                else (lambda fraction: progress(0.5 + fraction / 2))
+            ),
+            cancelled,
+        )
+    return target
+
+
+def process_file(
+    source_path,
+    target_path,
+    steps,
+    tile_size=TILE_SIZE,
+    progress=None,
+    cancelled=None,
+):
+    source = open_image(source_path)
+    extension = os.path.splitext(target_path)[1].lower()
+    if extension == ".npy" or extension in NETPBM:
+        target = process_tiles(
+            source,
+            steps,
+            lambda shape, dtype: create_image(target_path, shape, dtype),
+            tile_size,
+            progress,
+            cancelled,
+            os.path.dirname(os.path.abspath(target_path)),
+        )
+        target.flush()
+        return source.shape
+
+    # encoders need the whole image, so it is assembled on disk first and only mapped in for cv2.imwrite
+    with tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(target_path)),
+    ) as scratch:
+        spill = os.path.join(scratch, "result.npy")
+        target = process_tiles(
+            source,
+            steps,
+            lambda shape, dtype: create_image(spill, shape, dtype),
+            tile_size,
+            progress,
+            cancelled,
+            scratch,
+        )
+        written = cv2.imwrite(target_path, target)
+        del target
+    if not written:
+        raise ValueError(f"Cannot write image: {target_path}")
+    return source.shape
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Обработка изображений, не помещающихся в память, по тайлам",
+    )
+    parser.add_argument(
+        "pipeline",
+        help='JSON-файл или строка со списком операций, например \'[{"op": "blur", "kernel_size": 5}]\'',
+    )
+    parser.add_argument(
+        "input",
+        help="Исходное изображение (.npy, .ppm и .pgm читаются по частям)",
+    )
+    parser.add_argument(
+        "output",
+        help="Результат (.npy, .ppm и .pgm записываются по частям)",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=TILE_SIZE,
+        help=f"Сторона тайла в пикселях (по умолчанию {TILE_SIZE})",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        steps = operations.parse_pipeline(args.pipeline)
+        pipeline_halo(steps)
+    except ValueError as error:
+        parser.error(str(error))
+
+    start = time.perf_counter()
+    try:
+        shape = process_file(args.input, args.output, steps, args.tile_size)
+    except (OSError, ValueError, cv2.error) as error:
+        print(f"Ошибка: {error}", file=sys.stderr)
+        return 1
+    seconds = time.perf_counter() - start
+    megapixels = shape[0] * shape[1] / 1e6
+    print(
+        f"Обработано {shape[1]}x{shape[0]} ({megapixels:.1f} Мп) за {seconds:.2f} с, "
+        f"{megapixels / seconds:.1f} Мп/с",
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
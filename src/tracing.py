@@ -0,0 +1,108 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+
+class Tracer:
+    def __init__(self, max_events=200000):
+        self.events = deque(maxlen=max_events)
+        self.totals = {}
+        self.last = None
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @property
+    def memory(self):
+        return tracemalloc.is_tracing()
+
+    def set_memory(self, enabled):
+        # allocation tracking slows pure Python code down noticeably, so it is only on when asked for
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextmanager
+    def span(self, name, category="operation", **args):
+        memory = tracemalloc.is_tracing()
+        before = tracemalloc.get_traced_memory()[0] if memory else 0
+        start = time.perf_counter_ns()
+        try:
+            yield args
+        finally:
+            duration = time.perf_counter_ns() - start
+            if memory and tracemalloc.is_tracing():
+                # bytes still held when the span ends, e.g. the new image and its history entry
+                args["allocated_bytes"] = tracemalloc.get_traced_memory()[0] - before
+            self.record(name, category, start, duration, args)
+
+    def traced(self, category="operation", name=None):
+        def decorator(function):
+            label = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(label, category):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def record(self, name, category, start, duration, args):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start / 1000,
+            "dur": duration / 1000,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+            self._threads[thread.ident] = thread.name
+            count, total = self.totals.get(name, (0, 0))
+            self.totals[name] = (count + 1, total + duration)
+            self.last = event
+
+    def clear(self):
+        with self._lock:
+            self.events.clear()
+            self.totals.clear()
+            self.last = None
+
+    def export(self, file_path):
+        with self._lock:
+            events = list(self.events)
+            threads = dict(self._threads)
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": ident,
+                "args": {"name": name},
+            }
+            for ident, name in threads.items()
+        ]
+        # the Trace Event format read by chrome://tracing and ui.perfetto.dev
+        with open(file_path, "w", encoding="utf-8") as file:
+            json.dump(
+                {"traceEvents": metadata + events, "displayTimeUnit": "ms"},
+                file,
+                ensure_ascii=False,
+            )
+        return len(events)
+
+
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced
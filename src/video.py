@@ -0,0 +1,328 @@
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError
+
+import cv2
+import faces
+import operations
+from tracing import span
+
+
+QUEUE_SIZE = 8
+DEFAULT_FPS = 25.0
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.backpressure = 0
+        self.dropped = 0
+
+    def report(self, elapsed):
+        return {
+            "stage": self.name,
+            "frames": self.frames,
+            "fps": self.frames / elapsed if elapsed else 0.0,
+            # what the stage could sustain on its own, if it never had to wait for its neighbours
+            "capacity_fps": (
+                self.frames / self.busy_seconds if self.busy_seconds else 0.0
+            ),
+            "busy_seconds": self.busy_seconds,
+            "blocked_seconds": self.blocked_seconds,
+            "backpressure": self.backpressure,
+            "dropped": self.dropped,
+        }
+
+
+class VideoPipeline:
+    def __init__(
+        self,
+        source,
+        target,
+        steps,
+        detect_faces=False,
+        fast_faces=True,
+        queue_size=QUEUE_SIZE,
+        realtime=None,
+        fourcc="mp4v",
+    ):
+        self.source = int(source) if str(source).isdigit() else source
+        self.target = target
+        self.steps = steps
+        self.detect_faces = detect_faces
+        self.fast_faces = fast_faces
+        # a camera cannot wait for us, so it always runs in real time and drops what does not fit
+        self.realtime = isinstance(self.source, int) if realtime is None else realtime
+        self.fourcc = fourcc
+        self.decoded = queue.Queue(maxsize=queue_size)
+        self.processed = queue.Queue(maxsize=queue_size)
+        self.stages = {
+            name: StageStats(name) for name in ("decode", "process", "encode")
+        }
+        self.fps = DEFAULT_FPS
+        self.total_frames = 0
+        self._stop = threading.Event()
+        self._errors = []
+        self._start = None
+
+    def process_frame(self, frame):
+        frame = operations.run_pipeline(frame, self.steps)
+        if self.detect_faces:
+            frame = faces.draw_faces(
+                frame,
+                faces.detect_faces(frame, fast=self.fast_faces),
+            )
+        return frame
+
+    def run(self, progress=None, cancelled=None):
+        capture = cv2.VideoCapture(self.source)
+        if not capture.isOpened():
+            raise ValueError(f"Cannot open video: {self.source}")
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+        self.total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) or 0
+
+        self._start = time.perf_counter()
+        threads = [
+            threading.Thread(
+                target=self._guard,
+                args=(self._decode, capture),
+                name="video-decode",
+            ),
+            threading.Thread(
+                target=self._guard,
+                args=(self._process,),
+                name="video-process",
+            ),
+            threading.Thread(
+                target=self._guard,
+                args=(self._encode, progress),
+                name="video-encode",
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                if cancelled is not None and cancelled():
+                    self._stop.set()
+                threads[-1].join(0.1)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            capture.release()
+        if self._errors:
+            raise self._errors[0]
+        if cancelled is not None and cancelled():
+            raise CancelledError()
+        return self.report()
+
+    def stop(self):
+        self._stop.set()
+
+    def report(self):
+        elapsed = time.perf_counter() - self._start if self._start else 0.0
+        return {
+            "seconds": elapsed,
+            "source_fps": self.fps,
+            "realtime": self.realtime,
+            "stages": [stats.report(elapsed) for stats in self.stages.values()],
+        }
+
+    def _guard(self, function, *args):
+        try:
+            function(*args)
+        except Exception as error:
+            self._errors.append(error)
+            self._stop.set()
+
+    def _put(self, target, item, stats):
+        try:
+            target.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        # the next stage is behind, this one has to wait for it
+        stats.backpressure += 1
+        start = time.perf_counter()
+        try:
+            while not self._stop.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        finally:
+            stats.blocked_seconds += time.perf_counter() - start
+
+    def _get(self, source):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _decode(self, capture):
+        stats = self.stages["decode"]
+        index = 0
+        try:
+            while not self._stop.is_set():
+                if self.realtime and not isinstance(self.source, int):
+                    # a file is replayed at its own frame rate, as if it came from the camera
+                    delay = self._start + index / self.fps - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                start = time.perf_counter()
+                with span("decode", "video", frame=index):
+                    ok, frame = capture.read()
+                stats.busy_seconds += time.perf_counter() - start
+                if not ok:
+                    break
+                if self.realtime:
+                    try:
+                        self.decoded.put_nowait((index, frame))
+                    except queue.Full:
+                        stats.dropped += 1
+                else:
+                    self._put(self.decoded, (index, frame), stats)
+                stats.frames += 1
+                index += 1
+        finally:
+            self._put(self.decoded, None, stats)
+
+    def _process(self):
+        stats = self.stages["process"]
+        try:
+            while True:
+                item = self._get(self.decoded)
+                if item is None:
+                    break
+                index, frame = item
+                start = time.perf_counter()
+                with span("process", "video", frame=index):
+                    frame = self.process_frame(frame)
+                stats.busy_seconds += time.perf_counter() - start
+                stats.frames += 1
+                if not self._put(self.processed, (index, frame), stats):
+                    break
+        finally:
+            self._put(self.processed, None, stats)
+
+    def _encode(self, progress=None):
+        stats = self.stages["encode"]
+        writer = None
+        try:
+            while True:
+                item = self._get(self.processed)
+                if item is None:
+                    break
+                index, frame = item
+                start = time.perf_counter()
+                with span("encode", "video", frame=index):
+                    if writer is None:
+                        # the layout is known only after the first frame went through the pipeline
+                        writer = cv2.VideoWriter(
+                            self.target,
+                            cv2.VideoWriter_fourcc(*self.fourcc),
+                            self.fps,
+                            (frame.shape[1], frame.shape[0]),
+                            frame.ndim == 3,
+                        )
+                        if not writer.isOpened():
+                            raise ValueError(f"Cannot write video: {self.target}")
+                    writer.write(frame)
+                stats.busy_seconds += time.perf_counter() - start
+                stats.frames += 1
+                if progress is not None and self.total_frames:
+                    progress(min(stats.frames / self.total_frames, 1.0))
+        finally:
+            if writer is not None:
+                writer.release()
+
+
+def print_report(report):
+    print(
+        f"Время: {report['seconds']:.2f} с, частота источника: {report['source_fps']:.1f} кадр/с"
+        + (" (режим реального времени)" if report["realtime"] else ""),
+    )
+    for stage in report["stages"]:
+        print(
+            f"{stage['stage']:8} кадров: {stage['frames']:6}  {stage['fps']:7.1f} кадр/с  "
+            f"предел: {stage['capacity_fps']:7.1f} кадр/с  "
+            f"ожидание: {stage['blocked_seconds']:6.2f} с ({stage['backpressure']} раз)  "
+            f"пропущено: {stage['dropped']}",
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Покадровая обработка видео: чтение, обработка и запись идут параллельно",
+    )
+    parser.add_argument(
+        "pipeline",
+        help='JSON-файл или строка со списком операций, например \'[{"op": "grayscale"}]\'',
+    )
+    parser.add_argument("input", help="Видеофайл или номер камеры")
+    parser.add_argument("output", help="Выходной видеофайл")
+    parser.add_argument(
+        "--faces",
+        choices=("none", "fast", "full"),
+        default="none",
+        help="Отмечать лица на каждом кадре",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=QUEUE_SIZE,
+        help=f"Размер очередей между стадиями (по умолчанию {QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="Читать файл с его собственной частотой кадров и пропускать кадры, которые не успевают обработаться",
+    )
+    parser.add_argument("--fourcc", default="mp4v", help="Кодек выходного файла")
+    parser.add_argument("--json", default=None, help="Сохранить отчёт в JSON-файл")
+    args = parser.parse_args(argv)
+
+    try:
+        steps = operations.parse_pipeline(args.pipeline)
+    except ValueError as error:
+        parser.error(str(error))
+
+    pipeline = VideoPipeline(
+        args.input,
+        args.output,
+        steps,
+        detect_faces=args.faces != "none",
+        fast_faces=args.faces == "fast",
+        queue_size=args.queue_size,
+        realtime=True if args.realtime else None,
+        fourcc=args.fourcc,
+    )
+    try:
+        report = pipeline.run()
+    except KeyboardInterrupt:
+        pipeline.stop()
+        report = pipeline.report()
+    except (OSError, ValueError, cv2.error) as error:
+        print(f"Ошибка: {error}", file=sys.stderr)
+        return 1
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,273 @@
+import math
+import sys
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PyQt6 import sip
+from PyQt6.QtCore import (
+    pyqtSignal,
+    QPointF,
+    QRectF,
+    Qt,
+)
+from PyQt6.QtGui import (
+    QImage,
+    QPainter,
+    QPixmap,
+)
+from PyQt6.QtWidgets import QWidget
+from tracing import span
+
+
+# QImage reads these formats straight from OpenCV's BGR(A) channel order, so no swap pass is needed
+FORMATS = {
+    1: QImage.Format.Format_Grayscale8,
+    3: QImage.Format.Format_BGR888,
+    4: (
+        QImage.Format.Format_ARGB32
+        if sys.byteorder == "little"
+        else QImage.Format.Format_RGBA8888
+    ),
+}
+
+
+def to_qimage(image):
+    if image.dtype != np.uint8:
+        image = cv2.convertScaleAbs(image)
+    if image.ndim == 3 and image.shape[2] == 1:
+        image = image[:, :, 0]
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    if channels == 4 and sys.byteorder != "little":
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+    if image.strides[-1] != image.itemsize or (
+        image.ndim == 3 and image.strides[1] != channels
+    ):
+        image = np.ascontiguousarray(image)
+
+    # the address plus bytesPerLine lets a strided view, such as a tile of a larger image, be wrapped without a copy
+    qimage = QImage(
+        sip.voidptr(image.ctypes.data),
+        image.shape[1],
+        image.shape[0],
+        image.strides[0],
+        FORMATS[channels],
+    )
+    # QImage only borrows the memory, keep the array alive for as long as the image exists
+    qimage.buffer = image
+    return qimage
+
+
+class ImageViewer(QWidget):
+    cursorMoved = pyqtSignal(int, int)
+
+    TILE_SIZE = 256
+    MIN_ZOOM = 1 / 64
+    MAX_ZOOM = 32
+
+    def __init__(self, parent=None, cache_bytes=256 * 1024 * 1024):
+        super().__init__(parent)
+        self.setMouseTracking(True)
+        self.setFocusPolicy(Qt.FocusPolicy.WheelFocus)
+        self.cache_bytes = cache_bytes
+        self.levels = []
+        self.zoom = 1.0
+        self.offset = QPointF(0, 0)
+        self._tiles = OrderedDict()
+        self._tiles_nbytes = 0
+        self._drag_start = None
+        self._fit = True
+
+    def image(self):
+        return self.levels[0] if self.levels else None
+
+    def setImage(self, image):
+        previous = self.image()
+        self.levels = [image]
+        self.clearCache()
+        if previous is None or previous.shape[:2] != image.shape[:2]:
+            self.fitToWindow()
+        else:
+            self.update()
+
+    def showComposited(self, compositor, image, annotations):
+        previous = self.image()
+        image, dirty = compositor.update(image, annotations)
+        if dirty is None or previous is not image:
+            self.setImage(image)
+        elif dirty[2] and dirty[3]:
+            # a stroke was added or undone, only the tiles under it are rebuilt
+            self.updateRegion(image, *dirty)
+
+    def clearCache(self):
+        self._tiles.clear()
+        self._tiles_nbytes = 0
+
+    def fitToWindow(self):
+        image = self.image()
+        if image is None:
+            return
+        h, w = image.shape[:2]
+        self.zoom = min(1.0, self.width() / w, self.height() / h)
+        self.offset = QPointF(
+            (self.width() - w * self.zoom) / 2,
+            (self.height() - h * self.zoom) / 2,
+        )
+        self._fit = True
+        self.update()
+
+    def level(self, index):
+        while len(self.levels) <= index:
+            previous = self.levels[-1]
+            h, w = previous.shape[:2]
+            h, w = max(1, h // 2), max(1, w // 2)
+            # an exact 2x2 average, so a changed region can later be rebuilt on its own
+            self.levels.append(
+                cv2.resize(
+                    previous[: h * 2, : w * 2],
+                    (w, h),
+                    interpolation=cv2.INTER_AREA,
+                ),
+            )
+        return self.levels[index]
+
+    def levelForZoom(self):
+        if self.zoom >= 1:
+            return 0
+        image = self.image()
+        # stop at the level where the whole image already fits into a single tile
+        last = max(0, math.ceil(math.log2(max(image.shape[:2]) / self.TILE_SIZE)))
+        return min(int(math.floor(math.log2(1 / self.zoom))), last)
+
+    def tile(self, level, row, col):
+        key = (level, row, col)
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+            return pixmap
+
+        t = self.TILE_SIZE
+        y, x = row * t, col * t
+        y1, x1 = y + t, x + t
+        with span("tile", "display", level=level, row=row, col=col):
+            pixmap = QPixmap.fromImage(to_qimage(self.level(level)[y:y1, x:x1]))
+        self._tiles[key] = pixmap
+        self._tiles_nbytes += pixmap.width() * pixmap.height() * 4
+        while self._tiles_nbytes > self.cache_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._tiles_nbytes -= evicted.width() * evicted.height() * 4
+        return pixmap
+
+    def mapToImage(self, point):
+        return QPointF(
+            (point.x() - self.offset.x()) / self.zoom,
+            (point.y() - self.offset.y()) / self.zoom,
+        )
+
+    def updateRegion(self, image, x, y, w, h):
+        self.levels[0] = image
+        self._dropTiles(0, x, y, w, h)
+        for level in range(1, len(self.levels)):
+            level_h, level_w = self.levels[level].shape[:2]
+            x0, y0 = x // 2, y // 2
+            x1, y1 = min(-(-(x + w) // 2), level_w), min(-(-(y + h) // 2), level_h)
+            if x1 <= x0 or y1 <= y0:
+                break
+            sy0, sy1, sx0, sx1 = y0 * 2, y1 * 2, x0 * 2, x1 * 2
+            source = self.levels[level - 1][sy0:sy1, sx0:sx1]
+            self.levels[level][y0:y1, x0:x1] = cv2.resize(
+                source,
+                (x1 - x0, y1 - y0),
+                interpolation=cv2.INTER_AREA,
+            )
+            x, y, w, h = x0, y0, x1 - x0, y1 - y0
+            self._dropTiles(level, x, y, w, h)
+        self.update()
+
+    def _dropTiles(self, level, x, y, w, h):
+        t = self.TILE_SIZE
+        for row in range(y // t, (y + h - 1) // t + 1):
+            for col in range(x // t, (x + w - 1) // t + 1):
+                pixmap = self._tiles.pop((level, row, col), None)
+                if pixmap is not None:
+                    self._tiles_nbytes -= pixmap.width() * pixmap.height() * 4
+
+    def paintEvent(self, event):
+        with span("paint", "display"):
+            self._paint(event)
+
+    def _paint(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().color(self.backgroundRole()))
+        image = self.image()
+        if image is None:
+            return
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform, self.zoom < 1)
+
+        level = self.levelForZoom()
+        scale = 2**level
+        level_image = self.level(level)
+        level_h, level_w = level_image.shape[:2]
+        t = self.TILE_SIZE
+
+        # visible area in level coordinates, so the work depends on the window size only
+        top_left = self.mapToImage(QPointF(event.rect().topLeft()))
+        bottom_right = self.mapToImage(QPointF(event.rect().bottomRight()))
+        first_col = max(0, int(top_left.x() / scale) // t)
+        first_row = max(0, int(top_left.y() / scale) // t)
+        last_col = min((level_w - 1) // t, int(bottom_right.x() / scale) // t)
+        last_row = min((level_h - 1) // t, int(bottom_right.y() / scale) // t)
+
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                pixmap = self.tile(level, row, col)
+                target = QRectF(
+                    self.offset.x() + col * t * scale * self.zoom,
+                    self.offset.y() + row * t * scale * self.zoom,
+                    pixmap.width() * scale * self.zoom,
+                    pixmap.height() * scale * self.zoom,
+                )
+                painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self._fit:
+            self.fitToWindow()
+
+    def wheelEvent(self, event):
+        if self.image() is None:
+            return
+        factor = 1.25 if event.angleDelta().y() > 0 else 0.8
+        zoom = min(max(self.zoom * factor, self.MIN_ZOOM), self.MAX_ZOOM)
+        anchor = event.position()
+        point = self.mapToImage(anchor)
+        self.zoom = zoom
+        self.offset = QPointF(
+            anchor.x() - point.x() * zoom,
+            anchor.y() - point.y() * zoom,
+        )
+        self._fit = False
+        self.update()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.MouseButton.LeftButton:
+            self._drag_start = event.position() - self.offset
+        super().mousePressEvent(event)
+
+    def mouseMoveEvent(self, event):
+        if self._drag_start is not None:
+            self.offset = event.position() - self._drag_start
+            self._fit = False
+            self.update()
+        point = self.mapToImage(event.position())
+        self.cursorMoved.emit(int(point.x()), int(point.y()))
+        super().mouseMoveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        if event.button() == Qt.MouseButton.LeftButton:
+            self._drag_start = None
+        super().mouseReleaseEvent(event)
+
+    def mouseDoubleClickEvent(self, event):
+        self.fitToWindow()
+        super().mouseDoubleClickEvent(event)
@@ -0,0 +1,107 @@
+import threading
+import traceback
+from concurrent.futures import CancelledError
+
+from PyQt6.QtCore import (
+    pyqtSignal,
+    QObject,
+    QRunnable,
+    QThreadPool,
+)
+
+
+class TaskSignals(QObject):
+    finished = pyqtSignal(object, object)
+    failed = pyqtSignal(object, str)
+    progress = pyqtSignal(object, int)
+
+
+class Task(QRunnable):
+    def __init__(self, function, on_finished, message=""):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.function = function
+        self.on_finished = on_finished
+        self.message = message
+        self.signals = TaskSignals()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def progress(self, fraction):
+        self.signals.progress.emit(self, int(fraction * 100))
+
+    def run(self):
+        if self.cancelled():
+            return
+        try:
+            result = self.function(self)
+        except CancelledError:
+            return
+        except Exception as error:
+            traceback.print_exc()
+            self.signals.failed.emit(self, str(error))
+            return
+        if not self.cancelled():
+            self.signals.finished.emit(self, result)
+
+
+class TaskRunner(QObject):
+    started = pyqtSignal(str)
+    progress = pyqtSignal(int)
+    failed = pyqtSignal(str)
+    idle = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.current = None
+
+    def busy(self):
+        return self.current is not None
+
+    def submit(self, function, on_finished, message=""):
+        # only the latest request matters, whatever is still queued or running is dropped
+        self.cancel()
+        task = Task(function, on_finished, message)
+        task.signals.finished.connect(self._finished)
+        task.signals.failed.connect(self._failed)
+        task.signals.progress.connect(self._progress)
+        self.current = task
+        self.pool.start(task)
+        self.started.emit(message)
+        return task
+
+    def cancel(self):
+        task = self.current
+        if task is None:
+            return
+        task.cancel()
+        self.pool.tryTake(task)
+        self.current = None
+        self.idle.emit()
+
+    def wait(self, msecs=-1):
+        return self.pool.waitForDone(msecs)
+
+    def _finished(self, task, result):
+        if task is not self.current:
+            return
+        self.current = None
+        self.idle.emit()
+        task.on_finished(result)
+
+    def _failed(self, task, message):
+        if task is not self.current:
+            return
+        self.current = None
+        self.idle.emit()
+        self.failed.emit(message)
+
+    def _progress(self, task, value):
+        if task is self.current:
+            self.progress.emit(value)
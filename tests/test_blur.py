@@ -0,0 +1,45 @@
+import os
+
+import cv2
+import numpy as np
+import operations
+import pytest
+
+
+IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "images", "Picture2.png")
+# odd sizes, so neither side is a multiple of a pyramid level
+SIZES = [(613, 437), (1001, 769)]
+# the last direct kernel and the first box one, the last box kernel and the first pyramid one, then the step from a
+# 4x to an 8x pyramid level at sigma 64
+KERNELS = [15, 17, 211, 213, 423, 425]
+
+
+def textured(width, height):
+    # fine texture on top of the photo, flat areas would hide most of the error
+    image = cv2.resize(cv2.imread(IMAGE), (width, height))
+    noise = np.random.default_rng(0).integers(0, 256, image.shape, dtype=np.uint8)
+    return cv2.addWeighted(image, 0.7, cv2.GaussianBlur(noise, (0, 0), 2), 0.3, 0)
+
+
+def test_kernels_cover_every_strategy_switch():
+    strategies = [operations.blur_strategy(kernel_size) for kernel_size in KERNELS]
+    assert strategies == ["gaussian", "box", "box", "pyramid", "pyramid", "pyramid"]
+    sigmas = [operations.gaussian_sigma(kernel_size) for kernel_size in KERNELS]
+    assert sigmas[2] <= operations.PYRAMID_BLUR_SIGMA < sigmas[3]
+    assert operations.pyramid_factor(sigmas[4]) < operations.pyramid_factor(sigmas[5])
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("kernel_size", KERNELS)
+def test_blur_matches_gaussian(size, kernel_size):
+    image = textured(*size)
+    result = operations.blur(image, kernel_size)
+    reference = cv2.GaussianBlur(image, (kernel_size, kernel_size), 0)
+    assert result.shape == reference.shape
+    assert result.dtype == reference.dtype
+    assert cv2.PSNR(result, reference) >= operations.BLUR_MIN_PSNR
+
+
+def test_even_kernel_is_rounded_up():
+    image = textured(*SIZES[0])
+    assert np.array_equal(operations.blur(image, 16), operations.blur(image, 17))